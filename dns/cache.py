@@ -9,23 +9,696 @@ It is highly recommended to use these.
 """
 
 
+import fcntl
+import heapq
 import json
+import mmap
+import multiprocessing
+import os
+import struct
+import tempfile
+import threading
 import time
+import zlib
+from collections import OrderedDict
+from multiprocessing import shared_memory
 
-from dns.resource import ResourceRecord
+from dns.classes import Class
+from dns.name import Name
+from dns.resource import ResourceRecord, RecordData
+from dns.types import Type
+
+
+def cache_key(dname, type_, class_):
+    """Canonical key of an RRset in the cache
+
+    Args:
+        dname (Name): domain name
+        type_ (Type): type
+        class_ (Class): class
+
+    Returns:
+        (str, Type, Class): lowercased absolute name, type and class
+    """
+    name = str(dname).lower()
+    if not name.endswith("."):
+        name += "."
+    return name, type_, class_
+
+
+# Approximate memory used by a cached record besides its name and rdata
+RECORD_OVERHEAD = 850
+
+
+def record_size(record):
+    """Approximate number of bytes a cached record uses in memory
+
+    Args:
+        record (ResourceRecord): the record
+    """
+    name = sum(len(label) + 1 for label in record.name.labels)
+    rdata = sum(len(str(value)) for value in record.rdata.to_dict().values())
+    return RECORD_OVERHEAD + 2 * name + rdata
+
+
+class LRUPolicy:
+    """Eviction policy which evicts the least recently used RRset"""
+
+    def __init__(self, capacity):
+        """Initialize the policy
+
+        Args:
+            capacity (int): maximum number of RRsets in the cache (if > 0)
+        """
+        self.keys = OrderedDict()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def access(self, key):
+        """Record a cache hit on key"""
+        self.keys.move_to_end(key)
+
+    def insert(self, key):
+        """Record that key was added to the cache"""
+        self.keys[key] = None
+
+    def remove(self, key):
+        """Record that key was removed from the cache without eviction"""
+        self.keys.pop(key, None)
+
+    def evict(self):
+        """Choose the key to evict and forget it"""
+        return self.keys.popitem(last=False)[0]
+
+
+class LFUPolicy:
+    """Eviction policy which evicts the least frequently used RRset
+
+    Keys with the same number of hits are kept in insertion order in one
+    bucket per count, so every operation is O(1). Ties are broken by
+    evicting the least recently used key.
+    """
+
+    def __init__(self, capacity):
+        """Initialize the policy
+
+        Args:
+            capacity (int): maximum number of RRsets in the cache (if > 0)
+        """
+        self.counts = {}
+        self.buckets = {}
+        self.min_count = 0
+
+    def __len__(self):
+        return len(self.counts)
+
+    def _unlink(self, key):
+        count = self.counts.pop(key)
+        bucket = self.buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[count]
+        return count
+
+    def _link(self, key, count):
+        self.counts[key] = count
+        self.buckets.setdefault(count, OrderedDict())[key] = None
+
+    def access(self, key):
+        """Record a cache hit on key"""
+        count = self._unlink(key)
+        self._link(key, count + 1)
+        if count == self.min_count and count not in self.buckets:
+            self.min_count = count + 1
+
+    def insert(self, key):
+        """Record that key was added to the cache"""
+        self._link(key, 1)
+        self.min_count = 1
+
+    def remove(self, key):
+        """Record that key was removed from the cache without eviction"""
+        if key in self.counts:
+            count = self._unlink(key)
+            if count == self.min_count and count not in self.buckets:
+                self.min_count = min(self.buckets, default=0)
+
+    def evict(self):
+        """Choose the key to evict and forget it"""
+        key = next(iter(self.buckets[self.min_count]))
+        self.remove(key)
+        return key
+
+
+class ARCPolicy:
+    """Adaptive Replacement Cache eviction policy
+
+    See "ARC: A Self-Tuning, Low Overhead Replacement Cache" by Megiddo and
+    Modha. T1 holds keys seen once recently, T2 keys seen at least twice. B1
+    and B2 remember keys recently evicted from T1 and T2, a new key found in
+    one of them shifts the target size p of T1.
+    """
+
+    def __init__(self, capacity):
+        """Initialize the policy
+
+        Args:
+            capacity (int): maximum number of RRsets in the cache, if 0 the
+                current number of RRsets is used to size the ghost lists
+        """
+        self.capacity = capacity
+        self.p = 0
+        self.t1 = OrderedDict()
+        self.t2 = OrderedDict()
+        self.b1 = OrderedDict()
+        self.b2 = OrderedDict()
+
+    def __len__(self):
+        return len(self.t1) + len(self.t2)
+
+    def access(self, key):
+        """Record a cache hit on key"""
+        if key in self.t1:
+            del self.t1[key]
+            self.t2[key] = None
+        else:
+            self.t2.move_to_end(key)
+
+    def insert(self, key):
+        """Record that key was added to the cache"""
+        capacity = self.capacity or max(len(self), 1)
+        if key in self.b1:
+            delta = max(len(self.b2) // len(self.b1), 1)
+            self.p = min(self.p + delta, capacity)
+            del self.b1[key]
+            self.t2[key] = None
+        elif key in self.b2:
+            delta = max(len(self.b1) // len(self.b2), 1)
+            self.p = max(self.p - delta, 0)
+            del self.b2[key]
+            self.t2[key] = None
+        else:
+            self.t1[key] = None
+
+        while self.b1 and len(self.t1) + len(self.b1) > capacity:
+            self.b1.popitem(last=False)
+        while self.b2 and len(self) + len(self.b1) + len(self.b2) > 2 * capacity:
+            self.b2.popitem(last=False)
+
+    def remove(self, key):
+        """Record that key was removed from the cache without eviction"""
+        self.t1.pop(key, None)
+        self.t2.pop(key, None)
+
+    def evict(self):
+        """Choose the key to evict and remember it in a ghost list"""
+        if self.t1 and (len(self.t1) > self.p or not self.t2):
+            key = self.t1.popitem(last=False)[0]
+            self.b1[key] = None
+        else:
+            key = self.t2.popitem(last=False)[0]
+            self.b2[key] = None
+        return key
+
+
+POLICIES = {
+    "lru": LRUPolicy,
+    "lfu": LFUPolicy,
+    "arc": ARCPolicy,
+}
+
+
+class Snapshot:
+    """Binary snapshot of a RecordCache, memory-mapped from the cache file
+
+    The file starts with a header (magic, number of RRsets, number of slots)
+    followed by an open addressing hash table of slots (crc32 of the key,
+    offset, length) and the RRsets. Every RRset is stored as its key
+    followed by its records in uncompressed wire format, with the absolute
+    expiry time as a double instead of the TTL. Opening a snapshot only maps
+    the file, RRsets are decoded when they are first looked up.
+    """
+
+    MAGIC = b"DNSCACH1"
+    HEADER = struct.Struct("!8sII")
+    SLOT = struct.Struct("!III")
+
+    def __init__(self, file_, buf):
+        """Initialize the snapshot, use Snapshot.open instead
+
+        Args:
+            file_ (file): the open cache file
+            buf (mmap): the mapped cache file
+        """
+        self.file = file_
+        self.buf = buf
+        _, self.count, self.slots = self.HEADER.unpack_from(buf, 0)
+
+    def __len__(self):
+        return self.count
+
+    @classmethod
+    def open(cls, filename):
+        """Map a snapshot file
+
+        Returns:
+            Snapshot: the snapshot, or None if filename is not a snapshot
+        """
+        file_ = open(filename, "rb")
+        try:
+            if file_.read(len(cls.MAGIC)) != cls.MAGIC:
+                file_.close()
+                return None
+            buf = mmap.mmap(file_.fileno(), 0, access=mmap.ACCESS_READ)
+        except:
+            file_.close()
+            raise
+        return cls(file_, buf)
+
+    def close(self):
+        self.buf.close()
+        self.file.close()
+
+    @staticmethod
+    def encode_key(key):
+        name, type_, class_ = key
+        return name.encode("utf-8") + struct.pack("!HH", type_, class_)
+
+    @staticmethod
+    def decode_key(data):
+        type_, class_ = struct.unpack_from("!HH", data, len(data) - 4)
+        return data[:-4].decode("utf-8"), Type(type_), Class(class_)
+
+    @classmethod
+    def encode_rrset(cls, key, rrset):
+        """Encode an RRset as a snapshot entry"""
+        bkey = cls.encode_key(key)
+        entry = struct.pack("!H", len(bkey)) + bkey
+        entry += struct.pack("!dH", max(r.ttl for r in rrset), len(rrset))
+        for r in rrset:
+            rdata = r.rdata.to_bytes(0, None)
+            entry += r.name.to_bytes(0, None)
+            entry += struct.pack("!HHdH", r.type_, r.class_, r.ttl, len(rdata))
+            entry += rdata
+        return entry
+
+    def entries(self):
+        """Iterate over the entries as (key, expiry, raw entry)"""
+        buf = self.buf
+        for i in range(self.slots):
+            _, offset, length = self.SLOT.unpack_from(
+                buf, self.HEADER.size + i * self.SLOT.size)
+            if offset:
+                keylen = struct.unpack_from("!H", buf, offset)[0]
+                key = self.decode_key(buf[offset + 2:offset + 2 + keylen])
+                expiry = struct.unpack_from("!d", buf, offset + 2 + keylen)[0]
+                yield key, expiry, buf[offset:offset + length]
+
+    def get(self, key):
+        """Decode the RRset for key
+
+        Returns:
+            [ResourceRecord]: the RRset, or None if key is not in the snapshot
+        """
+        buf = self.buf
+        bkey = self.encode_key(key)
+        hash_ = zlib.crc32(bkey)
+        i = hash_ % self.slots
+        while True:
+            slot_hash, offset, length = self.SLOT.unpack_from(
+                buf, self.HEADER.size + i * self.SLOT.size)
+            if not offset:
+                return None
+            if slot_hash == hash_:
+                keylen = struct.unpack_from("!H", buf, offset)[0]
+                if buf[offset + 2:offset + 2 + keylen] == bkey:
+                    break
+            i = (i + 1) % self.slots
+
+        return self.decode_rrset(buf, offset)
+
+    @staticmethod
+    def decode_rrset(buf, offset):
+        """Decode the records of the entry at offset"""
+        keylen = struct.unpack_from("!H", buf, offset)[0]
+        offset += 2 + keylen + 8
+        count = struct.unpack_from("!H", buf, offset)[0]
+        offset += 2
+        rrset = []
+        for _ in range(count):
+            name, offset = Name.from_bytes(buf, offset)
+            type_, class_, ttl, rdlength = struct.unpack_from("!HHdH", buf,
+                                                              offset)
+            offset += 14
+            rdata = RecordData.create_from_bytes(Type(type_), buf, offset,
+                                                 rdlength)
+            offset += rdlength
+            rrset.append(ResourceRecord(name, Type(type_), Class(class_), ttl,
+                                        rdata))
+        return rrset
+
+    @classmethod
+    def write(cls, filename, entries):
+        """Write a snapshot file
+
+        Args:
+            filename (str): the file written
+            entries ([(tuple, bytes)]): keys and encoded entries
+        """
+        entries = list(entries)
+        slots = max(2 * len(entries), 1)
+        table = [(0, 0, 0)] * slots
+        offset = cls.HEADER.size + slots * cls.SLOT.size
+        for key, entry in entries:
+            hash_ = zlib.crc32(cls.encode_key(key))
+            i = hash_ % slots
+            while table[i][1]:
+                i = (i + 1) % slots
+            table[i] = (hash_, offset, len(entry))
+            offset += len(entry)
+
+        with open(filename, "wb") as file_:
+            file_.write(cls.HEADER.pack(cls.MAGIC, len(entries), slots))
+            file_.write(b"".join(cls.SLOT.pack(*slot) for slot in table))
+            for _, entry in entries:
+                file_.write(entry)
+
+
+class CacheShard:
+    """The part of a RecordCache holding the RRsets whose keys hash to it
+
+    Every shard has its own lock, eviction policy and expiry heap, so
+    threads using different shards do not wait for each other. Except for
+    lookup, the methods must be called with lock held.
+    """
+
+    def __init__(self, max_entries, max_bytes, policy):
+        """Initialize the shard
+
+        Args:
+            max_entries (int): maximum number of RRsets (if > 0)
+            max_bytes (int): approximate maximum memory use (if > 0)
+            policy (str): eviction policy, one of POLICIES
+        """
+        self.lock = threading.Lock()
+        self.records = {}
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.policy = POLICIES[policy](max_entries)
+        self.sizes = {}
+        self.size = 0
+        self.expiry = []
+        self.deadlines = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.journal = []
+        self.journaling = True
+        self.snapshot = None
+        self.shadowed = set()
+        self.generation = 0
+        self.versions = {}
+
+    def lookup(self, key):
+        """Lookup the RRset for key
+
+        A live RRset which is already in the shard is returned without
+        taking the lock. Its use is only passed to the eviction policy if the
+        lock is free, and the hit counter may miss some hits when threads
+        race. Everything else is done with the lock held.
+        """
+        rrset = self.records.get(key)
+        if rrset is not None:
+            deadline = self.deadlines.get(key)
+            if deadline is not None and deadline >= time.time():
+                self.hits += 1
+                if self.lock.acquire(False):
+                    try:
+                        if key in self.records:
+                            self.policy.access(key)
+                    finally:
+                        self.lock.release()
+                return list(rrset)
+
+        with self.lock:
+            self.expire()
+            rrset = self.records.get(key)
+            if rrset is None and self.snapshot and key not in self.shadowed:
+                self.materialize(key)
+                rrset = self.records.get(key)
+            if rrset is None:
+                self.misses += 1
+                return []
+
+            self.hits += 1
+            self.policy.access(key)
+            return list(rrset)
+
+    def expire(self, now=None):
+        """Remove the expired records from the shard
+
+        Args:
+            now (float): current time, time.time() if None
+        """
+        if now is None:
+            now = time.time()
+        expiry = self.expiry
+        while expiry and expiry[0][0] < now:
+            deadline, key = heapq.heappop(expiry)
+            if self.deadlines.get(key) != deadline:
+                continue
+            del self.deadlines[key]
+            rrset = [r for r in self.records[key] if r.ttl >= now]
+            if rrset:
+                self.records[key] = rrset
+                self.touch(key)
+                self.resize(key)
+                self.schedule(key, min(r.ttl for r in rrset))
+            else:
+                self.remove_rrset(key)
+                self.log_event("expire", key)
+                self.expirations += 1
+
+    def schedule(self, key, deadline):
+        """Make sure the RRset for key is checked at deadline"""
+        current = self.deadlines.get(key)
+        if current is not None and current <= deadline:
+            return
+        self.deadlines[key] = deadline
+        heapq.heappush(self.expiry, (deadline, key))
+        if len(self.expiry) > 2 * len(self.deadlines) + 64:
+            self.expiry = [(t, k) for k, t in self.deadlines.items()]
+            heapq.heapify(self.expiry)
+
+    def insert_record(self, record, key):
+        """Insert a record whose ttl is already an absolute expiry time"""
+        self.expire()
+        rrset = self.records.get(key)
+        if rrset is None and self.snapshot and key not in self.shadowed:
+            self.materialize(key)
+            rrset = self.records.get(key)
+        self.touch(key)
+        if rrset is None:
+            self.evict(1, record_size(record))
+            self.records[key] = [record]
+            self.policy.insert(key)
+        else:
+            rdata = record.rdata.to_dict()
+            for i, x in enumerate(rrset):
+                if x.rdata.to_dict() == rdata:
+                    rrset[i] = record
+                    self.schedule(key, record.ttl)
+                    return
+            rrset.append(record)
+        self.schedule(key, record.ttl)
+        self.resize(key)
+        self.evict()
+
+    def materialize(self, key):
+        """Move the RRset for key from the snapshot into the shard"""
+        self.shadowed.add(key)
+        now = time.time()
+        for record in self.snapshot.get(key) or []:
+            if record.ttl >= now:
+                self.insert_record(record, key)
+
+    def touch(self, key):
+        """Give the RRset for key a new version, see RecordCache"""
+        self.generation += 1
+        self.versions[key] = self.generation
+
+    def resize(self, key):
+        """Update the size of the RRset for key after it changed"""
+        size = sum(record_size(r) for r in self.records[key])
+        self.size += size - self.sizes.get(key, 0)
+        self.sizes[key] = size
+
+    def remove_rrset(self, key):
+        """Remove the RRset for key from the shard"""
+        self.generation += 1
+        self.versions.pop(key, None)
+        del self.records[key]
+        self.size -= self.sizes.pop(key)
+        self.deadlines.pop(key, None)
+        self.policy.remove(key)
+
+    def clear(self):
+        """Remove all RRsets from the shard"""
+        for key in list(self.records):
+            self.remove_rrset(key)
+
+    def evict(self, entries=0, size=0):
+        """Evict RRsets until the shard is within its bounds
+
+        Args:
+            entries (int): number of RRsets to make room for
+            size (int): number of bytes to make room for
+        """
+        while len(self.policy) and (
+                (self.max_entries and
+                 len(self.records) + entries > self.max_entries) or
+                (self.max_bytes and self.size + size > self.max_bytes)):
+            key = self.policy.evict()
+            self.generation += 1
+            self.versions.pop(key, None)
+            del self.records[key]
+            self.size -= self.sizes.pop(key)
+            self.deadlines.pop(key, None)
+            self.log_event("evict", key)
+            self.evictions += 1
+
+    def log_event(self, event, key):
+        """Add an eviction or expiry of key to the journal"""
+        if self.journaling:
+            name, type_, class_ = key
+            self.journal.append({event: [name, str(type_), str(class_)]})
+
+    def replay(self, key, event):
+        """Apply an event for key read from the journal"""
+        if "add" in event:
+            record = ResourceRecord.from_dict(event["add"])
+            if record.ttl >= time.time():
+                self.insert_record(record, key)
+            return
+        self.shadowed.add(key)
+        if key in self.records:
+            self.remove_rrset(key)
 
 
 class RecordCache:
-    """Cache for ResourceRecords"""
+    """Cache for ResourceRecords
+
+    Records are stored per RRset in a dictionary keyed by cache_key, so
+    lookups and insertions do not depend on the size of the cache. The
+    dictionary is split over a number of CacheShards chosen by the hash of
+    the key, each with its own lock, so the cache can be used by several
+    threads at once.
 
-    def __init__(self, ttl):
+    The cache can be bounded by a number of RRsets and by an approximate
+    number of bytes (see record_size). When a bound is exceeded RRsets are
+    evicted as chosen by the eviction policy. The bounds are divided evenly
+    over the shards.
+
+    Changes to the cache are persisted as an append-only journal of add,
+    evict and expire events next to a snapshot in the cache file, see
+    write_cache_file. The snapshot is memory-mapped when the cache is read,
+    an RRset only moves from the snapshot into the cache when it is first
+    used. Keys in the shadowed set of a shard are no longer taken from the
+    snapshot, because the shard itself holds (or has dropped) their RRsets.
+
+    Several processes (the workers of a Supervisor) can share the cache
+    file. Writes hold an flock on filename.lock, and before a process
+    appends to the journal or compacts it replays the events the other
+    processes appended since it last read the journal, see merge_journal.
+
+    Expired records are found with a min-heap of (expiry time, key) holding
+    the earliest expiry time of every RRset. Insertions and lookups which
+    take the lock first purge the RRsets whose time has come, so the cache
+    only holds live records and lookups do not have to check the expiry
+    time of every record.
+    """
+
+    def __init__(self, ttl, max_entries=0, max_bytes=0, policy="lru",
+                 filename="cache", shards=1):
         """Initialize the RecordCache
 
         Args:
             ttl (int): TTL of cached entries (if > 0)
+            max_entries (int): maximum number of RRsets (if > 0)
+            max_bytes (int): approximate maximum memory use (if > 0)
+            policy (str): eviction policy, one of POLICIES
+            filename (str): cache file, the journal is filename.journal
+            shards (int): number of shards
         """
-        self.records = {}
         self.ttl = ttl
+        self.filename = filename
+        self.shards = [CacheShard(-(-max_entries // shards),
+                                  -(-max_bytes // shards), policy)
+                       for _ in range(shards)]
+        self.snapshot = None
+        self.journal_lines = 0
+        self.journal_position = (None, 0)
+        self.compact_after = 1000
+        self.file_lock = threading.RLock()
+
+    def __len__(self):
+        """Number of RRsets in the cache"""
+        return sum(len(shard.records) for shard in self.shards)
+
+    @property
+    def generation(self):
+        """Number which changes whenever the content of the cache changes"""
+        return sum(shard.generation for shard in self.shards)
+
+    def rrset_version(self, key):
+        """Number which changes whenever the RRset for key changes
+
+        Args:
+            key (tuple): the cache_key of the RRset
+
+        Returns:
+            int: the version, or None if the RRset is not in the shard
+        """
+        return self.shard(key).versions.get(key)
+
+    def shard(self, key):
+        """The shard holding the RRset for key"""
+        return self.shards[hash(key) % len(self.shards)]
+
+    def rrsets(self):
+        """List all (key, RRset) pairs in the cache"""
+        items = []
+        for shard in self.shards:
+            with shard.lock:
+                items.extend(shard.records.items())
+        return items
+
+    def stats(self):
+        """Counters of the cache
+
+        Returns:
+            dict: entries, bytes, snapshot entries, hits, misses, evictions
+                and expirations
+        """
+        stats = {"entries": len(self),
+                 "snapshot": len(self.snapshot) if self.snapshot else 0}
+        for counter in ["size", "hits", "misses", "evictions", "expirations"]:
+            stats[counter] = sum(getattr(shard, counter)
+                                 for shard in self.shards)
+        stats["bytes"] = stats.pop("size")
+        return stats
+
+    def expire(self, now=None):
+        """Remove the expired records from the cache
+
+        Args:
+            now (float): current time, time.time() if None
+        """
+        for shard in self.shards:
+            with shard.lock:
+                shard.expire(now)
 
     def lookup(self, dname, type_, class_):
         """Lookup resource records in cache
@@ -38,22 +711,13 @@ class RecordCache:
             type_ (Type): type
             class_ (Class): class
         """
-
-        res = []
-        for r in self.records:
-            if r.name == dname and r.type_ == type_ and r.class_ == class_:
-                if r.ttl < time.time():
-                    r = None
-                else:
-                    res.append(r)
-
-        self.records = [x for x in self.records if not x == None]
-
-        return res
+        key = cache_key(dname, type_, class_)
+        return self.shard(key).lookup(key)
 
     def dump_cache(self):
-        for r in self.records:
-            print(r.to_dict())
+        for _, rrset in self.rrsets():
+            for r in rrset:
+                print(r.to_dict())
 
     def add_record(self, record):
         """Add a new Record to the cache
@@ -62,29 +726,694 @@ class RecordCache:
             record (ResourceRecord): the record added to the cache
         """
         record.ttl = record.ttl + time.time()
-        for x in self.records:
-            if x.name == record.name and x.type_ == record.type_ and x.class_ == record.class_:
-                key = list(x.rdata.to_dict().keys())[0]
-                if x.rdata.to_dict()[key] == record.rdata.to_dict()[key]:
-                    x = record
-                    return
-        self.records.append(record)
+        key = cache_key(record.name, record.type_, record.class_)
+        shard = self.shard(key)
+        with shard.lock:
+            shard.insert_record(record, key)
+            if shard.journaling:
+                shard.journal.append({"add": record.to_dict()})
+
+    def insert_record(self, record):
+        """Insert a record whose ttl is already an absolute expiry time"""
+        key = cache_key(record.name, record.type_, record.class_)
+        shard = self.shard(key)
+        with shard.lock:
+            shard.insert_record(record, key)
 
     def read_cache_file(self):
-        """Read the cache file from disk"""
-        dcts = []
+        """Read the cache file from disk
+
+        The snapshot in the cache file is mapped (or loaded, if it is an old
+        JSON cache file) first, then the events in the journal are replayed
+        on top of it.
+        """
+        with self.file_lock:
+            self.lock_shards()
+            try:
+                self.read_files()
+            finally:
+                self.unlock_shards()
+
+    def read_files(self):
+        for shard in self.shards:
+            shard.journaling = False
+            shard.clear()
+        self.close_snapshot()
         try:
-            with open("cache", "r") as file_:
-                dcts = json.load(file_)
+            self.snapshot = Snapshot.open(self.filename)
+            if self.snapshot is None:
+                self.read_json_file()
         except:
             print("could not read cache")
-        self.records = [ResourceRecord.from_dict(dct) for dct in dcts]
+        for shard in self.shards:
+            shard.snapshot = self.snapshot
+
+        self.journal_position = (None, 0)
+        self.replay_journal()
+        for shard in self.shards:
+            shard.journal = []
+            shard.journaling = True
+
+    def replay_journal(self):
+        """Replay the journal from journal_position
+
+        The events before journal_position were written or read by this
+        process already. If the journal was replaced by a compaction of
+        another process (it has another inode) the snapshot that process
+        wrote is mapped and the journal is read from the start. The shards
+        must be locked and not journaling.
+        """
+        try:
+            file_ = open(self.filename + ".journal", "rb")
+        except FileNotFoundError:
+            return
+        with file_:
+            inode = os.fstat(file_.fileno()).st_ino
+            if inode != self.journal_position[0]:
+                if self.journal_position[0] is not None:
+                    self.reopen_snapshot()
+                self.journal_position = (inode, 0)
+                self.journal_lines = 0
+            offset = self.journal_position[1]
+            file_.seek(offset)
+            for line in file_:
+                if not line.endswith(b"\n"):
+                    # The last event is still being written
+                    break
+                offset += len(line)
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    # An event which was not written completely
+                    continue
+                if "add" in event:
+                    dct = event["add"]
+                    key = cache_key(dct["name"], Type[dct["type"]],
+                                    Class[dct["class"]])
+                else:
+                    name, type_, class_ = (event.get("evict") or
+                                           event["expire"])
+                    key = (name, Type[type_], Class[class_])
+                self.shard(key).replay(key, event)
+                self.journal_lines += 1
+            self.journal_position = (inode, offset)
+
+    def reopen_snapshot(self):
+        """Map the snapshot written by a compaction of another process
+
+        The shadowed keys stay shadowed, the shards hold (or dropped) their
+        RRsets.
+        """
+        if self.snapshot is not None:
+            self.snapshot.close()
+        try:
+            self.snapshot = Snapshot.open(self.filename)
+        except OSError:
+            self.snapshot = None
+        for shard in self.shards:
+            shard.snapshot = self.snapshot
+
+    def merge_journal(self):
+        """Replay the events other processes appended to the journal"""
+        self.lock_shards()
+        try:
+            for shard in self.shards:
+                shard.journaling = False
+            self.replay_journal()
+        finally:
+            for shard in self.shards:
+                shard.journaling = True
+            self.unlock_shards()
+
+    def lock_file(self):
+        """Open and flock the lock file, it is unlocked when it is closed"""
+        file_ = open(self.filename + ".lock", "a")
+        fcntl.flock(file_, fcntl.LOCK_EX)
+        return file_
+
+    def read_json_file(self):
+        """Load a cache file in the JSON format of older versions"""
+        with open(self.filename, "r") as file_:
+            dcts = json.load(file_)
+        now = time.time()
+        for dct in dcts:
+            record = ResourceRecord.from_dict(dct)
+            if record.ttl >= now:
+                key = cache_key(record.name, record.type_, record.class_)
+                self.shard(key).insert_record(record, key)
+
+    def close_snapshot(self):
+        if self.snapshot is not None:
+            self.snapshot.close()
+            self.snapshot = None
+        for shard in self.shards:
+            shard.snapshot = None
+            shard.shadowed = set()
+
+    def lock_shards(self):
+        for shard in self.shards:
+            shard.lock.acquire()
+
+    def unlock_shards(self):
+        for shard in self.shards:
+            shard.lock.release()
 
     def write_cache_file(self):
-        """Write the cache file to disk"""
-        dcts = [record.to_dict() for record in self.records]
+        """Write the changes to the cache to disk
+
+        The events since the last write are appended to the journal. Once the
+        journal holds more events than compact_after, or than the number of
+        RRsets in the cache, the cache is compacted: the whole cache is
+        written as a new snapshot and the journal is emptied.
+        """
+        with self.file_lock:
+            events = []
+            for shard in self.shards:
+                with shard.lock:
+                    events.extend(shard.journal)
+                    shard.journal = []
+            try:
+                lock = self.lock_file()
+            except OSError:
+                print("could not write cache")
+                return
+            with lock:
+                self.merge_journal()
+                if events:
+                    lines = "".join(json.dumps(event) + "\n"
+                                    for event in events).encode()
+                    try:
+                        with open(self.filename + ".journal", "ab") as file_:
+                            file_.write(lines)
+                            inode = os.fstat(file_.fileno()).st_ino
+                    except:
+                        print("could not write cache")
+                        return
+                    self.journal_position = (
+                        inode, self.journal_position[1] + len(lines)
+                        if inode == self.journal_position[0] else len(lines))
+                    self.journal_lines += len(events)
+                if self.journal_lines > max(self.compact_after, len(self)):
+                    self.write_files()
+
+    def compact(self):
+        """Write the whole cache as a snapshot and empty the journal
+
+        RRsets which are still only in the old snapshot are copied without
+        decoding them.
+        """
+        with self.file_lock:
+            try:
+                lock = self.lock_file()
+            except OSError:
+                print("could not write cache")
+                return
+            with lock:
+                self.merge_journal()
+                self.write_files()
+
+    def write_files(self):
+        self.lock_shards()
+        try:
+            self.write_snapshot()
+        finally:
+            self.unlock_shards()
+
+    def replace_file(self, filename, write):
+        """Write a file under a temporary name and move it into place
+
+        Args:
+            filename (str): the file replaced
+            write (function): writes the file, called with its name
+        """
+        fd, temp = tempfile.mkstemp(
+            prefix=os.path.basename(filename) + ".",
+            dir=os.path.dirname(filename) or ".")
+        os.close(fd)
         try:
-            with open("cache", "w") as file_:
-                json.dump(dcts, file_, indent=2)
+            write(temp)
+            os.replace(temp, filename)
+        except:
+            os.unlink(temp)
+            raise
+
+    def write_snapshot(self):
+        now = time.time()
+        entries = [(key, Snapshot.encode_rrset(key, rrset))
+                   for shard in self.shards
+                   for key, rrset in shard.records.items()]
+        if self.snapshot is not None:
+            for key, expiry, entry in self.snapshot.entries():
+                shard = self.shard(key)
+                if (expiry >= now and key not in shard.shadowed and
+                        key not in shard.records):
+                    entries.append((key, entry))
+        try:
+            self.replace_file(self.filename,
+                              lambda temp: Snapshot.write(temp, entries))
+            self.replace_file(self.filename + ".journal",
+                              lambda temp: None)
+            inode = os.stat(self.filename + ".journal").st_ino
+            self.close_snapshot()
+            self.snapshot = Snapshot.open(self.filename)
         except:
             print("could not write cache")
+            return
+        for shard in self.shards:
+            shard.snapshot = self.snapshot
+            shard.shadowed = set(shard.records)
+        self.journal_lines = 0
+        self.journal_position = (inode, 0)
+
+
+class SharedRecordCache:
+    """Cache for ResourceRecords shared by several processes
+
+    The records are kept in a fixed-size table in shared memory, so an RRset
+    added by one worker process is found by all others. The table is split
+    in buckets of WAYS slots of SLOT_SIZE bytes, the bucket of an RRset is
+    chosen by the crc32 of its key. A slot holds a header (sequence number,
+    hash, expiry time, length) followed by the RRset encoded like a Snapshot
+    entry. RRsets which do not fit in a slot are not cached.
+
+    Writers lock one of a number of locks chosen by the bucket. Readers do
+    not lock: a writer makes the sequence number odd while it changes a
+    slot, readers copy the slot and retry if the sequence number was odd or
+    changed meanwhile. When a bucket is full the RRset expiring first is
+    evicted.
+
+    A worker may be killed while it writes. Readers give up on a slot after
+    READ_RETRIES tries and treat it as a miss. A writer which waits longer
+    than LOCK_TIMEOUT for a lock whose holder is dead takes the lock over
+    and empties the slots the holder left half written; if the holder is
+    alive the RRset is not cached.
+
+    The cache must be created before the worker processes are forked, so
+    they inherit the shared memory and the locks. It is not persisted, the
+    cache file is not used.
+    """
+
+    SLOT_SIZE = 512
+    WAYS = 8
+    HEADER = struct.Struct("!IIdH")
+    READ_RETRIES = 10000
+    LOCK_TIMEOUT = 1
+
+    def __init__(self, ttl, slots, locks=64):
+        """Initialize the SharedRecordCache
+
+        Args:
+            ttl (int): TTL of cached entries (if > 0)
+            slots (int): number of RRsets the table can hold
+            locks (int): number of locks for writers
+        """
+        self.ttl = ttl
+        self.buckets = max(slots // self.WAYS, 1)
+        self.memory = shared_memory.SharedMemory(
+            create=True, size=self.buckets * self.WAYS * self.SLOT_SIZE)
+        self.buf = self.memory.buf
+        self.locks = [multiprocessing.Lock() for _ in range(locks)]
+        self.holders = multiprocessing.Array("i", locks, lock=False)
+        self.recovery = multiprocessing.Lock()
+        self.changes = multiprocessing.Value("Q", 0, lock=False)
+        self.owner = os.getpid()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        """Number of live RRsets in the table"""
+        now = time.time()
+        return sum(1 for slot in range(self.buckets * self.WAYS)
+                   if self.HEADER.unpack_from(
+                       self.buf, slot * self.SLOT_SIZE)[2] >= now)
+
+    @property
+    def generation(self):
+        """Number which changes whenever the content of the table changes
+
+        Writers of different buckets may increment it at the same time and
+        lose an increment, but it still changes.
+        """
+        return self.changes.value
+
+    def rrset_version(self, key):
+        """Number which changes whenever the RRset for key changes
+
+        The version is the slot of the RRset and its sequence number.
+
+        Args:
+            key (tuple): the cache_key of the RRset
+
+        Returns:
+            (int, int): the version, or None if the RRset is not in the table
+        """
+        bkey = Snapshot.encode_key(key)
+        hash_ = zlib.crc32(bkey)
+        found = self.find(hash_ % self.buckets, hash_, bkey)
+        if found is None:
+            return None
+        return found[0], struct.unpack_from(
+            "!I", self.buf, found[0] * self.SLOT_SIZE)[0]
+
+    def stats(self):
+        """Counters of this process
+
+        Returns:
+            dict: entries, hits, misses and evictions
+        """
+        return {"entries": len(self), "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions}
+
+    def close(self):
+        """Remove the shared memory once the creating process is done"""
+        if os.getpid() == self.owner:
+            self.memory.unlink()
+            self.owner = None
+
+    def read_slot(self, slot):
+        """Copy a slot without tearing
+
+        Returns:
+            (int, float, bytes): hash, expiry time and entry of the slot
+        """
+        offset = slot * self.SLOT_SIZE
+        for _ in range(self.READ_RETRIES):
+            seq = self.HEADER.unpack_from(self.buf, offset)[0]
+            if seq & 1:
+                continue
+            data = bytes(self.buf[offset:offset + self.SLOT_SIZE])
+            if struct.unpack_from("!I", self.buf, offset)[0] == seq:
+                _, hash_, expiry, length = self.HEADER.unpack_from(data, 0)
+                return hash_, expiry, data[self.HEADER.size:
+                                           self.HEADER.size + length]
+        # The writer of the slot is stuck or died while writing
+        return 0, 0.0, b""
+
+    def acquire(self, index):
+        """Acquire a writer lock, taking it over if its holder died
+
+        Returns:
+            bool: whether the lock is held, False if a live process held it
+                for LOCK_TIMEOUT seconds
+        """
+        if self.locks[index].acquire(timeout=self.LOCK_TIMEOUT):
+            self.holders[index] = os.getpid()
+            return True
+        if not self.recovery.acquire(timeout=self.LOCK_TIMEOUT):
+            return False
+        try:
+            holder = self.holders[index]
+            if not holder or process_alive(holder):
+                return False
+            self.holders[index] = os.getpid()
+        finally:
+            self.recovery.release()
+        self.repair(index)
+        return True
+
+    def release(self, index):
+        """Release a writer lock"""
+        self.holders[index] = 0
+        self.locks[index].release()
+
+    def repair(self, index):
+        """Empty the slots under a lock which were left half written"""
+        for bucket in range(index, self.buckets, len(self.locks)):
+            for slot in range(bucket * self.WAYS, (bucket + 1) * self.WAYS):
+                offset = slot * self.SLOT_SIZE
+                seq = struct.unpack_from("!I", self.buf, offset)[0]
+                if seq & 1:
+                    self.HEADER.pack_into(self.buf, offset,
+                                          (seq + 1) & 0xffffffff, 0, 0.0, 0)
+
+    def write_slot(self, slot, hash_, expiry, entry):
+        """Write a slot, with the lock of its bucket held"""
+        offset = slot * self.SLOT_SIZE
+        seq = struct.unpack_from("!I", self.buf, offset)[0]
+        struct.pack_into("!I", self.buf, offset, (seq + 1) & 0xffffffff)
+        start = offset + self.HEADER.size
+        self.buf[start:start + len(entry)] = entry
+        self.changes.value += 1
+        self.HEADER.pack_into(self.buf, offset, (seq + 2) & 0xffffffff,
+                              hash_, expiry, len(entry))
+
+    def find(self, bucket, hash_, bkey):
+        """Find the RRset for a key in its bucket
+
+        Returns:
+            (int, float, bytes): slot, expiry time and entry, or None
+        """
+        for slot in range(bucket * self.WAYS, (bucket + 1) * self.WAYS):
+            slot_hash, expiry, entry = self.read_slot(slot)
+            if slot_hash == hash_ and entry[2:2 + len(bkey)] == bkey:
+                return slot, expiry, entry
+        return None
+
+    def lookup(self, dname, type_, class_):
+        """Lookup resource records in cache
+
+        Args:
+            dname (str): domain name
+            type_ (Type): type
+            class_ (Class): class
+        """
+        bkey = Snapshot.encode_key(cache_key(dname, type_, class_))
+        hash_ = zlib.crc32(bkey)
+        found = self.find(hash_ % self.buckets, hash_, bkey)
+        now = time.time()
+        if found is None or found[1] < now:
+            self.misses += 1
+            return []
+        rrset = [r for r in Snapshot.decode_rrset(found[2], 0) if r.ttl >= now]
+        if rrset:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return rrset
+
+    def dump_cache(self):
+        now = time.time()
+        for slot in range(self.buckets * self.WAYS):
+            _, expiry, entry = self.read_slot(slot)
+            if expiry >= now:
+                for r in Snapshot.decode_rrset(entry, 0):
+                    print(r.to_dict())
+
+    def add_record(self, record):
+        """Add a new Record to the cache
+
+        Args:
+            record (ResourceRecord): the record added to the cache
+        """
+        record.ttl = record.ttl + time.time()
+        self.insert_record(record)
+
+    def insert_record(self, record):
+        """Insert a record whose ttl is already an absolute expiry time"""
+        key = cache_key(record.name, record.type_, record.class_)
+        bkey = Snapshot.encode_key(key)
+        hash_ = zlib.crc32(bkey)
+        bucket = hash_ % self.buckets
+        now = time.time()
+        index = bucket % len(self.locks)
+        if not self.acquire(index):
+            return
+        try:
+            found = self.find(bucket, hash_, bkey)
+            rrset = []
+            if found is not None:
+                slot, expiry, entry = found
+                if expiry >= now:
+                    rrset = [r for r in Snapshot.decode_rrset(entry, 0)
+                             if r.ttl >= now]
+            else:
+                slot = self.free_slot(bucket, now)
+
+            rdata = record.rdata.to_dict()
+            rrset = [r for r in rrset if r.rdata.to_dict() != rdata]
+            rrset.append(record)
+            entry = Snapshot.encode_rrset(key, rrset)
+            if self.HEADER.size + len(entry) > self.SLOT_SIZE:
+                return
+            self.write_slot(slot, hash_, max(r.ttl for r in rrset), entry)
+        finally:
+            self.release(index)
+
+    def free_slot(self, bucket, now):
+        """Choose the slot for a new RRset, evicting one if needed"""
+        slots = range(bucket * self.WAYS, (bucket + 1) * self.WAYS)
+        expiries = [(self.HEADER.unpack_from(
+            self.buf, slot * self.SLOT_SIZE)[2], slot) for slot in slots]
+        expiry, slot = min(expiries)
+        if expiry >= now:
+            self.evictions += 1
+        return slot
+
+    def expire(self, now=None):
+        """Expired slots are reused by insert_record, nothing to do"""
+        pass
+
+    def read_cache_file(self):
+        """The shared cache is not persisted, nothing to read"""
+        pass
+
+    def write_cache_file(self):
+        """The shared cache is not persisted, nothing to write"""
+        pass
+
+
+def process_alive(pid):
+    """Whether a process exists"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def ttl_offsets(packet):
+    """Find the offsets of the TTL fields of the resource records in a message
+
+    Args:
+        packet (bytes): an encoded message
+
+    Returns:
+        [int]: offsets of the 32-bit TTL fields
+    """
+    def skip_name(offset):
+        while packet[offset] != 0:
+            if packet[offset] & 0xc0 == 0xc0:
+                return offset + 2
+            offset += packet[offset] + 1
+        return offset + 1
+
+    qdcount, ancount, nscount, arcount = struct.unpack_from("!HHHH", packet, 4)
+    offset = 12
+    for _ in range(qdcount):
+        offset = skip_name(offset) + 4
+    offsets = []
+    for _ in range(ancount + nscount + arcount):
+        offset = skip_name(offset) + 4
+        offsets.append(offset)
+        rdlength = struct.unpack_from("!H", packet, offset + 4)[0]
+        offset += 6 + rdlength
+    return offsets
+
+
+class PacketCache:
+    """Cache of encoded responses keyed by the request
+
+    A request is identified by its opcode and RD flag and everything after
+    the flags (section counts and question), so the response to a repeated
+    request can be sent without parsing the request or encoding records.
+    On a hit only the ID is patched into a copy of the response, and for
+    responses whose TTLs decay the time since the response was stored is
+    subtracted from every TTL.
+
+    An entry is only used while the zone and, for responses built from the
+    record cache, the RRsets it was built from are unchanged, and until its
+    expiry time. An answer from a single node of a zone is kept while that node
+    is unchanged and no names are added to or removed from the zones, so a
+    dynamic update only invalidates the answers it changes. When the cache
+    is full the oldest entry is dropped.
+    """
+
+    def __init__(self, max_entries, cache):
+        """Initialize the PacketCache
+
+        Args:
+            max_entries (int): maximum number of cached responses
+            cache (RecordCache): the record cache responses are built from
+        """
+        self.max_entries = max_entries
+        self.cache = cache
+        self.packets = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.packets)
+
+    @staticmethod
+    def key(data):
+        """The key for a request datagram"""
+        return bytes([data[2] & 0x79]) + data[4:]
+
+    def stats(self):
+        """Counters of the cache
+
+        Returns:
+            dict: entries, hits and misses
+        """
+        return {"entries": len(self), "hits": self.hits,
+                "misses": self.misses}
+
+    def get(self, data, version, shape=None):
+        """Find the response to a request
+
+        Args:
+            data (bytes): the request datagram
+            version (int): current version of the zone
+            shape (int): current shape of the zones, see Catalog
+
+        Returns:
+            bytes: the response, or None if it is not cached
+        """
+        key = self.key(data)
+        entry = self.packets.get(key)
+        now = time.time()
+        if entry is not None:
+            response, offsets, stored, expires, entry_version, \
+                entry_rrsets, entry_node = entry
+            if entry_node is not None:
+                zone, node, node_version = entry_node
+                current = (entry_version == shape and
+                           zone.node_version(node) == node_version)
+            else:
+                current = entry_version == version
+            if (now <= expires and current and
+                    (entry_rrsets is None or
+                     all(self.cache.rrset_version(rrset) == rrset_version
+                         for rrset, rrset_version in entry_rrsets))):
+                self.hits += 1
+                packet = bytearray(response)
+                packet[0:2] = data[0:2]
+                elapsed = int(now - stored)
+                if offsets and elapsed:
+                    for offset in offsets:
+                        ttl = struct.unpack_from("!I", packet, offset)[0]
+                        struct.pack_into("!I", packet, offset,
+                                         max(ttl - elapsed, 0))
+                return bytes(packet)
+            self.packets.pop(key, None)
+        self.misses += 1
+        return None
+
+    def put(self, data, response, expires, version, rrsets=None,
+            decay=False, node=None):
+        """Store the response to a request
+
+        Args:
+            data (bytes): the request datagram
+            response (bytes): the encoded response
+            expires (float): time after which the response is not used
+            version (int): version of the zone the response was built from,
+                or the shape of the zones if node is given
+            rrsets ([(tuple, int)]): the cache keys and versions (see
+                rrset_version) of the RRsets of the record cache the response
+                was built from, or None if it does not depend on the cache
+            decay (bool): decrease the TTLs by the time since storing
+            node ((Zone, Node, int)): the zone, node and node version (see
+                Zone.node_version) the response was built from, if it only
+                depends on that node
+        """
+        offsets = ttl_offsets(response) if decay else []
+        with self.lock:
+            if len(self.packets) >= self.max_entries:
+                self.packets.pop(next(iter(self.packets)), None)
+            self.packets[self.key(data)] = (response, offsets, time.time(),
+                                            expires, version, rrsets, node)
@@ -31,6 +31,7 @@ class Class(IntEnum):
     CS = 2
     CH = 3
     HS = 4
+    NONE = 254
     ANY = 255
 
     def __str__(self):
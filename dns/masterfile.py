@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+
+"""Master files
+
+This module contains a parser for master files (zone files) as described in
+section 5 of RFC 1035, with the $TTL directive of RFC 2308. The file is read
+line by line and the records are yielded as they are parsed, so a zone of any
+size is parsed in constant memory.
+"""
+
+import os.path
+import re
+import socket
+import struct
+
+from dns.classes import Class
+from dns.name import Name
+from dns.resource import (ResourceRecord, ARecordData, CNAMERecordData,
+                          NSRecordData, SOARecordData, GenericRecordData)
+from dns.types import Type
+
+
+SPECIAL = re.compile(r'[;()"\\]')
+TTL_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+CLASSES = {"IN", "CS", "CH", "HS"}
+
+
+class MasterFileError(ValueError):
+    """An error in a master file"""
+
+    def __init__(self, message, filename, lineno):
+        """Initialize the error
+
+        Args:
+            message (str): what is wrong
+            filename (str): the master file
+            lineno (int): the line the entry with the error starts on
+        """
+        super().__init__("{}:{}: {}".format(filename, lineno, message))
+        self.filename = filename
+        self.lineno = lineno
+
+
+def split_special(line, tokens, depth, error):
+    """Split a line with comments, parentheses, quotes or escapes
+
+    Quoted strings are added to tokens with their quotes.
+
+    Args:
+        line (str): the line
+        tokens ([str]): tokens of the entry, the tokens of line are added
+        depth (int): number of open parentheses before the line
+        error (function): raises a MasterFileError for a message
+
+    Returns:
+        int: number of open parentheses after the line
+    """
+    i = 0
+    n = len(line)
+    while i < n:
+        c = line[i]
+        if c in " \t\r\n":
+            i += 1
+        elif c == ";":
+            break
+        elif c == "(":
+            depth += 1
+            i += 1
+        elif c == ")":
+            depth -= 1
+            if depth < 0:
+                error("unbalanced parentheses")
+            i += 1
+        elif c == '"':
+            j = i + 1
+            while j < n and line[j] != '"':
+                j += 2 if line[j] == "\\" else 1
+            if j >= n:
+                error("unterminated string")
+            tokens.append(line[i:j + 1])
+            i = j + 1
+        else:
+            j = i
+            while j < n and line[j] not in ' \t\r\n;()"':
+                j += 2 if line[j] == "\\" else 1
+            tokens.append(line[i:j])
+            i = j
+    return depth
+
+
+def unescape(text, error):
+    """Decode the \\X and \\DDD escapes in a character string to bytes"""
+    data = bytearray()
+    i = 0
+    while i < len(text):
+        if text[i] != "\\":
+            data += text[i].encode("utf-8")
+            i += 1
+        elif text[i + 1:i + 4].isdigit() and len(text[i + 1:i + 4]) == 3:
+            data.append(int(text[i + 1:i + 4]) & 0xff)
+            i += 4
+        elif i + 1 < len(text):
+            data += text[i + 1].encode("utf-8")
+            i += 2
+        else:
+            error("escape at end of string")
+    return bytes(data)
+
+
+def parse_ttl(token, error):
+    """Parse a TTL, in seconds or with units (1h30m)"""
+    if token.isdigit():
+        ttl = int(token)
+    elif re.fullmatch(r"(\d+[smhdw])+", token.lower()):
+        ttl = sum(int(value) * TTL_UNITS[unit] for value, unit in
+                  re.findall(r"(\d+)([smhdw])", token.lower()))
+    else:
+        error("invalid TTL {}".format(token))
+    if ttl >= 2 ** 31:
+        error("TTL {} out of range".format(token))
+    return ttl
+
+
+def parse_master_file(file, origin=None, filename="<master file>"):
+    """Parse a master file
+
+    Handles comments, parentheses, quoted strings, $ORIGIN, $TTL and
+    $INCLUDE, @, relative names, blank owner names and optional TTL and class
+    fields in either order. A, NS, CNAME and SOA records get their own
+    RecordData, MX, PTR, TXT and AAAA records and records in the generic
+    format of RFC 3597 (\\# length hex) get GenericRecordData in wire format.
+
+    Args:
+        file (file): the open master file
+        origin (str): origin for relative names until $ORIGIN
+        filename (str): filename used in errors and for $INCLUDE
+
+    Yields:
+        ResourceRecord: the records in the order of the file
+
+    Raises:
+        MasterFileError: if the file contains an error
+    """
+    lineno = 0
+    owner = None
+    default_ttl = None
+    last_ttl = None
+    last_class = Class.IN
+
+    def error(message):
+        raise MasterFileError(message, filename, lineno)
+
+    def absolute(name):
+        if "\\" in name:
+            error("escaped characters in names are not supported")
+        if name == "@":
+            if origin is None:
+                error("@ used without origin")
+            return origin
+        if name.endswith("."):
+            return name
+        if origin is None:
+            error("relative name {} without origin".format(name))
+        return name + "." + origin if origin != "." else name + "."
+
+    tokens = []
+    depth = 0
+    blank = False
+    for number, line in enumerate(file, 1):
+        if depth == 0:
+            lineno = number
+            blank = line[:1] in (" ", "\t")
+            tokens = []
+        if SPECIAL.search(line):
+            depth = split_special(line, tokens, depth, error)
+        else:
+            tokens.extend(line.split())
+        if depth or not tokens:
+            continue
+
+        if tokens[0].startswith("$") and not blank:
+            directive = tokens[0].upper()
+            if directive == "$ORIGIN" and len(tokens) == 2:
+                origin = absolute(tokens[1])
+            elif directive == "$TTL" and len(tokens) == 2:
+                default_ttl = parse_ttl(tokens[1], error)
+            elif directive == "$INCLUDE" and len(tokens) in (2, 3):
+                include = os.path.join(os.path.dirname(filename), tokens[1])
+                include_origin = absolute(tokens[2]) if len(tokens) == 3 \
+                    else origin
+                with open(include) as included:
+                    yield from parse_master_file(included, include_origin,
+                                                 include)
+            else:
+                error("invalid directive {}".format(" ".join(tokens)))
+            continue
+
+        if blank:
+            if owner is None:
+                error("no owner name")
+        else:
+            owner = absolute(tokens[0])
+            tokens = tokens[1:]
+
+        ttl = None
+        class_ = None
+        i = 0
+        while i < len(tokens) and i < 2:
+            if tokens[i][0].isdigit() and ttl is None:
+                ttl = parse_ttl(tokens[i], error)
+            elif tokens[i].upper() in CLASSES and class_ is None:
+                class_ = Class[tokens[i].upper()]
+            else:
+                break
+            i += 1
+        if i == len(tokens):
+            error("no type")
+        try:
+            type_ = Type[tokens[i].upper()]
+        except KeyError:
+            error("unknown type {}".format(tokens[i]))
+        rdata = parse_rdata(type_, tokens[i + 1:], absolute, error)
+
+        if ttl is not None:
+            last_ttl = ttl
+        elif default_ttl is not None:
+            ttl = default_ttl
+        elif last_ttl is not None:
+            ttl = last_ttl
+        else:
+            error("no TTL")
+        if class_ is not None:
+            last_class = class_
+        yield ResourceRecord(Name(owner), type_, last_class, ttl, rdata)
+
+    if depth:
+        error("unbalanced parentheses")
+
+
+def parse_rdata(type_, tokens, absolute, error):
+    """Parse the RDATA fields of a record
+
+    Args:
+        type_ (Type): type of the record
+        tokens ([str]): the RDATA fields
+        absolute (function): makes a name absolute
+        error (function): raises a MasterFileError for a message
+
+    Returns:
+        RecordData: the record data
+    """
+    if tokens[:1] == ["\\#"]:
+        if len(tokens) < 2 or not tokens[1].isdigit():
+            error("invalid generic RDATA")
+        try:
+            data = bytes.fromhex("".join(tokens[2:]))
+        except ValueError:
+            error("invalid generic RDATA")
+        if len(data) != int(tokens[1]):
+            error("generic RDATA length mismatch")
+        return GenericRecordData(data)
+
+    counts = {Type.A: 1, Type.NS: 1, Type.CNAME: 1, Type.PTR: 1, Type.MX: 2,
+              Type.AAAA: 1, Type.SOA: 7}
+    if type_ in counts and len(tokens) != counts[type_]:
+        error("{} record needs {} RDATA fields".format(type_, counts[type_]))
+    try:
+        if type_ == Type.A:
+            socket.inet_pton(socket.AF_INET, tokens[0])
+            return ARecordData(tokens[0])
+        if type_ == Type.AAAA:
+            return GenericRecordData(
+                socket.inet_pton(socket.AF_INET6, tokens[0]))
+    except OSError:
+        error("invalid address {}".format(tokens[0]))
+    if type_ == Type.NS:
+        return NSRecordData(Name(absolute(tokens[0])))
+    if type_ == Type.CNAME:
+        return CNAMERecordData(Name(absolute(tokens[0])))
+    if type_ == Type.PTR:
+        return GenericRecordData(Name(absolute(tokens[0])).to_bytes(0))
+    if type_ == Type.MX:
+        if not tokens[0].isdigit() or int(tokens[0]) > 0xffff:
+            error("invalid MX preference {}".format(tokens[0]))
+        return GenericRecordData(struct.pack("!H", int(tokens[0])) +
+                                 Name(absolute(tokens[1])).to_bytes(0))
+    if type_ == Type.SOA:
+        if not tokens[2].isdigit() or int(tokens[2]) >= 2 ** 32:
+            error("invalid serial {}".format(tokens[2]))
+        return SOARecordData(Name(absolute(tokens[0])),
+                             Name(absolute(tokens[1])), int(tokens[2]),
+                             *[parse_ttl(token, error) for token in tokens[3:]])
+    if type_ == Type.TXT:
+        if not tokens:
+            error("TXT record needs RDATA")
+        data = b""
+        for token in tokens:
+            if token.startswith('"'):
+                token = token[1:-1]
+            string = unescape(token, error)
+            if len(string) > 255:
+                error("character string longer than 255 bytes")
+            data += bytes([len(string)]) + string
+        return GenericRecordData(data)
+    error("records of type {} are not supported".format(type_))
@@ -3,7 +3,8 @@
 """DNS messages.
 
 This module contains classes for DNS messages, their header section and
-question fields. See section 4 of RFC 1035 for more info.
+question fields. See section 4 of RFC 1035 for more info, and RFC 6891 for
+the OPT record of EDNS.
 """
 
 
@@ -11,10 +12,31 @@ import struct
 
 from dns.classes import Class
 from dns.name import Name
-from dns.resource import ResourceRecord
+from dns.resource import ResourceRecord, OPTRecordData
 from dns.types import Type
 
 
+# Maximum size of a UDP message without EDNS, see section 4.2.1 of RFC 1035
+UDP_PAYLOAD_SIZE = 512
+
+
+def opt_record(payload_size, rcode=0, version=0):
+    """Create the OPT record of a message, see RFC 6891
+
+    Args:
+        payload_size (int): UDP payload size the sender can receive
+        rcode (int): the full RCODE of a response, its upper 8 bits are
+            stored in the OPT record
+        version (int): the EDNS version
+
+    Returns:
+        ResourceRecord: the OPT record
+    """
+    return ResourceRecord(Name("."), Type.OPT, payload_size,
+                          (rcode >> 4) << 24 | version << 16,
+                          OPTRecordData([]))
+
+
 class Message:
     """DNS message."""
 
@@ -49,6 +71,31 @@ class Message:
         """Getter for all resource records."""
         return self.answers + self.authorities + self.additionals
 
+    @property
+    def opt(self):
+        """The OPT record in the additional section, or None."""
+        for additional in self.additionals:
+            if additional.type_ == Type.OPT:
+                return additional
+        return None
+
+    @property
+    def payload_size(self):
+        """The UDP payload size the sender can receive.
+
+        This is the size in the OPT record, but at least 512 bytes.
+        """
+        opt = self.opt
+        if opt is None:
+            return UDP_PAYLOAD_SIZE
+        return max(opt.class_, UDP_PAYLOAD_SIZE)
+
+    @property
+    def edns_version(self):
+        """The EDNS version of the OPT record, or None without one."""
+        opt = self.opt
+        return None if opt is None else (opt.ttl >> 16) & 0xff
+
     def to_bytes(self):
         """Convert Message to bytes."""
         compress = {}
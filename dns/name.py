@@ -36,27 +36,21 @@ class Name:
     def to_bytes(self, offset, compress=None):
         """Convert Name to bytes."""
         result = b""
-        add_null = True
-        if self.labels == [""]:
+        labels = self.labels
+        if labels == [""]:
             return b"\x00"
-        for i, label in enumerate(self.labels):
-            name = ".".join(self.labels[i:]).lower()
-            if compress is not None and name in compress:
-                pointer = compress[name]
-                result += struct.pack("!H", (3 << 14) + pointer)
-                add_null = False
-                break
-            else:
-                if compress is not None:
+        for i, label in enumerate(labels):
+            if compress is not None:
+                name = ".".join(labels[i:]).lower()
+                pointer = compress.get(name)
+                if pointer is not None:
+                    return result + struct.pack("!H", (3 << 14) + pointer)
+                if offset < 1 << 14:
                     compress[name] = offset
-                blabel = label.encode("utf-8")
-                result += struct.pack("!B{}s".format(len(blabel)),
-                                      len(blabel), blabel)
-                offset += 1 + len(blabel)
-        if add_null:
-            result += b"\x00"
-
-        return result
+            blabel = label.encode("utf-8")
+            result += bytes([len(blabel)]) + blabel
+            offset += 1 + len(blabel)
+        return result + b"\x00"
 
     @classmethod
     def from_bytes(cls, packet, offset):
@@ -8,40 +8,134 @@ DNS server, but with a different list of servers.
 """
 
 
+import asyncio
+import os
+import random
+import selectors
 import socket
+import struct
+import threading
+import time
 
 from dns.classes import Class
-from dns.message import Message, Question, Header
+from dns.message import Message, Question, Header, opt_record
 from dns.name import Name
+from dns.rcodes import RCode
 from dns.types import Type
-from dns.cache import RecordCache
+from dns.cache import RecordCache, cache_key
 
 
-class Resolver:
-    """DNS resolver"""
+# Seconds an idle TCP connection to a server is kept for the next request
+TCP_IDLE_TIMEOUT = 5
+# UDP payload size advertised to servers in the OPT record, see RFC 6891
+EDNS_PAYLOAD_SIZE = 1232
+# Number of UDP sockets all upstream requests are sent from
+UPSTREAM_SOCKETS = 4
+# Number of requests sent from an upstream socket before it is replaced by
+# one with a new source port
+SOCKET_REQUESTS = 10000
+# Seconds the receiver thread of UpstreamSockets waits for a response before
+# it checks which sockets to replace
+SELECT_TIMEOUT = 0.5
+
+# Query IDs and sockets are chosen with the random number generator of the
+# operating system, so they cannot be predicted by spoofers
+ids = random.SystemRandom()
+
 
-    def __init__(self, timeout, caching, ttl, rootip="198.41.0.4"):
+class Flight:
+    """A resolution in progress, shared by identical requests"""
+
+    def __init__(self, done):
+        """Initialize the flight
+
+        Args:
+            done (threading.Event or asyncio.Future): set when the result
+                (or error) of the resolution is known
+        """
+        self.done = done
+        self.queries = 0
+        self.result = None
+        self.error = None
+
+
+class Resolver:
+    """DNS resolver
+
+    Identical requests which arrive while a resolution for the same name is
+    in progress do not start their own, they wait for that resolution and
+    share its result (single-flight).
+
+    Requests are sent over UDP with an OPT record (EDNS, RFC 6891) which
+    advertises the payload size the resolver receives, so servers can send
+    large referrals in one datagram. A server which answers FORMERR without
+    an OPT record does not know EDNS and gets the request again without it.
+    A response with the TC flag set did not fit in a datagram, the request
+    is then sent again over TCP. One idle TCP connection per server is kept
+    for TCP_IDLE_TIMEOUT seconds and reused.
+
+    All UDP requests, of all threads and event loops, are sent from the
+    sockets of one UpstreamSockets pool with random IDs.
+    """
+
+    def __init__(self, timeout, caching, ttl, rootip="198.41.0.4", cache=None,
+                 edns_size=EDNS_PAYLOAD_SIZE):
         """Initialize the resolver
 
         Args:
             caching (bool): caching is enabled if True
             ttl (int): ttl of cache entries (if > 0)
+            cache (RecordCache): cache to use instead of reading a new one
+                from the cache file
+            edns_size (int): UDP payload size advertised to servers, 0 sends
+                requests without EDNS
         """
         self.timeout = timeout
+        self.edns_size = edns_size
         self.caching = caching
         self.ttl = ttl
         self.doLogging = False
         self.rootip = rootip
         self.rd = 0
+        self.flights = {}
+        self.async_flights = {}
+        self.connections = {}
+        self.async_connections = {}
+        self.sockets = UpstreamSockets(receive_size=self.receive_size)
+        self.lock = threading.Lock()
+        self.upstream = 0
+        self.coalesced = 0
+        self.saved = 0
 
         if self.caching:
-            self.cache = RecordCache(ttl)
-            self.cache.read_cache_file()
+            if cache is None:
+                cache = RecordCache(ttl)
+                cache.read_cache_file()
+            self.cache = cache
 
     def log(self, *args, end="\n"):
         if self.doLogging:
             print(*args, end=end)
 
+    def stats(self):
+        """Counters of upstream queries
+
+        Returns:
+            dict: queries sent upstream, requests which shared the result of
+                a resolution in progress and the upstream queries this saved
+        """
+        return {"upstream": self.upstream, "coalesced": self.coalesced,
+                "saved": self.saved}
+
+    def close(self):
+        """Close the upstream sockets and idle TCP connections"""
+        self.sockets.close()
+        with self.lock:
+            connections = list(self.connections.values())
+            self.connections.clear()
+        for sock, _ in connections:
+            sock.close()
+
     def logHeader(self, header):
         self.log("\tFLAGS", end="")
         self.log(" QR", header.qr, end=";")
@@ -74,24 +168,39 @@ class Resolver:
                 return False, iplist, namelist
         return False, [], []
 
-    def send_request(self, ip, name):
-
-        #create socket and request
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.settimeout(self.timeout)
+    def build_query(self, name, edns=True):
+        """Build the query message for name
 
+        Args:
+            name (Name): the name asked for
+            edns (bool): add an OPT record, if edns_size > 0
+        """
         question = Question(name, Type.A, Class.IN)
-        header = Header(9001, 0, 1, 0, 0, 0)
+        header = Header(ids.getrandbits(16), 0, 1, 0, 0, 0)
         header.qr = 0
         header.opcode = 0
         header.rd = self.rd
-        query = Message(header, [question])
+        additionals = []
+        if edns and self.edns_size > 0:
+            additionals.append(opt_record(self.edns_size))
+            header.ar_count = 1
+        return Message(header, [question], additionals=additionals)
+
+    @property
+    def receive_size(self):
+        """Size of the receive buffer for UDP responses"""
+        return max(self.edns_size, 512)
+
+    def handle_response(self, data):
+        """Parse a response and add its records to the cache
 
-        sock.sendto(query.to_bytes(), (ip, 53))
+        Args:
+            data (bytes): the response datagram
 
-        # Receive response
-        data = sock.recv(512)
-        sock.close()
+        Returns:
+            ([ResourceRecord], [ResourceRecord], [ResourceRecord]):
+                (answers, authorities, additionals)
+        """
         response = Message.from_bytes(data)
         self.logHeader(response.header)
         if self.caching:
@@ -101,10 +210,125 @@ class Resolver:
 
         return response.answers, response.authorities, response.additionals
 
-    def resolve_request(self, ip, hostname):
-        self.log("\nRESOLVING REQUEST", hostname, "at:", ip)
-        answers, authorities, additionals = self.send_request(ip, hostname)
+    def send_request(self, ip, name):
+        query = self.build_query(name).to_bytes()
+        data = self.send_udp(ip, query)
+        if self.edns_size > 0 and rejects_edns(data):
+            self.log("\tEDNS REJECTED, RETRYING WITHOUT")
+            query = self.build_query(name, edns=False).to_bytes()
+            data = self.send_udp(ip, query)
+        if truncated(data):
+            self.log("\tTRUNCATED, RETRYING OVER TCP")
+            data = self.send_tcp(ip, query)
+        return self.handle_response(data)
+
+    def send_udp(self, ip, query):
+        """Send a query over UDP and receive the response datagram
+
+        See UpstreamSockets.query.
+        """
+        return self.sockets.query((ip, 53), query, self.timeout)
+
+    def send_tcp(self, ip, query):
+        """Send a query over TCP, see section 4.2.2 of RFC 1035
 
+        An idle connection to the server is reused, if the server closed it
+        in the meantime a new connection is made. The connection is kept
+        for the next query afterwards.
+
+        Args:
+            ip (str): address of the server
+            query (bytes): the query
+
+        Returns:
+            bytes: the response
+        """
+        while True:
+            with self.lock:
+                sock, idle = self.connections.pop(ip, (None, 0))
+            reused = sock is not None
+            if reused and time.monotonic() - idle > TCP_IDLE_TIMEOUT:
+                sock.close()
+                continue
+            if not reused:
+                sock = socket.create_connection((ip, 53), self.timeout)
+            try:
+                sock.sendall(struct.pack("!H", len(query)) + query)
+                length = struct.unpack("!H", receive(sock, 2))[0]
+                data = receive(sock, length)
+                if data[:2] != query[:2]:
+                    raise ConnectionError("response to another query")
+            except OSError:
+                sock.close()
+                if reused:
+                    continue
+                raise
+            with self.lock:
+                old = self.connections.get(ip)
+                self.connections[ip] = (sock, time.monotonic())
+            if old is not None:
+                old[0].close()
+            return data
+
+    async def send_request_async(self, ip, name):
+        """Send a request without blocking the event loop
+
+        Same as send_request, but the response is awaited on the running
+        asyncio event loop.
+        """
+        query = self.build_query(name).to_bytes()
+        data = await self.send_udp_async(ip, query)
+        if self.edns_size > 0 and rejects_edns(data):
+            self.log("\tEDNS REJECTED, RETRYING WITHOUT")
+            query = self.build_query(name, edns=False).to_bytes()
+            data = await self.send_udp_async(ip, query)
+        if truncated(data):
+            self.log("\tTRUNCATED, RETRYING OVER TCP")
+            data = await self.send_tcp_async(ip, query)
+        return self.handle_response(data)
+
+    async def send_udp_async(self, ip, query):
+        """Send a query over UDP on an asyncio event loop, see send_udp"""
+        return await self.sockets.query_async((ip, 53), query, self.timeout)
+
+    async def send_tcp_async(self, ip, query):
+        """Send a query over TCP on an asyncio event loop, see send_tcp"""
+        loop = asyncio.get_running_loop()
+        while True:
+            reader, writer, idle, connection_loop = \
+                self.async_connections.pop(ip, (None, None, 0, None))
+            reused = writer is not None
+            if reused and (connection_loop is not loop or
+                           time.monotonic() - idle > TCP_IDLE_TIMEOUT):
+                if connection_loop is loop:
+                    writer.close()
+                continue
+            if not reused:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(ip, 53), self.timeout)
+            try:
+                writer.write(struct.pack("!H", len(query)) + query)
+                length = await receive_async(reader, 2, self.timeout)
+                data = await receive_async(
+                    reader, struct.unpack("!H", length)[0], self.timeout)
+                if data[:2] != query[:2]:
+                    raise ConnectionError("response to another query")
+            except OSError:
+                writer.close()
+                if reused:
+                    continue
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            old = self.async_connections.get(ip)
+            self.async_connections[ip] = (reader, writer, time.monotonic(),
+                                          loop)
+            if old is not None and old[3] is loop:
+                old[1].close()
+            return data
+
+    def read_response(self, hostname, answers, authorities, additionals):
         namelist = []
         ipaddrlist = []
         if len(answers) != 0:
@@ -135,11 +359,14 @@ class Resolver:
 
             return False, ipaddrlist, namelist
 
-    def gethostbyname(self, hostname):
-        """Translate a host name to IPv4 address.
+    def iterate(self, hostname):
+        """Resolve a host name, without doing any network I/O itself
 
-        Currently this method contains an example. You will have to replace
-        this example with the algorithm described in section 5.3.3 in RFC 1034.
+        This generator contains the resolution algorithm. Every request it
+        needs answered is yielded as an (ip, Name) pair, the caller sends
+        back the (answers, authorities, additionals) of the response. This
+        way the same algorithm is used by gethostbyname and
+        gethostbyname_async.
 
         Args:
             hostname (str): the hostname to resolve
@@ -161,7 +388,9 @@ class Resolver:
                     serveriplist = iplist
 
         while len(serveriplist) != 0:
-            res, iplist, namelist = self.resolve_request(serveriplist[0], Name(hostname))
+            self.log("\nRESOLVING REQUEST", hostname, "at:", serveriplist[0])
+            response = yield serveriplist[0], Name(hostname)
+            res, iplist, namelist = self.read_response(hostname, *response)
             if res:
                 self.log("END OF QUERY:", hostname)
                 if self.caching:
@@ -170,7 +399,7 @@ class Resolver:
             elif len(iplist) == 0 and not len(namelist) == 0:
                 newlist = []
                 for x in namelist:
-                    newhostname, newaliases, newips= self.gethostbyname(str(x))
+                    newhostname, newaliases, newips = yield from self.iterate(str(x))
                     newlist.extend(newips)
                 newlist.extend(serveriplist)
                 serveriplist = newlist
@@ -179,4 +408,395 @@ class Resolver:
                 serveriplist = iplist
         self.log("FAILURE")
         return hostname, [], []
-        return hostname, [], []
+
+    def gethostbyname(self, hostname):
+        """Translate a host name to IPv4 address.
+
+        Currently this method contains an example. You will have to replace
+        this example with the algorithm described in section 5.3.3 in RFC 1034.
+
+        Args:
+            hostname (str): the hostname to resolve
+
+        Returns:
+            (str, [str], [str]): (hostname, aliaslist, ipaddrlist)
+        """
+        key = cache_key(hostname, Type.A, Class.IN)
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight(threading.Event())
+        if not leader:
+            flight.done.wait()
+            return self.share(hostname, flight)
+
+        try:
+            steps = self.iterate(hostname)
+            try:
+                request = next(steps)
+                while True:
+                    flight.queries += 1
+                    request = steps.send(self.send_request(*request))
+            except StopIteration as stop:
+                flight.result = stop.value
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+                self.upstream += flight.queries
+            flight.done.set()
+        return flight.result
+
+    async def gethostbyname_async(self, hostname):
+        """Translate a host name to IPv4 address on an asyncio event loop.
+
+        Args:
+            hostname (str): the hostname to resolve
+
+        Returns:
+            (str, [str], [str]): (hostname, aliaslist, ipaddrlist)
+        """
+        key = cache_key(hostname, Type.A, Class.IN)
+        flight = self.async_flights.get(key)
+        if flight is not None:
+            await asyncio.shield(flight.done)
+            return self.share(hostname, flight)
+        flight = Flight(asyncio.get_running_loop().create_future())
+        self.async_flights[key] = flight
+
+        try:
+            steps = self.iterate(hostname)
+            try:
+                request = next(steps)
+                while True:
+                    flight.queries += 1
+                    request = steps.send(
+                        await self.send_request_async(*request))
+            except StopIteration as stop:
+                flight.result = stop.value
+        except BaseException as error:
+            flight.error = error
+            raise
+        finally:
+            del self.async_flights[key]
+            with self.lock:
+                self.upstream += flight.queries
+            flight.done.set_result(None)
+        return flight.result
+
+    def share(self, hostname, flight):
+        """Result of a finished flight for a request which waited for it"""
+        with self.lock:
+            self.coalesced += 1
+            self.saved += flight.queries
+        if flight.error is not None:
+            raise flight.error
+        return (hostname,) + flight.result[1:]
+
+
+def truncated(data):
+    """Whether the TC flag of a response is set"""
+    return len(data) > 2 and data[2] & 0x02
+
+
+def rejects_edns(data):
+    """Whether a response is a FORMERR without OPT record, see RFC 6891 7"""
+    return (len(data) >= 12 and data[3] & 0xf == RCode.FormErr and
+            data[10:12] == b"\x00\x00")
+
+
+def receive(sock, length):
+    """Read length bytes from a TCP connection
+
+    Raises:
+        OSError: if the connection is closed first
+    """
+    data = b""
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise ConnectionError("connection closed by server")
+        data += chunk
+    return data
+
+
+async def receive_async(reader, length, timeout):
+    """Read length bytes from a TCP connection on an asyncio event loop
+
+    Raises:
+        OSError: if the connection is closed first
+        asyncio.TimeoutError: if the bytes do not arrive within timeout
+    """
+    try:
+        return await asyncio.wait_for(reader.readexactly(length), timeout)
+    except asyncio.IncompleteReadError:
+        raise ConnectionError("connection closed by server") from None
+
+
+def question_key(data):
+    """The question of a message, with the name lowercased, or None
+
+    Args:
+        data (bytes): the message, with one question and an uncompressed
+            name
+    """
+    if len(data) < 12 or data[4:6] != b"\x00\x01":
+        return None
+    end = 12
+    while end < len(data) and 0 < data[end] < 64:
+        end += data[end] + 1
+    if end + 5 > len(data) or data[end]:
+        return None
+    return data[12:end + 1].lower() + data[end + 1:end + 5]
+
+
+class UpstreamSockets:
+    """A pool of UDP sockets shared by all requests to upstream servers
+
+    Instead of a socket per request, every request is sent from one of a
+    few long-lived non-blocking sockets, chosen at random, with a random
+    ID that is not in use on that socket for that server. One receiver
+    thread waits for the responses on all sockets with a selector and
+    hands every response to the request it answers: the request sent from
+    the socket it arrived on, to the address and port it came from, with
+    its ID and question (so responses from other servers, or to other or
+    timed out requests, are dropped). A response without a question
+    section, like a FORMERR of a server which does not support EDNS, is
+    matched on the ID alone. Any number of outstanding requests,
+    of threads as well as asyncio event loops, share the sockets.
+
+    A socket is replaced by a new one, with a new source port chosen by the
+    operating system, after max_requests requests; it is closed once the
+    requests sent from it are answered or timed out. The sockets and the
+    thread are made on first use, and again in a forked worker process.
+    """
+
+    def __init__(self, size=UPSTREAM_SOCKETS, max_requests=SOCKET_REQUESTS,
+                 receive_size=65535):
+        """Initialize the pool
+
+        Args:
+            size (int): number of sockets
+            max_requests (int): requests sent from a socket before it is
+                replaced
+            receive_size (int): size of the receive buffer for responses
+        """
+        self.size = size
+        self.max_requests = max_requests
+        self.receive_size = receive_size
+        self.lock = threading.Lock()
+        self.pid = None
+        self.thread = None
+        self.unmatched = 0
+
+    def start(self):
+        """Open the sockets and start the receiver thread"""
+        self.pid = os.getpid()
+        self.selector = selectors.DefaultSelector()
+        self.sent = {}
+        self.outstanding = {}
+        self.pending = {}
+        self.retired = []
+        self.sockets = [self.open_socket() for _ in range(self.size)]
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def open_socket(self):
+        """Open a socket and register it with the selector"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        sock.bind(("", 0))
+        self.selector.register(sock, selectors.EVENT_READ)
+        self.sent[sock] = 0
+        self.outstanding[sock] = 0
+        return sock
+
+    def stats(self):
+        """Counters of the pool
+
+        Returns:
+            dict: sockets (including replaced sockets not yet closed),
+                requests waiting for a response and responses dropped
+        """
+        with self.lock:
+            return {"sockets": len(self.sent), "pending": len(self.pending),
+                    "unmatched": self.unmatched}
+
+    def send(self, address, query, callback):
+        """Send a request from a random socket with a random ID
+
+        Args:
+            address ((str, int)): address and port of the server
+            query (bytes): the request, its ID is replaced
+            callback (function): called with the response on the receiver
+                thread, or with None if the pool is closed first
+
+        Returns:
+            tuple: the key of the request, see cancel
+        """
+        question = question_key(query)
+        with self.lock:
+            if self.pid != os.getpid():
+                self.start()
+            sock = ids.choice(self.sockets)
+            while True:
+                ident = ids.getrandbits(16)
+                key = (sock, address[0], address[1], ident)
+                if key not in self.pending:
+                    break
+            self.pending[key] = (question, callback)
+            self.sent[sock] += 1
+            self.outstanding[sock] += 1
+        try:
+            sock.sendto(struct.pack("!H", ident) + query[2:], address)
+        except OSError:
+            self.cancel(key)
+            raise
+        return key
+
+    def cancel(self, key):
+        """Stop waiting for the response to a request
+
+        Returns:
+            bool: False if the response was received first
+        """
+        with self.lock:
+            if self.pending.pop(key, None) is None:
+                return False
+            self.outstanding[key[0]] -= 1
+            return True
+
+    def query(self, address, query, timeout):
+        """Send a request and wait for the response
+
+        Args:
+            address ((str, int)): address and port of the server
+            query (bytes): the request
+            timeout (float): seconds to wait for the response
+
+        Returns:
+            bytes: the response
+
+        Raises:
+            socket.timeout: if there is no response within timeout
+            ConnectionError: if the pool is closed first
+        """
+        done = threading.Event()
+        responses = []
+
+        def callback(data):
+            responses.append(data)
+            done.set()
+
+        key = self.send(address, query, callback)
+        if not done.wait(timeout) and self.cancel(key):
+            raise socket.timeout("timed out")
+        done.wait()
+        if responses[0] is None:
+            raise ConnectionError("upstream sockets closed")
+        return responses[0]
+
+    async def query_async(self, address, query, timeout):
+        """Send a request and await the response, see query"""
+        loop = asyncio.get_running_loop()
+        response = loop.create_future()
+
+        def set_result(data):
+            if not response.done():
+                response.set_result(data)
+
+        def callback(data):
+            loop.call_soon_threadsafe(set_result, data)
+
+        key = self.send(address, query, callback)
+        try:
+            data = await asyncio.wait_for(response, timeout)
+        finally:
+            self.cancel(key)
+        if data is None:
+            raise ConnectionError("upstream sockets closed")
+        return data
+
+    def receive(self, sock):
+        """Hand the responses waiting on a socket to their requests"""
+        while True:
+            try:
+                data, address = sock.recvfrom(self.receive_size)
+            except OSError:
+                return
+            if len(data) < 12:
+                continue
+            key = (sock, address[0], address[1],
+                   struct.unpack_from("!H", data)[0])
+            questions = data[4:6] != b"\x00\x00"
+            with self.lock:
+                entry = self.pending.get(key)
+                if entry is None or (questions and
+                                     question_key(data) != entry[0]):
+                    self.unmatched += 1
+                    continue
+                callback = self.pending.pop(key)[1]
+                self.outstanding[sock] -= 1
+            try:
+                callback(data)
+            except RuntimeError:
+                pass
+
+    def replace_sockets(self):
+        """Replace the sockets which sent max_requests requests, and close
+        the replaced sockets without outstanding requests"""
+        with self.lock:
+            if self.thread is not threading.current_thread():
+                return
+            for i, sock in enumerate(self.sockets):
+                if self.sent[sock] >= self.max_requests:
+                    self.sockets[i] = self.open_socket()
+                    self.retired.append(sock)
+            for sock in [sock for sock in self.retired
+                         if not self.outstanding[sock]]:
+                self.retired.remove(sock)
+                self.selector.unregister(sock)
+                sock.close()
+                del self.sent[sock], self.outstanding[sock]
+
+    def run(self):
+        """Run the receiver thread, until close or a restart"""
+        thread = threading.current_thread()
+        selector = self.selector
+        while self.thread is thread:
+            try:
+                events = selector.select(SELECT_TIMEOUT)
+            except (OSError, ValueError):
+                return
+            for key, _ in events:
+                self.receive(key.fileobj)
+            self.replace_sockets()
+
+    def close(self):
+        """Stop the receiver thread and close the sockets
+
+        Requests waiting for a response fail with ConnectionError. The pool
+        is opened again by the next request.
+        """
+        with self.lock:
+            if self.pid is None:
+                return
+            callbacks = [callback for _, callback in self.pending.values()]
+            for sock in self.sent:
+                sock.close()
+            self.selector.close()
+            self.pid = None
+            self.thread = None
+            self.sockets = []
+            self.retired = []
+            self.sent = {}
+            self.outstanding = {}
+            self.pending = {}
+        for callback in callbacks:
+            try:
+                callback(None)
+            except RuntimeError:
+                pass
@@ -44,10 +44,16 @@ class ResourceRecord(object):
 
     @classmethod
     def from_bytes(cls, packet, offset):
-        """Convert ResourceRecord from bytes."""
+        """Convert ResourceRecord from bytes.
+
+        The CLASS of an OPT record is the UDP payload size (see RFC 6891),
+        it is kept as an int.
+        """
         name, offset = Name.from_bytes(packet, offset)
         type_ = Type(struct.unpack_from("!H", packet, offset)[0])
-        class_ = Class(struct.unpack_from("!H", packet, offset + 2)[0])
+        class_ = struct.unpack_from("!H", packet, offset + 2)[0]
+        if type_ != Type.OPT:
+            class_ = Class(class_)
         ttl, rdlength = struct.unpack_from("!iH", packet, offset + 4)
         offset += 10
         rdata = RecordData.create_from_bytes(type_, packet, offset, rdlength)
@@ -83,12 +89,18 @@ class RecordData:
             packet (bytes): packet.
             offset (int): offset in packet.
             rdlength (int): length of rdata.
+
+        Empty rdata (as in the prerequisites and deletions of an UPDATE
+        message, see RFC 2136) is GenericRecordData, except for OPT.
         """
+        if rdlength == 0 and type_ != Type.OPT:
+            return GenericRecordData(b"")
         classdict = {
             Type.A: ARecordData,
             Type.CNAME: CNAMERecordData,
             Type.NS: NSRecordData,
-            Type.SOA: SOARecordData
+            Type.SOA: SOARecordData,
+            Type.OPT: OPTRecordData
         }
         if type_ in classdict:
             return classdict[type_].from_bytes(packet, offset, rdlength)
@@ -102,7 +114,8 @@ class RecordData:
             Type.A: ARecordData,
             Type.CNAME: CNAMERecordData,
             Type.NS: NSRecordData,
-            Type.SOA: SOARecordData
+            Type.SOA: SOARecordData,
+            Type.OPT: OPTRecordData
         }
         if type_ in classdict:
             return classdict[type_].from_dict(dct)
@@ -273,12 +286,13 @@ class SOARecordData(RecordData):
             compress (dict): dict from domain names to pointers.
         """
         data = self.mname.to_bytes(offset, compress)
-        data += self.rname.to_bytes(len(data), compress)
+        data += self.rname.to_bytes(offset + len(data), compress)
         data += struct.pack("!I", self.serial)
         data += struct.pack("!i", self.refresh)
         data += struct.pack("!i", self.retry)
         data += struct.pack("!i", self.expire)
         data += struct.pack("!I", self.minimum)
+        return data
 
     @classmethod
     def from_bytes(cls, packet, offset, rdlength):
@@ -296,7 +310,7 @@ class SOARecordData(RecordData):
         retry = struct.unpack_from("!i", packet, offset + 8)[0]
         expire = struct.unpack_from("!i", packet, offset + 12)[0]
         minimum = struct.unpack_from("!I", packet, offset + 16)[0]
-        return cls(mname, rname, serial, refresh, retry, expire, minimum), offset + 20
+        return cls(mname, rname, serial, refresh, retry, expire, minimum)
 
     def to_dict(self):
         """Convert to dict."""
@@ -309,7 +323,60 @@ class SOARecordData(RecordData):
     def from_dict(cls, dct):
         """Create a RecordData object from dict."""
         return cls(Name(dct["mname"]), Name(dct["rname"]), dct["serial"],
-                   dt["refresh"], dct["retry"], dct["expire"], dct["minimum"])
+                   dct["refresh"], dct["retry"], dct["expire"], dct["minimum"])
+
+
+class OPTRecordData(RecordData):
+    """Record data for OPT type.
+
+    See RFC 6891 6.1.2.
+    """
+
+    def __init__(self, options):
+        """Create RecordData for OPT type.
+
+        Args:
+            options ([(int, bytes)]): option codes and their data.
+        """
+        self.options = options
+
+    def to_bytes(self, offset, compress):
+        """Convert to bytes.
+
+        Args:
+            offset (int): offset in packet.
+            compress (dict): dict from domain names to pointers.
+        """
+        return b"".join(struct.pack("!HH", code, len(data)) + data
+                        for code, data in self.options)
+
+    @classmethod
+    def from_bytes(cls, packet, offset, rdlength):
+        """Create a RecordData object from bytes.
+
+        Args:
+            packet (bytes): packet.
+            offset (int): offset in message.
+            rdlength (int): length of rdata.
+        """
+        options = []
+        end = offset + rdlength
+        while offset + 4 <= end:
+            code, length = struct.unpack_from("!HH", packet, offset)
+            options.append((code, packet[offset + 4:offset + 4 + length]))
+            offset += 4 + length
+        return cls(options)
+
+    def to_dict(self):
+        """Convert to dict."""
+        return {"options" : [[code, data.hex()]
+                             for code, data in self.options]}
+
+    @classmethod
+    def from_dict(cls, dct):
+        """Create a RecordData object from dict."""
+        return cls([(code, bytes.fromhex(data))
+                    for code, data in dct["options"]])
 
 
 class GenericRecordData(RecordData):
@@ -7,107 +7,708 @@ server using the algorithm described in section 4.3.2 of RFC 1034.
 """
 
 
-from threading import Thread
-from dns.zone import Zone
+import asyncio
+import gc
+import ipaddress
+import os
+import signal
+import sys
+import time
+import traceback
+from queue import Queue, Full
+from threading import (Thread, Event, Lock, Condition, current_thread,
+                       main_thread)
+from dns.zone import (MappedZone, load_catalog, zone_filenames,
+                      record_changes, transfer_records)
+from dns.update import OPCODE_UPDATE, UpdateError, update_zone
 from dns.name import Name
-from dns.message import Message, Header
-from dns.cache import RecordCache
+from dns.message import Message, Header, opt_record, UDP_PAYLOAD_SIZE
+from dns.cache import (RecordCache, SharedRecordCache, PacketCache,
+                       cache_key)
 from dns.resource import ResourceRecord, ARecordData, CNAMERecordData
 from dns.types import Type
 from dns.name import Name
 from dns.classes import Class
 from dns.resolver import Resolver
+from dns.rcodes import RCode
 import socket
 import struct
 
+
+# Maximum size of the messages of a zone transfer, see transfer_messages
+TRANSFER_MESSAGE_SIZE = 16384
+# Seconds a TCP connection may be idle before the server closes it
+TCP_IDLE_TIMEOUT = 10
+# Maximum number of requests on a TCP connection answered at the same time
+TCP_PIPELINE = 16
+# UDP payload size the server advertises in its OPT records, see RFC 6891
+EDNS_PAYLOAD_SIZE = 1232
+# Number of times in a row a worker may die within a second of starting
+# before the Supervisor gives up
+WORKER_FAILURES = 5
+
+
+def truncate_response(response, size=UDP_PAYLOAD_SIZE, opt=b""):
+    """Truncate a response which does not fit in a UDP datagram
+
+    A response longer than size is replaced by its header with the TC flag
+    set and its questions, which tells the client to ask again over TCP.
+
+    Args:
+        response (bytes): the encoded response
+        size (int): maximum size of the response
+        opt (bytes): encoded OPT record added to a truncated response
+
+    Returns:
+        bytes: the response, or the truncated response
+    """
+    if len(response) <= size:
+        return response
+    end = 12
+    for _ in range(struct.unpack_from("!H", response, 4)[0]):
+        while 0 < response[end] < 64:
+            end += response[end] + 1
+        end += 6 if response[end] >= 0xc0 else 5
+    return (response[0:2] + bytes([response[2] | 0x02, response[3]]) +
+            response[4:6] + b"\x00" * 4 + struct.pack("!H", bool(opt)) +
+            response[12:end] + opt)
+
+
+def add_opt(counts, records, opt):
+    """Add an OPT record to the counts and records of an encoded answer
+
+    Args:
+        counts (bytes): answer, authority and additional counts
+        records (bytes): the encoded records
+        opt (bytes): the encoded OPT record, or b"" to add nothing
+
+    Returns:
+        (bytes, bytes): the counts and records
+    """
+    if not opt:
+        return counts, records
+    additionals = struct.unpack_from("!H", counts, 4)[0] + 1
+    return counts[:4] + struct.pack("!H", additionals), records + opt
+
+
 class RequestHandler(Thread):
     """A handler for requests to the DNS server"""
 
-    def __init__(self):
-        """Initialize the handler thread"""
+    def __init__(self, server, requests):
+        """Initialize the handler thread
+
+        Args:
+            server (Server): the server the requests were received by
+            requests (Queue): queue of (data, address) pairs of UDP
+                requests and (data, address, reply) triples of TCP requests,
+                whose response is passed to reply; None stops the handler
+        """
         super().__init__()
         self.daemon = True
+        self.server = server
+        self.requests = requests
 
     def run(self):
         """ Run the handler thread"""
-        pass
+        while True:
+            request = self.requests.get()
+            if request is None:
+                break
+            data, address, *reply = request
+            try:
+                response = self.server.handle_request(data, address)
+            except Exception:
+                traceback.print_exc()
+                response = self.server.error_response(data, RCode.ServFail)
+            try:
+                if reply:
+                    reply[0](response)
+                elif response is not None:
+                    self.server.sock.sendto(
+                        self.server.udp_response(data, response), address)
+            except OSError:
+                self.server.log("\t\tSENDING RESPONSE FAILED")
+
+
+class TCPListener(Thread):
+    """Accepts the TCP connections to the DNS server"""
+
+    def __init__(self, server, sock):
+        """Initialize the listener thread
+
+        Args:
+            server (Server): the server the connections are made to
+            sock (socket): the listening socket
+        """
+        super().__init__()
+        self.daemon = True
+        self.server = server
+        self.sock = sock
+
+    def run(self):
+        """Run the listener thread"""
+        with self.sock:
+            while not self.server.done:
+                try:
+                    sock, address = self.sock.accept()
+                except socket.timeout:
+                    continue
+                except OSError:
+                    break
+                TCPHandler(self.server, sock, address).start()
+
+
+class TCPHandler(Thread):
+    """Answers the requests on a TCP connection to the DNS server
+
+    Every message is preceded by its length in two bytes, see section 4.2.2
+    of RFC 1035. Requests are read as they arrive and queued for the
+    request handlers, up to TCP_PIPELINE at a time, and every response is
+    sent as soon as it is ready, so the responses to pipelined requests may
+    be sent in a different order than the requests (section 6.2.1.1 of RFC
+    7766). Zone transfers, and all requests of a server without request
+    handlers, are answered by the connection thread itself. The connection
+    is kept open for further requests until the client closes it or it has
+    been idle for TCP_IDLE_TIMEOUT seconds.
+    """
+
+    def __init__(self, server, sock, address):
+        """Initialize the handler thread
+
+        Args:
+            server (Server): the server the connection was made to
+            sock (socket): the connected socket
+            address ((str, int)): address of the client
+        """
+        super().__init__()
+        self.daemon = True
+        self.server = server
+        self.sock = sock
+        self.address = address
+        self.lock = Lock()
+        self.idle = Condition()
+        self.pending = 0
+
+    def receive(self, length):
+        """Read length bytes, or None if the connection is closed first"""
+        data = b""
+        while len(data) < length:
+            chunk = self.sock.recv(length - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def send(self, responses):
+        """Send the messages of a response, without other responses between
+        them"""
+        with self.lock:
+            for response in responses:
+                self.sock.sendall(struct.pack("!H", len(response)) + response)
+
+    def reply(self, response):
+        """Send the response to a queued request, see RequestHandler"""
+        try:
+            if response is not None:
+                self.send([response])
+        except OSError:
+            pass
+        finally:
+            with self.idle:
+                self.pending -= 1
+                self.idle.notify_all()
+
+    def run(self):
+        """Run the handler thread"""
+        self.sock.settimeout(TCP_IDLE_TIMEOUT)
+        try:
+            while not self.server.done:
+                length = self.receive(2)
+                if length is None:
+                    break
+                data = self.receive(struct.unpack("!H", length)[0])
+                if data is None:
+                    break
+                if (not self.server.handlers or
+                        self.server.transfer_request(data) is not None):
+                    self.send(self.server.tcp_responses(data, self.address))
+                    continue
+                with self.idle:
+                    self.idle.wait_for(lambda: self.pending < TCP_PIPELINE)
+                    self.pending += 1
+                self.server.requests.put((data, self.address, self.reply))
+        except OSError:
+            pass
+        finally:
+            with self.idle:
+                self.idle.wait_for(lambda: self.pending == 0,
+                                   TCP_IDLE_TIMEOUT)
+            self.sock.close()
+
+
+class ZoneWatcher(Thread):
+    """Reloads the zones of a server when their files change
+
+    The files are checked every interval seconds (if > 0), reload makes the
+    watcher reload the zones straight away, e.g. on SIGHUP.
+    """
+
+    def __init__(self, server, interval):
+        """Initialize the watcher thread
+
+        Args:
+            server (Server): the server whose zones are reloaded
+            interval (float): seconds between checks of the zone files
+        """
+        super().__init__()
+        self.daemon = True
+        self.server = server
+        self.interval = interval
+        self.wake = Event()
+        self.forced = False
+        self.stamp = self.file_stamp()
+
+    def file_stamp(self):
+        """The name, inode, size and modification time of every zone file"""
+        stamp = []
+        for filename in zone_filenames(self.server.zone_files):
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                stamp.append((filename, None))
+                continue
+            stamp.append((filename, stat.st_ino, stat.st_size,
+                          stat.st_mtime_ns))
+        return stamp
+
+    def reload(self):
+        """Reload the zones as soon as possible"""
+        self.forced = True
+        self.wake.set()
+
+    def stop(self):
+        self.wake.set()
+
+    def run(self):
+        """Run the watcher thread"""
+        while True:
+            self.wake.wait(self.interval if self.interval > 0 else None)
+            self.wake.clear()
+            if self.server.done:
+                break
+            stamp = self.file_stamp()
+            if self.forced or stamp != self.stamp:
+                self.forced = False
+                self.stamp = stamp
+                self.server.reload_zones()
+
+
+class ServerProtocol(asyncio.DatagramProtocol):
+    """Serves the requests of a Server on an asyncio event loop"""
+
+    def __init__(self, server):
+        """Initialize the protocol
+
+        Args:
+            server (Server): the server answering the requests
+        """
+        self.server = server
+        self.transport = None
+        self.tasks = set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        response = self.server.cached_response(data, address)
+        if response is not None:
+            self.transport.sendto(self.server.udp_response(data, response),
+                                  address)
+            return
+        message = self.server.parse_request(data, address)
+        if message is None:
+            return
+        response = self.server.local_response(message, data, address)
+        if response is not None:
+            self.transport.sendto(self.server.udp_response(data, response),
+                                  address)
+            return
+        task = asyncio.ensure_future(self.resolve(data, message, address))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def resolve(self, data, message, address):
+        """Answer a request which needs the resolver"""
+        try:
+            response = await self.server.recursive_response_async(message)
+        except Exception:
+            self.server.log("\t\tRESOLVER FAILED")
+            response = self.server.error_response(data, RCode.ServFail)
+        if response is not None:
+            self.transport.sendto(self.server.udp_response(data, response),
+                                  address)
 
 
 class Server:
     """A recursive DNS server"""
 
-    def __init__(self, port, caching, ttl):
+    def __init__(self, port, caching, ttl, threads=8, queue_size=64,
+                 cache_entries=0, cache_bytes=0, cache_policy="lru",
+                 cache_shards=16, shared_cache=0, packet_cache=10000,
+                 zone_files=("zone",), zone_poll=5, allow_update=(),
+                 edns_size=EDNS_PAYLOAD_SIZE):
         """Initialize the server
 
         Args:
             port (int): port that server is listening on
             caching (bool): server uses resolver with caching if true
             ttl (int): ttl for records (if > 0) of cache
+            threads (int): number of request handler threads
+            queue_size (int): maximum number of requests waiting for a handler
+            cache_entries (int): maximum number of cached RRsets (if > 0)
+            cache_bytes (int): approximate maximum cache size (if > 0)
+            cache_policy (str): cache eviction policy ("lru", "lfu", "arc")
+            cache_shards (int): number of independently locked cache shards
+            shared_cache (int): if > 0, keep up to this many RRsets in a
+                cache shared by all worker processes instead
+            packet_cache (int): maximum number of encoded responses kept
+                for repeated requests (if > 0)
+            zone_files ([str]): master files and compiled zone images of the
+                zones, and directories of them (see load_catalog)
+            zone_poll (float): seconds between checks whether the zone files
+                changed, while serving (if > 0)
+            allow_update ([str]): networks of the clients allowed to send
+                dynamic updates (see update_response), no client if empty
+            edns_size (int): UDP payload size advertised to clients and
+                upstream servers in OPT records (EDNS, RFC 6891), 0 disables
+                EDNS
         """
         self.caching = caching
         self.ttl = ttl
         self.port = port
+        self.threads = threads
+        self.queue_size = queue_size
+        self.reuse_port = False
         self.done = False
-        self.zone = Zone()
-        self.zone.read_master_file('zone')
-        self.cache = RecordCache(ttl)
+        self.handlers = []
+        self.loop = None
+        self.zone_files = zone_files
+        self.zone_poll = zone_poll
+        self.catalog = load_catalog(zone_files)
+        self.watcher = None
+        self.allow_update = [ipaddress.ip_network(network)
+                             for network in allow_update]
+        self.update_lock = Lock()
+        self.edns_size = edns_size
+        self.opt = b""
+        if edns_size > 0:
+            self.opt = opt_record(edns_size).to_bytes(0, None)
+        if shared_cache > 0:
+            self.cache = SharedRecordCache(ttl, shared_cache)
+        else:
+            self.cache = RecordCache(ttl, cache_entries, cache_bytes,
+                                     cache_policy, shards=cache_shards)
         if self.caching:
             self.cache.read_cache_file()
+        self.packets = None
+        if packet_cache > 0:
+            self.packets = PacketCache(packet_cache, self.cache)
+        self.resolver = Resolver(5, self.caching, 0, cache=self.cache,
+                                 edns_size=edns_size)
+        self.resolver.rd = 0
+        self.resolver.rootip = "198.41.0.4"
         self.doLogging = True
 
     def log(self, *args, end="\n"):
         if self.doLogging:
             print(*args, end=end)
 
-    def search_zone(self, question):
-        tests = str(question).split('.')
-        for i in range(len(tests)):
-            test = '.'.join(tests[i:])
-            if test == '':
-                test = '.'
-            r = self.zone.records.get(test, None)
-            if not r == None:
-                if test == str(question):
-                    return True, r
-                return False, r
-        return False, []
+    def reload_zones(self):
+        """Load the zone files again and swap the new catalog in
+
+        The catalog is replaced by a single assignment: requests which
+        already took the old catalog are answered from it, later requests
+        from the new one. If any zone cannot be loaded the old catalog is
+        kept. Dynamic updates wait until the catalog is replaced.
+
+        Returns:
+            bool: whether the catalog was replaced
+        """
+        with self.update_lock:
+            try:
+                catalog = load_catalog(self.zone_files)
+                for name, zone in catalog.zones.items():
+                    old = self.catalog.zones.get(name)
+                    if old is not None:
+                        self.keep_history(old, zone)
+            except Exception as error:
+                self.log("ZONE RELOAD FAILED:", error)
+                return False
+            self.catalog = catalog
+        self.log("ZONES RELOADED:", len(catalog.zones))
+        return True
+
+    def keep_history(self, old, zone):
+        """Give a reloaded zone the history of its old version
+
+        If the serial changed, the change is added to the history for IXFR.
+
+        Args:
+            old (Zone or MappedZone): the zone before the reload
+            zone (Zone or MappedZone): the reloaded zone
+        """
+        zone.history = old.history.copy()
+        old_soa, new_soa = old.soa(), zone.soa()
+        if (old_soa is not None and new_soa is not None and
+                old_soa.rdata.serial != new_soa.rdata.serial):
+            deleted, added = record_changes(old, zone)
+            zone.history.add(old_soa, deleted, new_soa, added)
 
     def zone_resolution(self, questions):
+        catalog = self.catalog
+        answers, authorities, additionals = [], [], []
         for q in questions:
             self.log("\tRESOLVING:", q.qname)
-            res, rlist = self.search_zone(q.qname)
-            answers = []
-            authorities = []
-            additionals = []
-            for r in rlist:
-                if r.type_ == Type.A and res:
-                    answers.append(r)
-                if r.type_ == Type.NS:
-                    res, a = self.search_zone(r.rdata.nsdname)
-                    authorities.append(r)
-                    if res:
-                        additionals.append(a[0])
+            zone = catalog.find_zone(q.qname)
+            if zone is None:
+                answers, authorities, additionals = [], [], []
+                continue
+            answers, authorities, additionals = zone.sections(
+                *zone.find(q.qname))
         return answers, authorities, additionals
 
-    def check_cache(self, hostname):
-        iplist = self.cache.lookup(hostname, Type.A, Class.IN)
-        namelist = self.cache.lookup(hostname, Type.CNAME, Class.IN)
-        if not (iplist == [] and namelist == []):
-            iplist = [x.rdata.address for x in iplist]
-            namelist = [x.rdata.cname for x in namelist]
-            return True, iplist, namelist
-        return False, [], []
+    def zone_response(self, message, found=None):
+        """Answer a request with one question from the encoded zone answers
+
+        Args:
+            message (Message): the request
+            found (list): if given, the zone, node and node version the
+                answer is taken from are appended to it
+
+        Returns:
+            bytes: the response, or None if the zone has no answer
+        """
+        question = message.questions[0]
+        self.log("\tRESOLVING:", question.qname)
+        zone = self.catalog.find_zone(question.qname)
+        if zone is None:
+            return None
+        exact, node = zone.walk(question.qname)
+        if node is None:
+            return None
+        if found is not None:
+            found.append((zone, node, zone.node_version(node)))
+        template = zone.template(node, exact)
+        if template is None:
+            return None
+        self.log("SENDING RESPONSE:", 0, "\n")
+        counts, records = template
+        if message.opt is not None:
+            counts, records = add_opt(counts, records, self.opt)
+        header = self.build_message(message.header.ident, message.header.rd,
+                                    1, 0, message.questions, [], [], []).header
+        return (header.to_bytes()[:6] + counts +
+                question.to_bytes(12, {}) + records)
+
+    def fast_response(self, data, address, found=None):
+        """Answer a request from the zone without parsing it into a Message
+
+        Only requests with one A question in class IN, no other sections
+        than an OPT record of EDNS version 0 and no unusual flags are
+        answered, and only if the answer comes from the zone. The question
+        is read straight from the datagram, its zone is found with
+        Catalog.zone, its wire format and that of its ancestors are looked
+        up with Zone.node and the encoded answer of the closest node is sent
+        (see Zone.template). If found is given, the zone, node and node
+        version are appended to it, see zone_response.
+
+        Returns:
+            bytes: the response, or None if the request takes the full path
+        """
+        view = memoryview(data)
+        if (len(data) < 17 or data[2] & 0xfe or data[10] or data[11] > 1 or
+                view[4:10] != b"\x00\x01\x00\x00\x00\x00"):
+            return None
+        starts = []
+        offset = 12
+        while data[offset]:
+            if data[offset] > 63:
+                return None
+            starts.append(offset)
+            offset += data[offset] + 1
+            if offset >= len(data):
+                return None
+        end = offset + 5
+        if view[offset + 1:end] != b"\x00\x01\x00\x01":
+            return None
+        opt = b""
+        if data[11]:
+            if (len(data) < end + 11 or not self.opt or data[end + 6] or
+                    view[end:end + 3] != b"\x00\x00\x29" or len(data) !=
+                    end + 11 + struct.unpack_from("!H", data, end + 9)[0]):
+                return None
+            opt = self.opt
+        elif len(data) != end:
+            return None
+
+        qname = bytes(view[12:offset + 1]).lower()
+        zone = self.catalog.zone(qname)
+        if zone is None:
+            return None
+        for start in starts + [offset]:
+            node = zone.node(qname[start - 12:])
+            if node is not None:
+                if found is not None:
+                    found.append((zone, node, zone.node_version(node)))
+                answer = zone.template(node, start == 12)
+                if answer is None:
+                    return None
+                self.log("REQUEST RECIEVED:", address, "(ZONE FAST PATH)")
+                counts, records = add_opt(*answer, opt)
+                return (bytes(view[0:2]) + bytes([0x84 | data[2], 0x80]) +
+                        b"\x00\x01" + counts + bytes(view[12:end]) + records)
+        return None
+
+    def transfer_request(self, data):
+        """Parse a request if it asks for a zone transfer
+
+        Returns:
+            Message: the request, or None if it is not an AXFR or IXFR
+                request with one question
+        """
+        if len(data) < 17 or data[4:6] != b"\x00\x01":
+            return None
+        offset = 12
+        while offset < len(data) and 0 < data[offset] < 64:
+            offset += data[offset] + 1
+        if data[offset + 1:offset + 3] not in (b"\x00\xfb", b"\x00\xfc"):
+            return None
+        try:
+            return Message.from_bytes(data)
+        except Exception:
+            return None
+
+    def transfer_zone(self, name):
+        """The zone whose name is name, or None"""
+        zone = self.catalog.find_zone(name)
+        if (zone is None or name.to_bytes(0).lower() !=
+                zone.origin().to_bytes(0).lower()):
+            return None
+        return zone
+
+    def transfer_responses(self, message, data, address):
+        """Answer an AXFR or IXFR request, see dns.zone.transfer_records
+
+        Only the name of a zone can be transferred. An IXFR request has the
+        SOA record of the client in its authority section.
+
+        Yields:
+            bytes: the messages of the response
+        """
+        question = message.questions[0]
+        self.log("TRANSFER REQUEST:", address, question.qtype, question.qname)
+        zone = self.transfer_zone(question.qname)
+        records = None
+        if zone is not None:
+            serial = None
+            if question.qtype == Type.IXFR:
+                soas = [r for r in message.authorities if r.type_ == Type.SOA]
+                if not soas:
+                    yield self.error_response(data, RCode.FormErr)
+                    return
+                serial = soas[0].rdata.serial
+            records = transfer_records(zone, serial)
+        if records is None:
+            yield self.error_response(data, RCode.NotAuth)
+            return
+        yield from self.transfer_messages(message, records)
+
+    def transfer_messages(self, message, records,
+                          size=TRANSFER_MESSAGE_SIZE):
+        """Encode the records of a zone transfer as a stream of messages
+
+        The records are encoded one at a time, every message holds as many
+        as fit in size bytes (at least one) and is compressed on its own.
+        Only the first message has the question.
+
+        Args:
+            message (Message): the request
+            records (iterator of ResourceRecord): the records
+            size (int): maximum size of a message
+
+        Yields:
+            bytes: the messages
+        """
+        header = self.build_message(message.header.ident, message.header.rd,
+                                    1, 0, [], [], [], []).header
+        prefix = header.to_bytes()[:4]
+        compress = {}
+        body = [message.questions[0].to_bytes(12, compress)]
+        length = 12 + len(body[0])
+        questions = 1
+        for record in records:
+            data = record.to_bytes(length, compress)
+            if length + len(data) > size and len(body) > questions:
+                yield (prefix + struct.pack("!HHHH", questions,
+                                            len(body) - questions, 0, 0) +
+                       b"".join(body))
+                compress = {}
+                body = []
+                length = 12
+                questions = 0
+                data = record.to_bytes(length, compress)
+            body.append(data)
+            length += len(data)
+        yield (prefix + struct.pack("!HHHH", questions, len(body) - questions,
+                                    0, 0) + b"".join(body))
+
+    def tcp_responses(self, data, address):
+        """Answer a request received over TCP
+
+        Zone transfers are answered with a stream of messages, see
+        transfer_responses, other requests as by handle_request.
+
+        Yields:
+            bytes: the messages of the response
+        """
+        message = self.transfer_request(data)
+        if message is not None:
+            yield from self.transfer_responses(message, data, address)
+            return
+        response = self.handle_request(data, address)
+        if response is not None:
+            yield response
+
+    def cache_versions(self, questions):
+        """The versions of the RRsets consult_cache looks up
+
+        Returns:
+            ((tuple, int)): cache keys and versions, see PacketCache.put
+        """
+        keys = [cache_key(q.qname, type_, Class.IN) for q in questions
+                for type_ in (Type.A, Type.CNAME)]
+        return tuple((key, self.cache.rrset_version(key)) for key in keys)
 
     def consult_cache(self, questions):
+        """Answer questions from the cache
+
+        The answers get the TTL of the server if it is > 0, otherwise the
+        remaining TTL of the cached records.
+
+        Returns:
+            ([ResourceRecord], float): the answers and the time the first of
+                the cached records expires
+        """
         answers = []
+        expires = float("inf")
+        now = time.time()
         for q in questions:
-            res, iplist, namelist = self.check_cache(q.qname)
-            if res:
-                for ip in iplist:
-                    answers.append(ResourceRecord(q.qname, Type.A, Class.IN, self.ttl, ARecordData(ip)))
-                for n in namelist:
-                    answers.append(ResourceRecord(q.qname, Type.CNAME, Class.IN, self.ttl, CNAMERecordData(n)))
-        return answers
+            for type_ in [Type.A, Type.CNAME]:
+                for r in self.cache.lookup(q.qname, type_, Class.IN):
+                    expires = min(expires, r.ttl)
+                    ttl = self.ttl if self.ttl > 0 else max(int(r.ttl - now), 0)
+                    answers.append(ResourceRecord(q.qname, type_, Class.IN, ttl, r.rdata))
+        return answers, expires
 
     def build_message(self,id, rd, aa, rcode, questions, answers, authorities, additionals):
         header = Header(id, 0, len(questions), len(answers), len(authorities), len(additionals))
@@ -120,54 +721,542 @@ class Server:
         return Message(header, questions=questions, answers=answers, authorities=authorities, additionals=additionals)
 
 
-    def serve(self):
-        """Start serving requests"""
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.bind(("", self.port))
+    def error_response(self, data, rcode):
+        """Build an error response for a raw request without resolving it
 
-        while not self.done:
-            data, address = sock.recvfrom(65565)
+        The question is echoed when it is the only section in the request.
+
+        Args:
+            data (bytes): the request datagram
+            rcode (RCode): the response code
+
+        Returns:
+            bytes: the response, or None if the request is not a DNS message
+        """
+        try:
+            request = Header.from_bytes(data)
+        except ValueError:
+            return None
+        echo = (request.an_count, request.ns_count, request.ar_count) == (0, 0, 0)
+        header = Header(request.ident, 0, request.qd_count if echo else 0, 0, 0, 0)
+        header.qr = 1
+        header.rd = request.rd
+        header.ra = 1
+        header.rcode = rcode
+        return header.to_bytes() + (data[12:] if echo else b"")
+
+    def parse_request(self, data, address):
+        """Parse a request datagram
+
+        Returns:
+            Message: the request, or None if it is not a valid DNS message
+        """
+        try:
             message = Message.from_bytes(data)
+        except Exception:
+            self.log("MALFORMED REQUEST:", address)
+            return None
+        self.log("REQUEST RECIEVED:", address)
+        return message
+
+    def cached_response(self, data, address):
+        """Answer a request without parsing it, if possible
+
+        The request is answered from the packet cache or else by
+        fast_response, whose response is then added to the packet cache.
+
+        Returns:
+            bytes: the response, or None if the request takes the full path
+        """
+        if self.packets is None or len(data) < 12:
+            return self.fast_response(data, address)
+        catalog = self.catalog
+        response = self.packets.get(data, catalog.version, catalog.shape)
+        if response is not None:
+            self.log("REQUEST RECIEVED:", address, "(CACHED RESPONSE)")
+            return response
+        found = []
+        response = self.fast_response(data, address, found)
+        if response is not None:
+            self.packets.put(data, response, float("inf"), catalog.shape,
+                             node=found[0])
+        return response
 
-            rd = message.header.rd
-            rcode = 0
-            aa = 1
+    def local_response(self, message, data=None, address=None):
+        """Answer a request from the zone and the cache
 
-            self.log("REQUEST RECIEVED:", address)
+        Args:
+            message (Message): the request
+            data (bytes): the request datagram, if given the response is
+                stored in the packet cache
+            address ((str, int)): address of the client
+
+        Returns:
+            bytes: the response, or None if the resolver has to be called
+        """
+        rd = message.header.rd
+        rcode = 0
+        aa = 1
+        catalog = self.catalog
+        version = catalog.version
+        if message.header.opcode == OPCODE_UPDATE:
+            return self.update_response(message, address)
+        if self.opt and message.edns_version:
+            self.log("\tUNSUPPORTED EDNS VERSION:", message.edns_version)
+            return self.response(message, 0, RCode.BADVERS, [], [], [])
+        if (len(message.questions) == 1 and
+                message.questions[0].qtype in (Type.AXFR, Type.IXFR)):
+            return self.udp_transfer_response(message)
+        rrsets = None
+        expires = float("inf")
+
+        if len(message.questions) == 1:
+            found = []
+            response = self.zone_response(message, found)
+            if response is not None:
+                if data is not None and self.packets is not None:
+                    self.packets.put(data, response, expires, catalog.shape,
+                                     node=found[0])
+                return response
+            answers, authorities, additionals = [], [], []
+        else:
             answers, authorities, additionals = self.zone_resolution(message.questions)
 
+        if answers == [] and authorities == [] and additionals == []:
+            self.log("\tZONE RESOLUTION FAILED")
+            rrsets = self.cache_versions(message.questions)
+            answers, expires = self.consult_cache(message.questions)
+
             if answers == []:
-                if authorities == [] and additionals == []:
-                    self.log("\tZONE RESOLUTION FAILED")
-                    answers = self.consult_cache(message.questions)
-
-                    if answers == []:
-                        self.log("\tCACHE LOOKUP FAILED")
-                        rcode = 3
-                    else:
-                        aa = 0
-
-                if rcode == 3 and rd == 1:
-                    rcode = 0
-                    self.log("\tCALLING RESOLVER")
-                    resolver = Resolver(5, True, 0)
-                    resolver.rd = 0
-                    resolver.rootip = "198.41.0.4"
-                    for q in message.questions:
-                        self.log("\t\tRESOLVING:", q.qname)
-
-                        hostname, namelist, iplist = resolver.gethostbyname(str(q.qname))
-                        if hostname == str(q.qname):
-                            for ip in iplist:
-                                answers.append(ResourceRecord(q.qname, Type.A, Class.IN, self.ttl, ARecordData(ip)))
-                            for n in namelist:
-                                answers.append(ResourceRecord(q.qname, Type.CNAME, Class.IN, self.ttl, CNAMERecordData(n)))
-
-            self.log("SENDING RESPONSE:", rcode, "\n")
-            mess = self.build_message(message.header.ident, rd, aa, rcode, message.questions, answers, authorities, additionals)
-            sock.sendto(mess.to_bytes(), address)
+                self.log("\tCACHE LOOKUP FAILED")
+                if rd == 1:
+                    return None
+                rcode = 3
+            else:
+                aa = 0
+
+        response = self.response(message, aa, rcode, answers, authorities, additionals)
+        if data is not None and self.packets is not None and rcode == 0:
+            self.packets.put(data, response, expires, version, rrsets,
+                             decay=rrsets is not None and self.ttl <= 0)
+        return response
+
+    def udp_transfer_response(self, message):
+        """Answer a zone transfer request received over UDP
+
+        Zone transfers are only sent over TCP. An IXFR request is answered
+        with the SOA record alone, which tells the client to ask again over
+        TCP (section 2 of RFC 1995), an AXFR request is refused.
+        """
+        question = message.questions[0]
+        zone = self.transfer_zone(question.qname)
+        soa = zone.soa() if zone is not None else None
+        if soa is None:
+            return self.response(message, 0, RCode.NotAuth, [], [], [])
+        if question.qtype == Type.AXFR:
+            return self.response(message, 0, RCode.Refused, [], [], [])
+        return self.response(message, 1, 0, [soa], [], [])
+
+    def update_response(self, message, address):
+        """Apply a dynamic update, see dns.update
+
+        Updates are refused unless the client is in one of the allow_update
+        networks and the zone is loaded from a master file (a zone image
+        cannot change). Updates are applied one at a time.
+
+        Returns:
+            bytes: the response, which has the zone section of the request
+        """
+        self.log("UPDATE REQUEST:", address)
+        if (address is None or not any(
+                ipaddress.ip_address(address[0]) in network
+                for network in self.allow_update)):
+            return self.update_message(message, RCode.Refused)
+        if (len(message.questions) != 1 or
+                message.questions[0].qtype != Type.SOA):
+            return self.update_message(message, RCode.FormErr)
+        zone = self.transfer_zone(message.questions[0].qname)
+        if zone is None or zone.soa() is None:
+            return self.update_message(message, RCode.NotAuth)
+        if isinstance(zone, MappedZone):
+            return self.update_message(message, RCode.Refused)
+        try:
+            with self.update_lock:
+                update_zone(zone, message)
+        except UpdateError as error:
+            self.log("\tUPDATE FAILED:", error)
+            return self.update_message(message, error.rcode)
+        return self.update_message(message, RCode.NoError)
+
+    def update_message(self, message, rcode):
+        """Encode the response to an UPDATE request"""
+        self.log("SENDING RESPONSE:", rcode, "\n")
+        response = self.build_message(message.header.ident, 0, 0, rcode,
+                                      message.questions[:1], [], [], [])
+        response.header.opcode = OPCODE_UPDATE
+        response.header.ra = 0
+        return response.to_bytes()
+
+    def response(self, message, aa, rcode, answers, authorities, additionals):
+        """Encode the response to a request
+
+        A request with an OPT record gets one in the response, which holds
+        the upper bits of an extended rcode.
+        """
+        self.log("SENDING RESPONSE:", rcode, "\n")
+        if self.opt and message.opt is not None:
+            additionals = additionals + [opt_record(self.edns_size, rcode)]
+        mess = self.build_message(message.header.ident, message.header.rd, aa, rcode & 0xf, message.questions, answers, authorities, additionals)
+        return mess.to_bytes()
+
+    def udp_response(self, data, response):
+        """Truncate a response to the UDP payload size of its request
+
+        The payload size is 512 bytes, or if the request has an OPT record
+        the size it advertises, but at most edns_size (see RFC 6891).
+
+        Args:
+            data (bytes): the request datagram
+            response (bytes): the response
+
+        Returns:
+            bytes: the response, or the truncated response
+        """
+        if len(response) <= UDP_PAYLOAD_SIZE:
+            return response
+        size, opt = UDP_PAYLOAD_SIZE, b""
+        if self.opt:
+            try:
+                request = Message.from_bytes(data)
+            except Exception:
+                request = None
+            if request is not None and request.opt is not None:
+                size = min(request.payload_size,
+                           max(self.edns_size, UDP_PAYLOAD_SIZE))
+                opt = self.opt
+        return truncate_response(response, size, opt)
+
+    def resolved_answers(self, question, hostname, namelist, iplist):
+        """Convert the result of gethostbyname to answers for question"""
+        answers = []
+        if hostname == str(question.qname):
+            for ip in iplist:
+                answers.append(ResourceRecord(question.qname, Type.A, Class.IN, self.ttl, ARecordData(ip)))
+            for n in namelist:
+                answers.append(ResourceRecord(question.qname, Type.CNAME, Class.IN, self.ttl, CNAMERecordData(n)))
+        return answers
+
+    def recursive_response(self, message):
+        """Answer a request using the resolver"""
+        self.log("\tCALLING RESOLVER")
+        answers = []
+        for q in message.questions:
+            self.log("\t\tRESOLVING:", q.qname)
+            answers.extend(self.resolved_answers(q, *self.resolver.gethostbyname(str(q.qname))))
+        return self.response(message, 1, 0, answers, [], [])
+
+    async def recursive_response_async(self, message):
+        """Answer a request using the resolver on an asyncio event loop"""
+        self.log("\tCALLING RESOLVER")
+        answers = []
+        for q in message.questions:
+            self.log("\t\tRESOLVING:", q.qname)
+            answers.extend(self.resolved_answers(q, *await self.resolver.gethostbyname_async(str(q.qname))))
+        return self.response(message, 1, 0, answers, [], [])
+
+    def handle_request(self, data, address):
+        """Resolve a single request
+
+        Args:
+            data (bytes): the request datagram
+            address ((str, int)): address of the client
+
+        Returns:
+            bytes: the response, or None if no response should be sent
+        """
+        response = self.cached_response(data, address)
+        if response is not None:
+            return response
+        message = self.parse_request(data, address)
+        if message is None:
+            return None
+        response = self.local_response(message, data, address)
+        if response is None:
+            try:
+                response = self.recursive_response(message)
+            except Exception:
+                self.log("\t\tRESOLVER FAILED")
+                response = self.error_response(data, RCode.ServFail)
+        return response
+
+    async def handle_request_async(self, data, address):
+        """Resolve a single request on an asyncio event loop
+
+        See handle_request, the resolver is called with
+        recursive_response_async.
+        """
+        response = self.cached_response(data, address)
+        if response is not None:
+            return response
+        message = self.parse_request(data, address)
+        if message is None:
+            return None
+        response = self.local_response(message, data, address)
+        if response is None:
+            try:
+                response = await self.recursive_response_async(message)
+            except Exception:
+                self.log("\t\tRESOLVER FAILED")
+                response = self.error_response(data, RCode.ServFail)
+        return response
+
+    async def serve_tcp(self, reader, writer):
+        """Answer the requests on a TCP connection, see TCPHandler
+
+        Every request other than a zone transfer is answered by its own
+        task, at most TCP_PIPELINE at a time.
+        """
+        address = writer.get_extra_info("peername")
+        pipeline = asyncio.Semaphore(TCP_PIPELINE)
+        tasks = set()
+
+        async def answer(data):
+            try:
+                response = await self.handle_request_async(data, address)
+                if response is not None:
+                    writer.write(struct.pack("!H", len(response)) + response)
+            finally:
+                pipeline.release()
+
+        try:
+            while not self.done:
+                length = await asyncio.wait_for(reader.readexactly(2),
+                                                TCP_IDLE_TIMEOUT)
+                data = await reader.readexactly(struct.unpack("!H", length)[0])
+                message = self.transfer_request(data)
+                if message is not None:
+                    for response in self.transfer_responses(message, data,
+                                                            address):
+                        writer.write(struct.pack("!H", len(response)) +
+                                     response)
+                        await writer.drain()
+                    continue
+                await pipeline.acquire()
+                task = asyncio.ensure_future(answer(data))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, OSError):
+            pass
+        finally:
+            if tasks:
+                await asyncio.wait(tasks, timeout=TCP_IDLE_TIMEOUT)
+            writer.close()
+
+    def serve(self):
+        """Start serving requests
+
+        The calling thread only receives datagrams and queues them for the
+        request handlers. When the queue is full the request is answered with
+        SERVFAIL straight away.
+        """
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self.reuse_port:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.sock.bind(("", self.port))
+        self.sock.settimeout(0.5)
+
+        tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        tcp.bind(("", self.port))
+        tcp.listen()
+        tcp.settimeout(0.5)
+        TCPListener(self, tcp).start()
+
+        self.requests = Queue(self.queue_size)
+        self.handlers = [RequestHandler(self, self.requests)
+                         for _ in range(self.threads)]
+        for handler in self.handlers:
+            handler.start()
+
+        while not self.done:
+            try:
+                data, address = self.sock.recvfrom(65565)
+            except socket.timeout:
+                continue
+            try:
+                self.requests.put_nowait((data, address))
+            except Full:
+                self.log("QUEUE FULL, DROPPING REQUEST:", address)
+                response = self.error_response(data, RCode.ServFail)
+                if response is not None:
+                    self.sock.sendto(response, address)
+
+    async def serve_async(self):
+        """Start serving requests on the running asyncio event loop
+
+        Zone and cache answers are sent from datagram_received directly, only
+        requests which need the resolver become tasks on the event loop. TCP
+        connections are served by serve_tcp.
+        """
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: ServerProtocol(self), local_addr=("0.0.0.0", self.port),
+            reuse_port=self.reuse_port or None)
+        tcp = await asyncio.start_server(self.serve_tcp, "0.0.0.0", self.port,
+                                         reuse_port=self.reuse_port or None)
+        try:
+            await self.stopped.wait()
+        finally:
+            tcp.close()
+            transport.close()
+
+    def run(self, engine="threads"):
+        """Serve requests until the server is shut down
+
+        The zones are reloaded when their files change (see ZoneWatcher) and
+        on SIGHUP.
+
+        Args:
+            engine (str): "threads" for serve, "asyncio" for serve_async
+        """
+        self.watcher = ZoneWatcher(self, self.zone_poll)
+        self.watcher.start()
+        if current_thread() is main_thread():
+            signal.signal(signal.SIGHUP,
+                          lambda signum, frame: self.watcher.reload())
+        if engine == "asyncio":
+            asyncio.run(self.serve_async())
+        else:
+            self.serve()
 
     def shutdown(self):
         """Shut the server down"""
         self.done = True
+        self.log("CACHE:", self.cache.stats())
+        if self.packets is not None:
+            self.log("PACKETS:", self.packets.stats())
+        self.log("RESOLVER:", self.resolver.stats())
+        self.resolver.close()
+        if isinstance(self.cache, SharedRecordCache):
+            self.cache.close()
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.stopped.set)
+        if self.watcher is not None:
+            self.watcher.stop()
+        for _ in self.handlers:
+            self.requests.put(None)
+
+
+
+class Supervisor:
+    """Runs a Server in several worker processes
+
+    The server is created (and its zones loaded) before the workers are
+    forked, so the workers share that memory copy-on-write. Every worker
+    binds the same port with SO_REUSEPORT and the kernel spreads the requests
+    over them. Workers which die are restarted. A worker which dies within a
+    second of starting is restarted after a delay which doubles every time,
+    after WORKER_FAILURES such deaths in a row the supervisor shuts down and
+    exits.
+    """
+
+    def __init__(self, server, workers):
+        """Initialize the supervisor
+
+        Args:
+            server (Server): the server run by every worker
+            workers (int): number of worker processes
+        """
+        self.server = server
+        self.server.reuse_port = True
+        self.workers = workers
+        self.engine = "threads"
+        self.started = {}
+        self.failures = 0
+        self.done = False
+
+    def spawn(self, delay=0):
+        """Fork a new worker process
 
+        Args:
+            delay (float): seconds the worker waits before it starts serving
+        """
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            status = 1
+            try:
+                time.sleep(delay)
+                signal.signal(signal.SIGTERM,
+                              lambda signum, frame: self.server.shutdown())
+                self.server.run(self.engine)
+                status = 0
+            except:
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(status)
+        self.server.log("WORKER STARTED:", pid)
+        self.started[pid] = time.monotonic() + delay
+
+    def run(self, engine="threads"):
+        """Start the workers and restart them when they die
+
+        Args:
+            engine (str): engine the workers serve with, see Server.run
+        """
+        self.engine = engine
+        gc.freeze()
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.shutdown())
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.reload())
+        for _ in range(self.workers):
+            self.spawn()
+
+        while not self.done:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            started = self.started.pop(pid, None)
+            if self.done or started is None:
+                continue
+            self.server.log("WORKER DIED:", pid, "STATUS:", status)
+            if time.monotonic() - started < 1:
+                self.failures += 1
+                if self.failures >= WORKER_FAILURES:
+                    self.shutdown()
+                    sys.exit("workers keep dying at startup, giving up")
+                self.spawn(2 ** (self.failures - 1))
+            else:
+                self.failures = 0
+                self.spawn()
+
+    def reload(self):
+        """Make all workers reload the zones"""
+        for pid in list(self.started):
+            try:
+                os.kill(pid, signal.SIGHUP)
+            except ProcessLookupError:
+                pass
+
+    def shutdown(self):
+        """Stop all workers and wait for them to exit"""
+        self.done = True
+        for pid in list(self.started):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in list(self.started):
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+            self.started.pop(pid, None)
+        if isinstance(self.server.cache, SharedRecordCache):
+            self.server.cache.close()
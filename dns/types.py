@@ -35,6 +35,9 @@ class Type(IntEnum):
     MX = 15
     TXT = 16
     AAAA = 28
+    OPT = 41
+    IXFR = 251
+    AXFR = 252
     ANY = 255
 
     def __str__(self):
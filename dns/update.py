@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+
+"""Dynamic updates
+
+This module applies UPDATE messages (RFC 2136) to a Zone. The zone section
+names the zone, the prerequisite section (the answer section of the Message)
+holds the conditions the zone has to meet and the update section (the
+authority section) the records to add and delete. Only the nodes of the
+names in the update are changed, see dns.zone.apply_changes, and every
+update is added to the history and the journal of the zone.
+"""
+
+
+from dns.classes import Class
+from dns.rcodes import RCode
+from dns.resource import ResourceRecord, SOARecordData
+from dns.types import Type
+from dns.zone import tree_labels, apply_changes, append_journal
+
+
+# The opcode of UPDATE messages
+OPCODE_UPDATE = 5
+
+# Types which only appear in questions, never in a zone
+META_TYPES = (Type.IXFR, Type.AXFR, Type.ANY)
+
+
+class UpdateError(Exception):
+    """An update which is not applied"""
+
+    def __init__(self, rcode, message):
+        """Initialize the error
+
+        Args:
+            rcode (RCode): the response code of the response
+            message (str): why the update is not applied
+        """
+        super().__init__(message)
+        self.rcode = rcode
+
+
+def rdata_bytes(record):
+    """The RDATA of a record in uncompressed wire format"""
+    return record.rdata.to_bytes(0, None)
+
+
+def serial_newer(new, old):
+    """Whether serial new comes after serial old, see RFC 1982"""
+    return 0 < (new - old) % 2 ** 32 < 2 ** 31
+
+
+class Update:
+    """An update of a zone
+
+    The record sets of the names in the update are copied from the zone
+    when the update first touches them, changed, and compared with those of
+    the zone by commit.
+    """
+
+    def __init__(self, zone):
+        """Initialize the update
+
+        Args:
+            zone (Zone): the zone to update
+        """
+        self.zone = zone
+        self.origin = zone.origin()
+        self.labels = tree_labels(self.origin)
+        self.sets = {}
+
+    def in_zone(self, name):
+        """Whether a name is in the zone"""
+        return tree_labels(name)[:len(self.labels)] == self.labels
+
+    def is_apex(self, name):
+        """Whether a name is the name of the zone"""
+        return tree_labels(name) == self.labels
+
+    def records(self, name):
+        """The records of a name in the zone, see find"""
+        exact, records, _ = self.zone.find(name)
+        return records if exact else []
+
+    def record_set(self, name):
+        """The changed records of a name, copied from the zone on first use"""
+        key = name.to_bytes(0).lower()
+        if key not in self.sets:
+            self.sets[key] = (name, list(self.records(name)))
+        return self.sets[key][1]
+
+    def check_prerequisites(self, prerequisites):
+        """Check the prerequisites, see section 3.2 of RFC 2136
+
+        Raises:
+            UpdateError: if a prerequisite is malformed or not met
+        """
+        required = {}
+        for record in prerequisites:
+            if record.ttl != 0:
+                raise UpdateError(RCode.FormErr, "prerequisite with TTL")
+            if not self.in_zone(record.name):
+                raise UpdateError(RCode.NotZone,
+                                  "{} not in zone".format(record.name))
+            records = self.records(record.name)
+            if record.class_ in (Class.ANY, Class.NONE):
+                if rdata_bytes(record):
+                    raise UpdateError(RCode.FormErr, "prerequisite with RDATA")
+                if record.type_ == Type.ANY:
+                    exists = bool(records)
+                else:
+                    exists = any(r.type_ == record.type_ for r in records)
+                if record.class_ == Class.ANY and not exists:
+                    raise UpdateError(
+                        RCode.NXDomain if record.type_ == Type.ANY
+                        else RCode.NXRRSet, "{} {} does not exist".format(
+                            record.name, record.type_))
+                if record.class_ == Class.NONE and exists:
+                    raise UpdateError(
+                        RCode.YXDomain if record.type_ == Type.ANY
+                        else RCode.YXRRSet, "{} {} exists".format(
+                            record.name, record.type_))
+            elif record.class_ == Class.IN:
+                if record.type_ in META_TYPES:
+                    raise UpdateError(RCode.FormErr, "prerequisite of type {}"
+                                      .format(record.type_))
+                key = (record.name.to_bytes(0).lower(), record.type_)
+                required.setdefault(key, (record.name, set()))[1].add(
+                    rdata_bytes(record))
+            else:
+                raise UpdateError(RCode.FormErr, "prerequisite of class {}"
+                                  .format(record.class_))
+        for (_, type_), (name, rdatas) in required.items():
+            if rdatas != {rdata_bytes(r) for r in self.records(name)
+                          if r.type_ == type_}:
+                raise UpdateError(RCode.NXRRSet, "{} {} differs".format(
+                    name, type_))
+
+    def prescan(self, updates):
+        """Check the update section, see section 3.4.1 of RFC 2136
+
+        Raises:
+            UpdateError: if an update is malformed or outside the zone
+        """
+        for record in updates:
+            if not self.in_zone(record.name):
+                raise UpdateError(RCode.NotZone,
+                                  "{} not in zone".format(record.name))
+            if record.class_ == Class.IN:
+                malformed = (record.type_ in META_TYPES or
+                             not rdata_bytes(record))
+            elif record.class_ == Class.ANY:
+                malformed = (record.ttl != 0 or bool(rdata_bytes(record)) or
+                             record.type_ in (Type.IXFR, Type.AXFR))
+            elif record.class_ == Class.NONE:
+                malformed = record.ttl != 0 or record.type_ in META_TYPES
+            else:
+                malformed = True
+            if malformed:
+                raise UpdateError(RCode.FormErr, "malformed update {} {} {}"
+                                  .format(record.name, record.class_,
+                                          record.type_))
+
+    def apply(self, updates):
+        """Apply the update section to the copied record sets
+
+        See section 3.4.2 of RFC 2136: a CNAME record is not added to a name
+        with other records and the other way around, an SOA record only if
+        its serial is newer, and the SOA record and the last NS record of
+        the zone are never deleted.
+        """
+        for record in updates:
+            records = self.record_set(record.name)
+            apex = self.is_apex(record.name)
+            if record.class_ == Class.IN:
+                self.add(records, record, apex)
+            elif record.class_ == Class.ANY:
+                if record.type_ == Type.ANY:
+                    keep = (Type.SOA, Type.NS) if apex else ()
+                    records[:] = [r for r in records if r.type_ in keep]
+                elif not apex or record.type_ not in (Type.SOA, Type.NS):
+                    records[:] = [r for r in records
+                                  if r.type_ != record.type_]
+            elif record.type_ != Type.SOA:
+                if (apex and record.type_ == Type.NS and
+                        sum(r.type_ == Type.NS for r in records) <= 1):
+                    continue
+                data = rdata_bytes(record)
+                records[:] = [r for r in records
+                              if r.type_ != record.type_ or
+                              rdata_bytes(r) != data]
+
+    @staticmethod
+    def add(records, record, apex):
+        """Add a record to a copied record set, see apply"""
+        if record.type_ == Type.SOA:
+            soas = [r for r in records if r.type_ == Type.SOA]
+            if apex and soas and serial_newer(record.rdata.serial,
+                                              soas[0].rdata.serial):
+                records[records.index(soas[0])] = record
+            return
+        cnames = any(r.type_ == Type.CNAME for r in records)
+        others = any(r.type_ != Type.CNAME for r in records)
+        if record.type_ == Type.CNAME:
+            if others:
+                return
+            records[:] = [record]
+            return
+        if cnames:
+            return
+        data = rdata_bytes(record)
+        for i, r in enumerate(records):
+            if r.type_ == record.type_ and rdata_bytes(r) == data:
+                records[i] = record
+                return
+        records.append(record)
+
+    def changes(self):
+        """The records deleted from and added to the zone by the update
+
+        Returns:
+            ([ResourceRecord], [ResourceRecord]): deleted and added records
+        """
+        deleted, added = [], []
+        for name, records in self.sets.values():
+            old = {r.to_bytes(0, None): r for r in self.records(name)}
+            new = {r.to_bytes(0, None): r for r in records}
+            deleted.extend(r for data, r in old.items() if data not in new)
+            added.extend(r for data, r in new.items() if data not in old)
+        return deleted, added
+
+    def commit(self):
+        """Apply the changes to the zone
+
+        Unless the update changed the serial itself, the serial of the SOA
+        record is incremented. The change is added to the history and the
+        journal of the zone.
+
+        Returns:
+            bool: whether the zone changed
+        """
+        deleted, added = self.changes()
+        if not deleted and not added:
+            return False
+        old_soa = self.zone.soa()
+        new_soa = next((r for r in added if r.type_ == Type.SOA), None)
+        if new_soa is None:
+            rdata = old_soa.rdata
+            new_soa = ResourceRecord(
+                old_soa.name, old_soa.type_, old_soa.class_, old_soa.ttl,
+                SOARecordData(rdata.mname, rdata.rname,
+                              (rdata.serial + 1) % 2 ** 32, rdata.refresh,
+                              rdata.retry, rdata.expire, rdata.minimum))
+            deleted.append(old_soa)
+            added.append(new_soa)
+        apply_changes(self.zone, deleted, added)
+        self.zone.history.add(
+            old_soa, [r for r in deleted if r.type_ != Type.SOA],
+            new_soa, [r for r in added if r.type_ != Type.SOA])
+        append_journal(self.zone, old_soa, deleted, new_soa, added)
+        return True
+
+
+def update_zone(zone, message):
+    """Apply an UPDATE message to a zone
+
+    The prerequisites are checked and the update section is checked before
+    anything is changed, so an update is applied completely or not at all.
+    Updates of one zone must not run concurrently.
+
+    Args:
+        zone (Zone): the zone named in the zone section, with an SOA record
+        message (Message): the UPDATE message
+
+    Returns:
+        bool: whether the zone changed
+
+    Raises:
+        UpdateError: if the update is not applied
+    """
+    update = Update(zone)
+    update.check_prerequisites(message.answers)
+    update.prescan(message.authorities)
+    update.apply(message.authorities)
+    return update.commit()
@@ -3,23 +3,59 @@
 """Zones of domain name space
 
 See section 6.1.2 of RFC 1035 and section 4.2 of RFC 1034.
-Instead of tree structures we simply use dictionaries from domain names to
-zones or record sets.
+A zone keeps its record sets in a dictionary from domain names and in a tree
+of labels, see Zone.find. A compiled zone image is answered from directly,
+see MappedZone. A catalog finds the zone of a name among many zones. Zones
+keep their last changes for incremental zone transfers, see History.
 
 These classes are merely a suggestion, feel free to use something else.
 """
 
+from dns.name import Name
 from dns.resource import *
 from dns.types import Type
 from dns.classes import Class
+from dns.masterfile import parse_master_file
+import collections
+import itertools
 import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import zlib
+
+# Versions of zones, a zone gets a new one whenever it changes
+versions = itertools.count(1)
+
+# Limits of the changes a zone keeps for IXFR, see History
+HISTORY_CHANGES = 100
+HISTORY_RECORDS = 100000
+
+# The journal of dynamic updates of a master file is filename + JOURNAL_SUFFIX
+JOURNAL_SUFFIX = ".journal"
 
 class Catalog:
-    """A catalog of zones"""
+    """A catalog of zones
+
+    Besides the zones dictionary the catalog maps the lowercased wire format
+    of the name of every zone to the zone. The zone of a name is found by
+    looking up the name and then its ancestors, the longest match wins, so
+    the cost depends on the number of labels of the name and not on the
+    number of zones.
+
+    The version of the catalog changes whenever a zone is added or one of
+    its zones changes, its shape only when a zone is added or names are
+    added to or removed from one of its zones (so the node a name is
+    answered from may have changed).
+    """
 
     def __init__(self):
         """Initialize the catalog"""
         self.zones = {}
+        self.wire = {}
+        self.version = self.shape = next(versions)
 
     def add_zone(self, name, zone):
         """Add a new zone to the catalog
@@ -29,58 +65,916 @@ class Catalog:
             zone (Zone): zone
         """
         self.zones[name] = zone
+        self.wire[Name(name).to_bytes(0).lower()] = zone
+        zone.catalog = self
+        self.version = self.shape = next(versions)
+
+    def zone(self, key):
+        """The zone of a name in lowercased wire format, or None"""
+        wire = self.wire
+        start = 0
+        while True:
+            zone = wire.get(key[start:])
+            if zone is not None:
+                return zone
+            if not key[start]:
+                return None
+            start += key[start] + 1
+
+    def find_zone(self, name):
+        """The zone a name belongs to, or None
+
+        Args:
+            name (Name or str): domain name
+        """
+        if not isinstance(name, Name):
+            name = Name(name)
+        return self.zone(name.to_bytes(0).lower())
+
+
+class History:
+    """The last changes of a zone, for incremental zone transfers
+
+    See RFC 1995. Every change is kept as (old SOA, deleted records, new
+    SOA, added records), oldest first. The oldest changes are dropped when
+    there are more than max_changes changes or they hold more than
+    max_records records together, a client with an older serial then gets
+    the full zone.
+    """
+
+    def __init__(self, max_changes=HISTORY_CHANGES,
+                 max_records=HISTORY_RECORDS):
+        """Initialize the history
+
+        Args:
+            max_changes (int): maximum number of changes kept
+            max_records (int): maximum number of records in the changes
+        """
+        self.max_changes = max_changes
+        self.max_records = max_records
+        self.changes = collections.deque()
+        self.records = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.changes)
+
+    def copy(self):
+        """A history with the same changes"""
+        history = History(self.max_changes, self.max_records)
+        with self.lock:
+            history.changes.extend(self.changes)
+            history.records = self.records
+        return history
+
+    def add(self, old_soa, deleted, new_soa, added):
+        """Add a change
+
+        Args:
+            old_soa (ResourceRecord): SOA record before the change
+            deleted ([ResourceRecord]): records deleted, except the SOA
+            new_soa (ResourceRecord): SOA record after the change
+            added ([ResourceRecord]): records added, except the SOA
+        """
+        with self.lock:
+            self.changes.append((old_soa, deleted, new_soa, added))
+            self.records += len(deleted) + len(added)
+            while self.changes and (len(self.changes) > self.max_changes or
+                                    self.records > self.max_records):
+                _, deleted, _, added = self.changes.popleft()
+                self.records -= len(deleted) + len(added)
+
+    def since(self, serial):
+        """The changes from the version with serial to the newest version
+
+        Returns:
+            [(ResourceRecord, [ResourceRecord], ResourceRecord,
+              [ResourceRecord])]: the changes, or None if the history does
+                not go back to serial
+        """
+        with self.lock:
+            changes = list(self.changes)
+        for i, (old_soa, _, _, _) in enumerate(changes):
+            if old_soa.rdata.serial == serial:
+                return changes[i:]
+        return None
+
+
+class Node:
+    """A node in the label tree of a Zone
+
+    The children are keyed by their lowercased label. A node without records
+    only connects the nodes below it. The glue and the encoded answers of a
+    node are kept with the version of the node they were made for, see
+    Zone.touch.
+    """
+
+    __slots__ = ("name", "children", "records", "glue", "templates",
+                 "version")
+
+    def __init__(self):
+        self.name = None
+        self.children = None
+        self.records = None
+        self.glue = None
+        self.templates = None
+        self.version = 0
+
+
+def tree_labels(name):
+    """The lowercased labels of a name from the root down
+
+    Args:
+        name (Name or str): domain name
+    """
+    if not isinstance(name, Name):
+        name = Name(name)
+    return [label.lower() for label in reversed(name.labels) if label]
 
 
 class Zone:
-    """A zone in the domain name space"""
+    """A zone in the domain name space
+
+    Besides the records dictionary the zone keeps a tree of Nodes with one
+    level per label, starting at the root label, so finding the closest
+    node of a name takes one walk down the tree without building strings.
+
+    The answer for every node is encoded once (see template), responses are
+    made by concatenating a header, the question and the encoded sections.
+    The wire dictionary maps the lowercased wire format of every name to its
+    node, to find nodes without decoding the question. The referrers
+    dictionary maps the lowercased wire format of name servers to the
+    nodes with NS records for them, whose glue changes with them.
+    """
 
     def __init__(self):
         """Initialize the Zone """
         self.records = {}
+        self.root = Node()
+        self.wire = {}
+        self.referrers = {}
+        self.catalog = None
+        self.filename = None
+        self.history = History()
+        self.version = next(versions)
+
+    def changed(self, shape=False):
+        """Give the zone, and the catalog it is in, a new version
+
+        Args:
+            shape (bool): names were added or removed, see Catalog
+        """
+        self.version = next(versions)
+        if self.catalog is not None:
+            self.catalog.version = self.version
+            if shape:
+                self.catalog.shape = self.version
+
+    def touch(self, node, key, shape=False):
+        """Record that the records of a node changed
+
+        The node, and the nodes which have it as glue, get a new version,
+        so their answers are encoded again on first use.
+
+        Args:
+            node (Node): the node
+            key (bytes): lowercased wire format of the name of the node
+            shape (bool): the node was added or removed, see changed
+        """
+        node.version = next(versions)
+        for referrer in self.referrers.get(key, ()):
+            referrer.version = next(versions)
+        self.changed(shape)
+
+    def node_version(self, node):
+        """The version of a node, see touch"""
+        return node.version
 
     def add_node(self, name, record_set):
         """Add a record set to the zone
 
         Args:
-            name (str): domain name
+            name (str or Name): domain name
             record_set ([ResourceRecord]): resource records
         """
-        self.records[name] = record_set
+        if not isinstance(name, Name):
+            name = Name(name)
+        node = self.root
+        for label in tree_labels(name):
+            if node.children is None:
+                node.children = {}
+            child = node.children.get(label)
+            if child is None:
+                child = node.children[label] = Node()
+            node = child
+        added = node.records is None
+        if not added:
+            self.records.pop(str(node.name), None)
+        self.records[str(name)] = record_set
+        node.name = name
+        node.records = record_set
+        key = name.to_bytes(0).lower()
+        self.wire[key] = node
+        self.touch(node, key, added)
+
+    def remove_node(self, name):
+        """Remove the record set of a name from the zone
+
+        Args:
+            name (str or Name): domain name
+        """
+        exact, node = self.walk(name)
+        if not exact or node is None:
+            return
+        key = node.name.to_bytes(0).lower()
+        self.records.pop(str(node.name), None)
+        self.wire.pop(key, None)
+        node.records = None
+        self.touch(node, key, True)
+
+    def add_record(self, record):
+        """Add a record to the record set of its owner name
+
+        Args:
+            record (ResourceRecord): the record
+        """
+        exact, node = self.walk(record.name)
+        if exact and node is not None:
+            node.records.append(record)
+            self.touch(node, node.name.to_bytes(0).lower())
+        else:
+            self.add_node(record.name, [record])
+
+    def find(self, name):
+        """Find the node of a name, or else its closest enclosing node
+
+        Names are compared case-insensitively.
+
+        Args:
+            name (Name or str): domain name
+
+        Returns:
+            (bool, [ResourceRecord], [ResourceRecord]): whether the node has
+                the name itself, the records of the node and its glue (see
+                glue). (False, [], []) if the zone has no node for the name
+                or an ancestor.
+        """
+        exact, node = self.walk(name)
+        if node is None:
+            return False, [], []
+        return exact, node.records, self.glue(node)
+
+    def walk(self, name):
+        """Walk down the tree to the closest node of a name, see find
+
+        Returns:
+            (bool, Node): whether the node has the name itself, and the node
+                (None if there is none)
+        """
+        if not isinstance(name, Name):
+            name = Name(name)
+        labels = name.labels
+        if labels == [""]:
+            labels = []
+        node = self.root
+        closest = node if node.records is not None else None
+        depth = found = 0
+        for label in reversed(labels):
+            children = node.children
+            if children is None:
+                break
+            node = children.get(label)
+            if node is None:
+                # Most names are asked in lowercase, try that first
+                node = children.get(label.lower())
+                if node is None:
+                    break
+            depth += 1
+            if node.records is not None:
+                closest = node
+                found = depth
+        return found == len(labels), closest
+
+    def record_sets(self):
+        """Iterate over the record sets of the nodes, from the root down
+
+        Every node comes before the nodes below it, and nodes with the same
+        parent are ordered by their lowercased label.
+        """
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node.records:
+                yield node.records
+            if node.children:
+                stack.extend(node.children[label] for label in
+                             sorted(node.children, reverse=True))
+
+    def soa(self):
+        """The SOA record of the zone, or None if it has none"""
+        exact, records, _ = self.find(self.origin())
+        for record in records if exact else []:
+            if record.type_ == Type.SOA:
+                return record
+        return None
+
+    def origin(self):
+        """The name of the zone
+
+        Returns:
+            Name: the owner of the SOA record at the top of the zone, or the
+                root if there is none
+        """
+        node = self.root
+        while node.records is None and node.children and \
+                len(node.children) == 1:
+            node = next(iter(node.children.values()))
+        if node.records and any(r.type_ == Type.SOA for r in node.records):
+            return node.name
+        return Name(".")
+
+    def glue(self, node):
+        """The glue of the NS records of a node
+
+        The glue of an NS record is the first A record of its name server,
+        if the name server has a node in the zone.
+        """
+        if node.glue is not None and node.glue[0] == node.version:
+            return node.glue[1]
+        glue = []
+        for record in node.records:
+            if record.type_ == Type.NS:
+                key = record.rdata.nsdname.to_bytes(0).lower()
+                self.referrers.setdefault(key, set()).add(node)
+                exact, server = self.walk(record.rdata.nsdname)
+                addresses = [r for r in server.records
+                             if r.type_ == Type.A] if exact else []
+                if addresses:
+                    glue.append(addresses[0])
+        node.glue = (node.version, glue)
+        return glue
+
+    @staticmethod
+    def sections(exact, records, glue):
+        """The sections of the answer from a node
+
+        Args:
+            exact (bool): the node has the name asked for, it is not an
+                enclosing node
+            records ([ResourceRecord]): the records of the node
+            glue ([ResourceRecord]): the glue of the node, see find
+
+        Returns:
+            ([ResourceRecord], [ResourceRecord], [ResourceRecord]):
+                (answers, authorities, additionals)
+        """
+        answers = []
+        authorities = []
+        for r in records:
+            if r.type_ == Type.A and exact:
+                answers.append(r)
+            if r.type_ == Type.NS:
+                authorities.append(r)
+        return answers, authorities, list(glue)
+
+    def template(self, node, exact):
+        """The encoded answer from a node
+
+        Records owned by the name asked for are compressed against the
+        question, which follows the 12-byte header. Other names are not
+        compressed, as their offset in the response is not known.
+
+        Args:
+            node (Node): a node with records
+            exact (bool): the node has the name asked for, see sections
+
+        Returns:
+            (bytes, bytes): the answer, authority and additional counts
+                and the records, or None if the answer is empty
+        """
+        templates = node.templates
+        if templates is None or templates[0] != node.version:
+            templates = node.templates = (node.version,
+                                          self.encode(node, True),
+                                          self.encode(node, False))
+        return templates[1] if exact else templates[2]
 
-    def read_master_file(self, filename):
+    def encode(self, node, exact):
+        """Encode the answer from a node, see template"""
+        answers, authorities, additionals = self.sections(
+            exact, node.records, self.glue(node))
+        if answers == [] and authorities == [] and additionals == []:
+            return None
+        compress = {}
+        offset = 12 + len(node.name.to_bytes(12, compress)) + 4
+        if not exact:
+            compress = None
+        records = b""
+        for record in answers + authorities + additionals:
+            records += record.to_bytes(offset + len(records), compress)
+        return (struct.pack("!HHH", len(answers), len(authorities),
+                            len(additionals)), records)
+
+    def node(self, key):
+        """The node of a name in lowercased wire format, or None"""
+        return self.wire.get(key)
+
+    def compile(self):
+        """Encode the answers from all nodes now instead of on first use"""
+        for node in list(self.wire.values()):
+            self.template(node, True)
+
+    def read_master_file(self, filename, origin=None):
         """Read the zone from a master file
 
-        See section 5 of RFC 1035.
+        See section 5 of RFC 1035 and dns.masterfile. The records are added
+        as they are parsed.
 
         Args:
             filename (str): the filename of the master file
+            origin (str): origin of relative names until $ORIGIN
+
+        Raises:
+            MasterFileError: if the master file contains an error
         """
         with open(filename) as file:
-            lines = file.readlines()
-        dct = {}
-        for line in lines:
-            if line[0] != ";":
-                data = line.split()
-                if data[2] == 'NS':
-                    t  = Type.NS
-                    rdata = NSRecordData(Name(data[3]))
-                elif data[2] == 'A':
-                    t  = Type.A
-                    rdata = ARecordData(data[3])
-
-                elif data[2] == 'CNAME':
-                    t  = Type.CNAME
-                    rdata = CNAMERecordData(Name(data[3]))
-                else:
-                    continue
-                RR = ResourceRecord(Name(data[0]), t, Class.IN, int(data[1]), rdata)
-                if data[0] in dct.keys() :
-                    dct[data[0]].append(RR)
-                else:
-                    dct[data[0]] = [RR]
-        
-        for key, value in dct.items():
-            self.add_node(key, value)
-
-                
-            
+            for record in parse_master_file(file, origin, filename):
+                self.add_record(record)
+        self.filename = filename
+        self.compile()
+
+
+def encode_records(records):
+    """Encode records in uncompressed wire format, preceded by their count"""
+    data = struct.pack("!H", len(records))
+    for record in records:
+        data += record.to_bytes(0, None)
+    return data
+
+
+def decode_records(buf, offset):
+    """Decode records encoded by encode_records"""
+    count = struct.unpack_from("!H", buf, offset)[0]
+    offset += 2
+    records = []
+    for _ in range(count):
+        record, offset = ResourceRecord.from_bytes(buf, offset)
+        records.append(record)
+    return records
+
+
+class MappedZone:
+    """A zone answered from a memory-mapped zone image
+
+    The image is made from a Zone by write (see the compile-zone command of
+    dns_zone.py). It starts with a header (magic, number of names, number of
+    slots) followed by an open addressing hash table of slots (crc32 of the
+    name, offset, length) and the entries, ordered by name from the root
+    down. Every entry holds the lowercased wire format of its name, the
+    records and glue of the node in uncompressed wire format and the encoded
+    answers of Zone.template, an empty answer has length 0.
+
+    Opening an image only maps the file: loading takes the same time for a
+    zone of any size, only the pages of the names asked for become
+    resident, and worker processes mapping the same image share its pages.
+    The nodes of a mapped zone are the offsets of their entries.
+    """
+
+    MAGIC = b"DNSZONE1"
+    HEADER = struct.Struct("!8sII")
+    SLOT = struct.Struct("!III")
+    ENTRY = struct.Struct("!HIIII")
+
+    # Answers are taken from the same sections as those of a Zone
+    sections = staticmethod(Zone.sections)
+    soa = Zone.soa
+
+    def __init__(self, file_, buf):
+        """Initialize the zone, use MappedZone.open instead
+
+        Args:
+            file_ (file): the open zone image
+            buf (mmap): the mapped zone image
+        """
+        self.file = file_
+        self.buf = buf
+        _, self.count, self.slots = self.HEADER.unpack_from(buf, 0)
+        self.catalog = None
+        self.filename = file_.name
+        self.history = History()
+        self.version = next(versions)
+
+    def __len__(self):
+        return self.count
+
+    @classmethod
+    def open(cls, filename):
+        """Map a zone image
+
+        Returns:
+            MappedZone: the zone, or None if filename is not a zone image
+        """
+        file_ = open(filename, "rb")
+        try:
+            if file_.read(len(cls.MAGIC)) != cls.MAGIC:
+                file_.close()
+                return None
+            buf = mmap.mmap(file_.fileno(), 0, access=mmap.ACCESS_READ)
+        except:
+            file_.close()
+            raise
+        return cls(file_, buf)
+
+    def close(self):
+        self.buf.close()
+        self.file.close()
+
+    def node_version(self, node):
+        """The version of a node, the nodes of an image never change"""
+        return 0
+
+    def node(self, key):
+        """The entry offset of a name in lowercased wire format, or None"""
+        buf = self.buf
+        slots = self.slots
+        unpack_slot = self.SLOT.unpack_from
+        table = self.HEADER.size
+        size = self.SLOT.size
+        hash_ = zlib.crc32(key)
+        i = hash_ % slots
+        while True:
+            slot_hash, offset, _ = unpack_slot(buf, table + i * size)
+            if not offset:
+                return None
+            if slot_hash == hash_:
+                start = offset + self.ENTRY.size
+                if buf[start:start + len(key)] == key and \
+                        buf[offset] << 8 | buf[offset + 1] == len(key):
+                    return offset
+            i = (i + 1) % slots
+
+    def walk(self, name):
+        """Find the closest node of a name, see Zone.walk
+
+        The wire format of the name and then those of its ancestors are
+        looked up until a node is found.
+
+        Returns:
+            (bool, int): whether the node has the name itself, and the node
+                (None if there is none)
+        """
+        if not isinstance(name, Name):
+            name = Name(name)
+        key = name.to_bytes(0).lower()
+        start = 0
+        while True:
+            node = self.node(key[start:])
+            if node is not None:
+                return start == 0, node
+            if not key[start]:
+                return False, None
+            start += key[start] + 1
+
+    def find(self, name):
+        """Find the node of a name, see Zone.find"""
+        exact, node = self.walk(name)
+        if node is None:
+            return False, [], []
+        return exact, self.records(node), self.glue(node)
+
+    def fields(self, node):
+        """The offsets of the records, glue and answers of an entry"""
+        keylen, *lengths = self.ENTRY.unpack_from(self.buf, node)
+        offset = node + self.ENTRY.size + keylen
+        fields = []
+        for length in lengths:
+            fields.append((offset, length))
+            offset += length
+        return fields
+
+    def records(self, node):
+        """The records of a node"""
+        return decode_records(self.buf, self.fields(node)[0][0])
+
+    def glue(self, node):
+        """The glue of a node, see Zone.glue"""
+        return decode_records(self.buf, self.fields(node)[1][0])
+
+    def template(self, node, exact):
+        """The encoded answer from a node, see Zone.template"""
+        keylen, records, glue, answer, referral = self.ENTRY.unpack_from(
+            self.buf, node)
+        offset = node + self.ENTRY.size + keylen + records + glue
+        if exact:
+            length = answer
+        else:
+            offset += answer
+            length = referral
+        if not length:
+            return None
+        return (self.buf[offset:offset + 6],
+                self.buf[offset + 6:offset + length])
+
+    def origin(self):
+        """The name of the zone, see Zone.origin
+
+        The names are ordered from the root down, so the top of the zone is
+        the first entry.
+        """
+        for name, node in self.names():
+            if any(r.type_ == Type.SOA for r in self.records(node)):
+                return name
+            break
+        return Name(".")
+
+    def record_sets(self):
+        """Iterate over the record sets of the nodes, see Zone.record_sets"""
+        for _, node in self.names():
+            yield self.records(node)
+
+    def names(self):
+        """Iterate over the names of the zone, from the root down"""
+        offset = self.HEADER.size + self.slots * self.SLOT.size
+        for _ in range(self.count):
+            yield Name.from_bytes(self.buf, offset + self.ENTRY.size)[0], offset
+            offset += self.ENTRY.size + sum(
+                self.ENTRY.unpack_from(self.buf, offset))
+
+    @classmethod
+    def write(cls, filename, zone):
+        """Write the image of a zone
+
+        The image is written to a temporary file which then replaces
+        filename, so servers which still map the old image keep reading it.
+
+        Args:
+            filename (str): the file written
+            zone (Zone): the zone
+        """
+        nodes = sorted(zone.wire.items(),
+                       key=lambda item: tree_labels(item[1].name))
+        slots = max(2 * len(nodes), 1)
+        table = [(0, 0, 0)] * slots
+        offset = cls.HEADER.size + slots * cls.SLOT.size
+        entries = []
+        for key, node in nodes:
+            fields = [encode_records(node.records),
+                      encode_records(zone.glue(node))]
+            for exact in (True, False):
+                template = zone.template(node, exact)
+                fields.append(b"".join(template) if template else b"")
+            entry = (cls.ENTRY.pack(len(key), *map(len, fields)) + key +
+                     b"".join(fields))
+            hash_ = zlib.crc32(key)
+            i = hash_ % slots
+            while table[i][1]:
+                i = (i + 1) % slots
+            table[i] = (hash_, offset, len(entry))
+            offset += len(entry)
+            entries.append(entry)
+
+        fd, temp = tempfile.mkstemp(prefix=os.path.basename(filename) + ".",
+                                    dir=os.path.dirname(filename) or ".")
+        try:
+            with os.fdopen(fd, "wb") as file_:
+                file_.write(cls.HEADER.pack(cls.MAGIC, len(entries), slots))
+                file_.write(b"".join(cls.SLOT.pack(*slot) for slot in table))
+                for entry in entries:
+                    file_.write(entry)
+            os.replace(temp, filename)
+        except:
+            os.unlink(temp)
+            raise
+
+
+def load_zone(filename, origin=None):
+    """Load a zone from a zone image or a master file
+
+    Args:
+        filename (str): a zone image (see MappedZone) or master file
+        origin (str): origin of relative names in a master file
+
+    The changes in the journal of a master file are applied to its zone,
+    see replay_journal.
+
+    Returns:
+        MappedZone or Zone: the zone
+    """
+    zone = MappedZone.open(filename)
+    if zone is None:
+        zone = Zone()
+        zone.read_master_file(filename, origin)
+        replay_journal(zone)
+    return zone
+
+
+def zone_filenames(paths):
+    """The zone files of paths
+
+    Args:
+        paths ([str]): files, and directories of which all files are zone
+            files (except hidden files and journals)
+
+    Returns:
+        [str]: the filenames, those in a directory in sorted order
+    """
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            filenames.extend(os.path.join(path, name)
+                             for name in sorted(os.listdir(path))
+                             if not name.startswith(".") and
+                             not name.endswith(JOURNAL_SUFFIX) and
+                             os.path.isfile(os.path.join(path, name)))
+        else:
+            filenames.append(path)
+    return filenames
+
+
+def load_catalog(paths):
+    """Load zone files into a catalog
+
+    Every file is loaded with load_zone and added under its origin (see
+    Zone.origin).
+
+    Args:
+        paths ([str]): zone files and directories of zone files, see
+            zone_filenames
+
+    Returns:
+        Catalog: the catalog
+
+    Raises:
+        ValueError: if two files hold a zone with the same name
+    """
+    catalog = Catalog()
+    loaded = {}
+    for filename in zone_filenames(paths):
+        zone = load_zone(filename)
+        name = str(zone.origin())
+        if name in loaded:
+            raise ValueError("{} and {} both hold zone {}".format(
+                loaded[name], filename, name))
+        loaded[name] = filename
+        catalog.add_zone(name, zone)
+    return catalog
+
+
+def record_changes(old, new):
+    """The records deleted and added between two versions of a zone
+
+    Records are compared in uncompressed wire format, SOA records are left
+    out (see History.add).
+
+    Args:
+        old (Zone or MappedZone): the old version
+        new (Zone or MappedZone): the new version
+
+    Returns:
+        ([ResourceRecord], [ResourceRecord]): deleted and added records
+    """
+    def encoded(zone):
+        return {record.to_bytes(0, None): record
+                for records in zone.record_sets() for record in records
+                if record.type_ != Type.SOA}
+
+    old_records = encoded(old)
+    new_records = encoded(new)
+    deleted = [record for data, record in old_records.items()
+               if data not in new_records]
+    added = [record for data, record in new_records.items()
+             if data not in old_records]
+    return deleted, added
+
+
+def apply_changes(zone, deleted, added):
+    """Delete and add records, changing only the nodes of their names
+
+    The record sets of the nodes are replaced instead of changed in place,
+    so requests answered from them while the zone changes see either the
+    old or the new records. Records are compared in uncompressed wire
+    format, a node without records left is removed.
+
+    Args:
+        zone (Zone): the zone
+        deleted ([ResourceRecord]): records to delete
+        added ([ResourceRecord]): records to add
+    """
+    changes = {}
+    for record in deleted:
+        key = record.name.to_bytes(0).lower()
+        changes.setdefault(key, (record.name, [], []))[1].append(record)
+    for record in added:
+        key = record.name.to_bytes(0).lower()
+        changes.setdefault(key, (record.name, [], []))[2].append(record)
+    for name, drop, add in changes.values():
+        exact, node = zone.walk(name)
+        if exact and node is not None:
+            name, records = node.name, node.records
+        else:
+            records = []
+        gone = {record.to_bytes(0, None) for record in drop}
+        records = [record for record in records
+                   if record.to_bytes(0, None) not in gone] + add
+        if records:
+            zone.add_node(name, records)
+        elif exact and node is not None:
+            zone.remove_node(name)
+
+
+def append_journal(zone, old_soa, deleted, new_soa, added):
+    """Append a change of a zone to the journal of its master file
+
+    The journal is filename.journal, every line is a JSON object with the
+    old and new serial and the deleted and added records (including the
+    SOA records) in uncompressed wire format as hex. Nothing is written for
+    a zone without a master file.
+    """
+    if zone.filename is None:
+        return
+    entry = {"serial": [old_soa.rdata.serial, new_soa.rdata.serial],
+             "delete": [record.to_bytes(0, None).hex() for record in deleted],
+             "add": [record.to_bytes(0, None).hex() for record in added]}
+    with open(zone.filename + JOURNAL_SUFFIX, "a") as file_:
+        file_.write(json.dumps(entry) + "\n")
+
+
+def replay_journal(zone):
+    """Apply the changes in the journal of a zone, see append_journal
+
+    A change is only applied if the zone has its old serial, so a journal
+    is ignored once the master file has been edited and its serial
+    increased. The changes applied are added to the history of the zone.
+
+    Returns:
+        int: the number of changes applied
+    """
+    try:
+        file_ = open(zone.filename + JOURNAL_SUFFIX)
+    except (OSError, TypeError):
+        return 0
+    applied = 0
+    with file_:
+        for line in file_:
+            try:
+                entry = json.loads(line)
+                serial = entry["serial"][0]
+                deleted, added = [
+                    [ResourceRecord.from_bytes(bytes.fromhex(data), 0)[0]
+                     for data in entry[field]] for field in ("delete", "add")]
+            except (ValueError, KeyError, IndexError, TypeError,
+                    struct.error):
+                break
+            old_soa = zone.soa()
+            if old_soa is None or old_soa.rdata.serial != serial:
+                continue
+            apply_changes(zone, deleted, added)
+            zone.history.add(
+                old_soa, [r for r in deleted if r.type_ != Type.SOA],
+                zone.soa(), [r for r in added if r.type_ != Type.SOA])
+            applied += 1
+    return applied
+
+
+def transfer_records(zone, serial=None):
+    """The records of a zone transfer
+
+    A full transfer (AXFR, RFC 5936) is the SOA record, all other records
+    and the SOA record again. An incremental transfer (IXFR, RFC 1995) from
+    serial is just the SOA record if serial is current, or else the SOA
+    record, the changes since serial (every change is the old SOA record,
+    the deleted records, the new SOA record and the added records) and the
+    SOA record again. If the history of the zone does not go back to
+    serial the full transfer is sent instead.
+
+    Args:
+        zone (Zone or MappedZone): the zone
+        serial (int): serial of the client for IXFR, None for AXFR
+
+    Returns:
+        iterator of ResourceRecord: the records, or None if the zone has
+            no SOA record
+    """
+    soa = zone.soa()
+    if soa is None:
+        return None
+    if serial == soa.rdata.serial:
+        return iter([soa])
+    changes = zone.history.since(serial) if serial is not None else None
+
+    def records():
+        yield soa
+        if changes is None:
+            for record_set in zone.record_sets():
+                for record in record_set:
+                    if record.type_ != Type.SOA:
+                        yield record
+        else:
+            for old_soa, deleted, new_soa, added in changes:
+                yield old_soa
+                yield from deleted
+                yield new_soa
+                yield from added
+        yield soa
+
+    return records()
@@ -0,0 +1,453 @@
+#!/usr/bin/env python3
+
+""" DNS benchmarks
+
+This script contains benchmarks for the resolver, cache and server. Every
+benchmark is a subcommand, run "dns_bench.py <benchmark> -h" for its options.
+"""
+
+
+import json
+import os
+import random
+import socket
+import tempfile
+import time
+from argparse import ArgumentParser
+from threading import Thread
+
+from dns.cache import RecordCache
+from dns.classes import Class
+from dns.message import Message, Header, Question
+from dns.name import Name
+from dns.resource import ResourceRecord, ARecordData, NSRecordData
+from dns.server import Server
+from dns.masterfile import parse_master_file
+from dns.zone import Catalog, Zone, MappedZone, load_zone
+from dns.types import Type
+
+
+def make_query(hostname, ident=0, rd=1):
+    """Encode an A query for hostname"""
+    header = Header(ident, 0, 1, 0, 0, 0)
+    header.rd = rd
+    return Message(header, [Question(Name(hostname), Type.A, Class.IN)]).to_bytes()
+
+
+def bench_udp(args):
+    """Send queries to a running server and report the queries per second
+
+    Every client thread has one socket and one outstanding query at a time.
+    """
+    queries = [make_query(hostname, rd=args.rd) for hostname in args.hostname]
+    answered = [0] * args.clients
+    lost = [0] * args.clients
+
+    def client(n):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(args.timeout)
+        for i in range(args.count):
+            sock.sendto(queries[i % len(queries)], (args.server, args.port))
+            try:
+                sock.recv(65535)
+                answered[n] += 1
+            except socket.timeout:
+                lost[n] += 1
+        sock.close()
+
+    clients = [Thread(target=client, args=(n,)) for n in range(args.clients)]
+    start = time.perf_counter()
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    print("answered: {}, lost: {}, time: {:.3f}s, qps: {:.0f}".format(
+        sum(answered), sum(lost), elapsed, sum(answered) / elapsed))
+
+
+def fill_cache(cache, size):
+    """Add size A records for distinct names to cache"""
+    for i in range(size):
+        cache.add_record(ResourceRecord(
+            Name("host{}.example.com".format(i)), Type.A, Class.IN, 3600,
+            ARecordData("10.{}.{}.{}".format(i >> 16 & 255, i >> 8 & 255,
+                                             i & 255))))
+
+
+def bench_cache(args):
+    """Report the lookup latency of RecordCache at several sizes"""
+    for size in args.size:
+        cache = RecordCache(0, args.max_entries, args.max_bytes, args.policy)
+        start = time.perf_counter()
+        fill_cache(cache, size)
+        fill = time.perf_counter() - start
+
+        names = [Name("host{}.example.com".format(random.randrange(size)))
+                 for _ in range(args.lookups)]
+        start = time.perf_counter()
+        for name in names:
+            cache.lookup(name, Type.A, Class.IN)
+        lookup = time.perf_counter() - start
+
+        print("entries: {:>8}, insert: {:6.2f} us, lookup: {:6.2f} us".format(
+            size, fill / size * 1e6, lookup / args.lookups * 1e6))
+        print("    {}".format(cache.stats()))
+
+
+def bench_startup(args):
+    """Report how long reading the cache file takes at several sizes"""
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "cache")
+        for size in args.size:
+            cache = RecordCache(0, filename=filename)
+            fill_cache(cache, size)
+            cache.compact()
+            if args.json:
+                with open(filename, "w") as file_:
+                    json.dump([record.to_dict()
+                               for _, rrset in cache.rrsets()
+                               for record in rrset], file_)
+
+            cache = RecordCache(0, filename=filename)
+            start = time.perf_counter()
+            cache.read_cache_file()
+            read = time.perf_counter() - start
+
+            name = Name("host{}.example.com".format(random.randrange(size)))
+            start = time.perf_counter()
+            cache.lookup(name, Type.A, Class.IN)
+            first = time.perf_counter() - start
+            cache.close_snapshot()
+
+            print("entries: {:>8}, read: {:9.3f} ms, first lookup: {:7.1f} us"
+                  .format(size, read * 1e3, first * 1e6))
+
+
+def bench_threads(args):
+    """Report the throughput of a shared RecordCache by number of threads
+
+    Every thread does lookups of random names, every tenth operation adds
+    a record instead.
+    """
+    cache = RecordCache(0, shards=args.shards)
+    fill_cache(cache, args.entries)
+    names = [Name("host{}.example.com".format(i)) for i in range(args.entries)]
+
+    def worker(seed):
+        rng = random.Random(seed)
+        for i in range(args.operations):
+            name = names[rng.randrange(args.entries)]
+            if i % 10 == 0:
+                cache.add_record(ResourceRecord(name, Type.A, Class.IN, 3600,
+                                                ARecordData("10.0.0.1")))
+            else:
+                cache.lookup(name, Type.A, Class.IN)
+
+    for count in args.threads:
+        threads = [Thread(target=worker, args=(n,)) for n in range(count)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        print("threads: {:>3}, operations/s: {:.0f}".format(
+            count, count * args.operations / elapsed))
+
+
+def bench_server(args):
+    """Report the requests per second of Server.handle_request
+
+    The requests are answered in-process, without sockets: on the full path,
+    with the packet cache and with the zone fast path. The server reads the
+    zone file in the current directory.
+    """
+    queries = [make_query(hostname, ident, rd=0)
+               for ident, hostname in enumerate(args.hostname)]
+    for mode in ["full path", "packet cache", "fast path"]:
+        packet_cache = args.packet_cache if mode == "packet cache" else 0
+        server = Server(0, False, 0, packet_cache=packet_cache)
+        server.doLogging = False
+        if mode != "fast path":
+            server.fast_response = lambda data, address, found=None: None
+        start = time.perf_counter()
+        for i in range(args.count):
+            server.handle_request(queries[i % len(queries)], None)
+        elapsed = time.perf_counter() - start
+        print("{:>12}, requests/s: {:.0f}".format(mode, args.count / elapsed))
+
+
+def split_join_search(records, name):
+    """Find the closest node of name the way Server.search_zone used to"""
+    tests = str(name).split('.')
+    for i in range(len(tests)):
+        test = '.'.join(tests[i:])
+        if test == '':
+            test = '.'
+        r = records.get(test, None)
+        if r is not None:
+            return test == str(name), r
+    return False, []
+
+
+def split_join_find(records, name):
+    """Find the closest node and its glue the way Server.zone_resolution did"""
+    exact, rlist = split_join_search(records, name)
+    glue = []
+    for r in rlist:
+        if r.type_ == Type.NS:
+            res, a = split_join_search(records, r.rdata.nsdname)
+            if res:
+                glue.append(a[0])
+    return exact, rlist, glue
+
+
+def bench_zone(args):
+    """Report the lookup latency of Zone.find on a large zone
+
+    The zone has size hosts spread over 1000 domains, which are delegated.
+    Half of the lookups are for hosts, half for names below a delegation.
+    The lookups by splitting and joining strings, as Server.search_zone did
+    for the name and its name servers, are timed for comparison.
+    """
+    zone = Zone()
+    start = time.perf_counter()
+    for i in range(1000):
+        domain = "domain{}.example.".format(i)
+        zone.add_node(domain, [ResourceRecord(
+            Name(domain), Type.NS, Class.IN, 3600,
+            NSRecordData(Name("ns." + domain)))])
+        zone.add_node("ns." + domain, [ResourceRecord(
+            Name("ns." + domain), Type.A, Class.IN, 3600,
+            ARecordData("10.0.0.1"))])
+    for i in range(args.size):
+        hostname = "host{}.domain{}.example.".format(i, i % 1000)
+        zone.add_node(hostname, [ResourceRecord(
+            Name(hostname), Type.A, Class.IN, 3600, ARecordData("10.0.0.2"))])
+    build = time.perf_counter() - start
+
+    names = []
+    for i in range(args.lookups):
+        host = random.randrange(args.size)
+        names.append(Name("{}host{}.domain{}.example.".format(
+            "www.sub." if i % 2 else "", host, host % 1000)))
+
+    start = time.perf_counter()
+    for name in names:
+        zone.find(name)
+    find = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for name in names:
+        split_join_find(zone.records, name)
+    split_join = time.perf_counter() - start
+
+    print("names: {}, build: {:.1f} s, find: {:.2f} us, split and join: "
+          "{:.2f} us".format(len(zone.records), build,
+                             find / args.lookups * 1e6,
+                             split_join / args.lookups * 1e6))
+
+
+def write_master_file(filename, size):
+    """Write a master file with size records under 1000 delegated domains"""
+    with open(filename, "w") as file_:
+        file_.write("$ORIGIN example.\n$TTL 3600\n"
+                    "@ IN SOA ns hostmaster ( 1 7200 3600 604800 300 )\n"
+                    "  IN NS ns\nns A 192.0.2.1\n")
+        for i in range(size):
+            if i % 1000 == 0:
+                file_.write("$ORIGIN domain{}.example.\n"
+                            "@ NS ns\nns 600 IN A 10.0.0.1\n".format(i // 1000))
+            file_.write("host{} A 10.{}.{}.{}\n".format(
+                i, i >> 16 & 255, i >> 8 & 255, i & 255))
+
+
+def bench_masterfile(args):
+    """Report how long parsing and loading a master file take
+
+    The time to load the zone is checked against the time budget, which is
+    given per million records.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "zone")
+        write_master_file(filename, args.size)
+
+        start = time.perf_counter()
+        with open(filename) as file_:
+            count = sum(1 for _ in parse_master_file(file_, None, filename))
+        parse = time.perf_counter() - start
+
+        start = time.perf_counter()
+        Zone().read_master_file(filename)
+        load = time.perf_counter() - start
+
+    budget = args.budget * args.size / 1e6
+    print("records: {}, parse: {:.1f} s ({:.0f} records/s), load: {:.1f} s, "
+          "budget: {:.1f} s, {}".format(count, parse, count / parse, load,
+                                        budget,
+                                        "OK" if load <= budget else "OVER"))
+
+
+def bench_image(args):
+    """Report how long opening a zone image takes at several sizes
+
+    Master files of every size are compiled to a zone image, then the time
+    to load the image and to answer the first lookup from it is measured.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        master = os.path.join(directory, "zone")
+        image = os.path.join(directory, "zone.img")
+        for size in args.size:
+            write_master_file(master, size)
+            zone = Zone()
+            zone.read_master_file(master)
+            MappedZone.write(image, zone)
+            del zone
+
+            start = time.perf_counter()
+            zone = load_zone(image)
+            load = time.perf_counter() - start
+
+            i = random.randrange(size)
+            name = Name("host{}.domain{}.example".format(i, i // 1000))
+            start = time.perf_counter()
+            zone.template(zone.walk(name)[1], True)
+            first = time.perf_counter() - start
+            zone.close()
+
+            print("records: {:>8}, image: {:6.1f} MB, load: {:7.3f} ms, "
+                  "first lookup: {:7.1f} us".format(
+                      size, os.path.getsize(image) / 1e6, load * 1e3,
+                      first * 1e6))
+
+
+def bench_catalog(args):
+    """Report the latency of finding the zone of a name in a Catalog
+
+    Every catalog holds the zones zone<i>.example. of its size, the names
+    looked up are hosts three labels below a random zone.
+    """
+    for size in args.size:
+        catalog = Catalog()
+        for i in range(size):
+            catalog.add_zone("zone{}.example.".format(i), Zone())
+        names = [Name("www.host.zone{}.example.".format(random.randrange(size)))
+                 for _ in range(1000)]
+
+        start = time.perf_counter()
+        for i in range(args.lookups):
+            catalog.find_zone(names[i % len(names)])
+        elapsed = time.perf_counter() - start
+        print("zones: {:>8}, find_zone: {:.2f} us".format(
+            size, elapsed / args.lookups * 1e6))
+
+
+def run_benchmarks():
+    parser = ArgumentParser(description="DNS Benchmarks")
+    benchmarks = parser.add_subparsers(dest="benchmark")
+    benchmarks.required = True
+
+    udp = benchmarks.add_parser("udp", help="Load test a running server")
+    udp.add_argument("hostname", nargs="+", help="hostnames to query")
+    udp.add_argument("-s", "--server", default="127.0.0.1",
+                     help="the address of the server")
+    udp.add_argument("-p", "--port", type=int, default=53,
+                     help="the port of the server")
+    udp.add_argument("-n", "--count", type=int, default=1000,
+                     help="queries sent per client")
+    udp.add_argument("--clients", type=int, default=16,
+                     help="number of concurrent clients")
+    udp.add_argument("--timeout", metavar="time", type=float, default=2,
+                     help="time to wait for a response")
+    udp.add_argument("--rd", type=int, choices=[0, 1], default=1,
+                     help="value of the RD flag in the queries")
+    udp.set_defaults(run=bench_udp)
+
+    cache = benchmarks.add_parser("cache", help="RecordCache lookup latency")
+    cache.add_argument("--size", type=int, nargs="+",
+                       default=[1000, 100000, 1000000],
+                       help="numbers of cached entries")
+    cache.add_argument("--lookups", type=int, default=100000,
+                       help="lookups per size")
+    cache.add_argument("--max-entries", metavar="count", type=int, default=0,
+                       help="maximum number of cached RRsets (if > 0)")
+    cache.add_argument("--max-bytes", metavar="size", type=int, default=0,
+                       help="approximate maximum cache size (if > 0)")
+    cache.add_argument("--policy", choices=["lru", "lfu", "arc"],
+                       default="lru", help="cache eviction policy")
+    cache.set_defaults(run=bench_cache)
+
+    startup = benchmarks.add_parser("startup",
+                                    help="Time to read the cache file")
+    startup.add_argument("--size", type=int, nargs="+",
+                         default=[1000, 100000, 1000000],
+                         help="numbers of cached entries")
+    startup.add_argument("--json", action="store_true",
+                         help="use the JSON cache file of older versions")
+    startup.set_defaults(run=bench_startup)
+
+    threads = benchmarks.add_parser("threads",
+                                    help="RecordCache throughput by threads")
+    threads.add_argument("--threads", type=int, nargs="+",
+                         default=[1, 2, 4, 8, 16],
+                         help="numbers of threads")
+    threads.add_argument("--shards", type=int, default=16,
+                         help="number of cache shards")
+    threads.add_argument("--entries", type=int, default=10000,
+                         help="number of cached names")
+    threads.add_argument("--operations", type=int, default=50000,
+                         help="operations per thread")
+    threads.set_defaults(run=bench_threads)
+
+    server = benchmarks.add_parser("server",
+                                   help="Server requests/s of the full path, "
+                                        "packet cache and fast path")
+    server.add_argument("hostname", nargs="*",
+                        default=["ns1.dns.nl.", "ru.nl."],
+                        help="hostnames to query")
+    server.add_argument("-n", "--count", type=int, default=100000,
+                        help="number of requests")
+    server.add_argument("--packet-cache", metavar="count", type=int,
+                        default=10000, help="size of the packet cache")
+    server.set_defaults(run=bench_server)
+
+    zone = benchmarks.add_parser("zone", help="Zone lookup latency")
+    zone.add_argument("--size", type=int, default=1000000,
+                      help="number of hosts in the zone")
+    zone.add_argument("--lookups", type=int, default=100000,
+                      help="number of lookups")
+    zone.set_defaults(run=bench_zone)
+
+    masterfile = benchmarks.add_parser("masterfile",
+                                       help="Time to load a master file")
+    masterfile.add_argument("--size", type=int, default=1000000,
+                            help="number of records in the master file")
+    masterfile.add_argument("--budget", metavar="time", type=float,
+                            default=60,
+                            help="seconds allowed to load a million records")
+    masterfile.set_defaults(run=bench_masterfile)
+
+    image = benchmarks.add_parser("image",
+                                  help="Time to load a compiled zone image")
+    image.add_argument("--size", type=int, nargs="+",
+                       default=[1000, 100000, 1000000],
+                       help="numbers of records in the zone")
+    image.set_defaults(run=bench_image)
+
+    catalog = benchmarks.add_parser("catalog",
+                                    help="Catalog zone lookup latency")
+    catalog.add_argument("--size", type=int, nargs="+",
+                         default=[10, 1000, 100000],
+                         help="numbers of zones in the catalog")
+    catalog.add_argument("--lookups", type=int, default=100000,
+                         help="lookups per size")
+    catalog.set_defaults(run=bench_catalog)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    run_benchmarks()
@@ -23,9 +23,13 @@ def resolve():
                         help="TTL value of cached entries (if > 0)")
     parser.add_argument("-n", "--nameserver", type=str, default="198.41.0.4",
                         help="set nameserver")
+    parser.add_argument("--edns-size", metavar="size", type=int, default=1232,
+                        help="UDP payload size advertised with EDNS (0 "
+                             "disables EDNS)")
     args = parser.parse_args()
 
-    resolver = Resolver(args.timeout, args.caching, args.ttl, args.nameserver)
+    resolver = Resolver(args.timeout, args.caching, args.ttl, args.nameserver,
+                        edns_size=args.edns_size)
     resolver.doLogging = True
     hostname, aliaslist, ipaddrlist = resolver.gethostbyname(args.hostname)
 
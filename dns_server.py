@@ -8,7 +8,7 @@ This script contains the code for starting a DNS server.
 
 from argparse import ArgumentParser
 
-from dns.server import Server
+from dns.server import Server, Supervisor
 
 
 def run_server():
@@ -19,11 +19,62 @@ def run_server():
             help="TTL value of cached entries (if > 0)")
     parser.add_argument("-p", "--port", type=int, default=53,
             help="Port which server listens on")
+    parser.add_argument("--threads", type=int, default=8,
+            help="Number of request handler threads")
+    parser.add_argument("--queue-size", metavar="size", type=int, default=64,
+            help="Maximum number of queued requests (answered with SERVFAIL "
+                 "when exceeded)")
+    parser.add_argument("--engine", choices=["threads", "asyncio"],
+            default="threads",
+            help="Serve requests on a pool of handler threads or on an "
+                 "asyncio event loop")
+    parser.add_argument("--workers", type=int, default=1,
+            help="Number of server processes sharing the port "
+                 "(SO_REUSEPORT)")
+    parser.add_argument("--cache-entries", metavar="count", type=int,
+            default=0, help="Maximum number of cached RRsets (if > 0)")
+    parser.add_argument("--cache-bytes", metavar="size", type=int,
+            default=0, help="Approximate maximum cache size in bytes (if > 0)")
+    parser.add_argument("--cache-policy", choices=["lru", "lfu", "arc"],
+            default="lru", help="Cache eviction policy")
+    parser.add_argument("--cache-shards", metavar="count", type=int,
+            default=16, help="Number of independently locked cache shards")
+    parser.add_argument("--shared-cache", metavar="count", type=int,
+            default=0, help="Share a cache of this many RRsets between the "
+                            "workers (if > 0)")
+    parser.add_argument("--packet-cache", metavar="count", type=int,
+            default=10000, help="Number of encoded responses kept for "
+                                "repeated requests (0 disables)")
+    parser.add_argument("--zone", metavar="file", nargs="+",
+            default=["zone"],
+            help="Master files or zone images (see dns_zone.py "
+                 "compile-zone) of the zones, or directories of them")
+    parser.add_argument("--zone-poll", metavar="time", type=float,
+            default=5, help="Seconds between checks whether the zone file "
+                            "changed, it is then reloaded (0 only reloads "
+                            "on SIGHUP)")
+    parser.add_argument("--allow-update", metavar="network", nargs="+",
+            default=[], help="Networks of the clients allowed to send "
+                             "dynamic updates (RFC 2136) of master file "
+                             "zones, by default updates are refused")
+    parser.add_argument("--edns-size", metavar="size", type=int,
+            default=1232, help="UDP payload size advertised to clients and "
+                               "upstream servers with EDNS (0 disables "
+                               "EDNS)")
     args = parser.parse_args()
+    if args.allow_update and args.workers > 1:
+        parser.error("dynamic updates need a single worker, every worker "
+                     "has its own copy of the zones")
 
-    server = Server(args.port, args.caching, args.ttl)
+    server = Server(args.port, args.caching, args.ttl, args.threads,
+                    args.queue_size, args.cache_entries, args.cache_bytes,
+                    args.cache_policy, args.cache_shards, args.shared_cache,
+                    args.packet_cache, args.zone, args.zone_poll,
+                    args.allow_update, args.edns_size)
+    if args.workers > 1:
+        server = Supervisor(server, args.workers)
     try:
-        server.serve()
+        server.run(args.engine)
     except KeyboardInterrupt:
         server.shutdown()
         print()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+""" DNS zone tools
+
+This script contains commands for zones. The compile-zone command compiles a
+master file to a zone image, which the server maps instead of parsing the
+master file, see dns.zone.MappedZone.
+"""
+
+
+import time
+from argparse import ArgumentParser
+
+from dns.zone import Zone, MappedZone
+
+
+def compile_zone(args):
+    """Compile a master file to a zone image"""
+    start = time.perf_counter()
+    zone = Zone()
+    zone.read_master_file(args.master_file, args.origin)
+    MappedZone.write(args.image, zone)
+    print("{}: {} names in {:.1f} s".format(args.image, len(zone.wire),
+                                           time.perf_counter() - start))
+
+
+def run_command():
+    parser = ArgumentParser(description="DNS zone tools")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    compile_ = commands.add_parser("compile-zone",
+                                   help="Compile a master file to a zone image")
+    compile_.add_argument("master_file", help="the master file")
+    compile_.add_argument("image", help="the zone image written")
+    compile_.add_argument("--origin",
+                          help="origin of relative names until $ORIGIN")
+    compile_.set_defaults(run=compile_zone)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    run_command()
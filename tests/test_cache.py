@@ -0,0 +1,487 @@
+#!/usr/bin/env python3
+
+import json
+import multiprocessing
+import os
+import struct
+import tempfile
+import threading
+import time
+import unittest.mock
+import zlib
+
+from util import DNSTestCase
+
+from dns.cache import (RecordCache, SharedRecordCache, PacketCache, Snapshot,
+                       cache_key, ttl_offsets)
+from dns.classes import Class
+from dns.message import Message, Header, Question
+from dns.name import Name
+from dns.resource import ResourceRecord, ARecordData
+from dns.types import Type
+
+
+def a_record(name, address, ttl=3600):
+    return ResourceRecord(Name(name), Type.A, Class.IN, ttl,
+                          ARecordData(address))
+
+
+class RecordCacheTestCase(DNSTestCase):
+    def setUp(self):
+        self.cache = RecordCache(0)
+
+    def test_cache_key(self):
+        self.assertEqual(cache_key(Name("WWW.Example.com"), Type.A, Class.IN),
+                         ("www.example.com.", Type.A, Class.IN))
+        self.assertEqual(cache_key("www.example.com", Type.A, Class.IN),
+                         cache_key(Name("www.example.com."), Type.A, Class.IN))
+
+    def test_lookup(self):
+        self.cache.add_record(a_record("www.example.com", "1.2.3.4"))
+        self.cache.add_record(a_record("www.example.com", "1.2.3.5"))
+        records = self.cache.lookup(Name("WWW.EXAMPLE.COM"), Type.A, Class.IN)
+        self.assertEqual([r.rdata.address for r in records],
+                         ["1.2.3.4", "1.2.3.5"])
+
+    def test_lookup_type_and_class(self):
+        self.cache.add_record(a_record("example.com", "1.2.3.4"))
+        self.assertEqual(self.cache.lookup(Name("example.com"), Type.NS,
+                                           Class.IN), [])
+        self.assertEqual(self.cache.lookup(Name("example.com"), Type.A,
+                                           Class.CS), [])
+
+    def test_add_duplicate(self):
+        self.cache.add_record(a_record("example.com", "1.2.3.4", 10))
+        self.cache.add_record(a_record("example.com", "1.2.3.4", 20))
+        records = self.cache.lookup(Name("example.com"), Type.A, Class.IN)
+        self.assertEqual(len(records), 1)
+        self.assertGreater(records[0].ttl, time.time() + 15)
+
+    def test_lookup_expired(self):
+        self.cache.add_record(a_record("example.com", "1.2.3.4", -1))
+        self.assertEqual(self.cache.lookup(Name("example.com"), Type.A,
+                                           Class.IN), [])
+        self.assertEqual(len(self.cache), 0)
+
+    def test_expire(self):
+        for i in range(10):
+            self.cache.add_record(a_record("host{}.example.com".format(i),
+                                           "10.0.0.{}".format(i), 10 + i))
+        self.cache.add_record(a_record("host0.example.com", "10.0.1.0", 100))
+        self.cache.expire(time.time() + 15)
+        self.assertEqual(len(self.cache), 5)
+        self.assertEqual(self.cache.stats()["expirations"], 5)
+        records = self.cache.lookup(Name("host0.example.com"), Type.A,
+                                    Class.IN)
+        self.assertEqual([r.rdata.address for r in records], ["10.0.1.0"])
+        self.cache.expire(time.time() + 1000)
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.stats()["bytes"], 0)
+
+
+class EvictionTestCase(DNSTestCase):
+    def lookup(self, cache, name):
+        return cache.lookup(Name(name), Type.A, Class.IN)
+
+    def test_max_entries(self):
+        cache = RecordCache(0, max_entries=2)
+        for i in range(5):
+            cache.add_record(a_record("host{}.example.com".format(i),
+                                      "10.0.0.{}".format(i)))
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.stats()["evictions"], 3)
+
+    def test_max_bytes(self):
+        cache = RecordCache(0, max_bytes=5000)
+        for i in range(100):
+            cache.add_record(a_record("host{}.example.com".format(i),
+                                      "10.0.0.{}".format(i)))
+        self.assertLessEqual(cache.stats()["bytes"], 5000)
+        self.assertGreater(len(cache), 0)
+
+    def test_lru(self):
+        cache = RecordCache(0, max_entries=2, policy="lru")
+        cache.add_record(a_record("a.example.com", "10.0.0.1"))
+        cache.add_record(a_record("b.example.com", "10.0.0.2"))
+        self.lookup(cache, "a.example.com")
+        cache.add_record(a_record("c.example.com", "10.0.0.3"))
+        self.assertEqual(self.lookup(cache, "b.example.com"), [])
+        self.assertNotEqual(self.lookup(cache, "a.example.com"), [])
+
+    def test_lfu(self):
+        cache = RecordCache(0, max_entries=2, policy="lfu")
+        cache.add_record(a_record("a.example.com", "10.0.0.1"))
+        cache.add_record(a_record("b.example.com", "10.0.0.2"))
+        self.lookup(cache, "a.example.com")
+        self.lookup(cache, "a.example.com")
+        self.lookup(cache, "b.example.com")
+        cache.add_record(a_record("c.example.com", "10.0.0.3"))
+        self.assertEqual(self.lookup(cache, "b.example.com"), [])
+        self.assertNotEqual(self.lookup(cache, "a.example.com"), [])
+
+    def test_arc(self):
+        cache = RecordCache(0, max_entries=2, policy="arc")
+        cache.add_record(a_record("a.example.com", "10.0.0.1"))
+        cache.add_record(a_record("b.example.com", "10.0.0.2"))
+        self.lookup(cache, "a.example.com")
+        cache.add_record(a_record("c.example.com", "10.0.0.3"))
+        # b was only seen once, a is frequently used
+        self.assertEqual(self.lookup(cache, "b.example.com"), [])
+        self.assertNotEqual(self.lookup(cache, "a.example.com"), [])
+        # b is remembered as a ghost, adding it again adapts the policy
+        cache.add_record(a_record("b.example.com", "10.0.0.2"))
+        self.assertEqual(cache.shards[0].policy.p, 1)
+        self.assertEqual(len(cache), 2)
+
+    def test_hits_and_misses(self):
+        cache = RecordCache(0)
+        cache.add_record(a_record("a.example.com", "10.0.0.1"))
+        self.lookup(cache, "a.example.com")
+        self.lookup(cache, "b.example.com")
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+
+
+class ShardTestCase(DNSTestCase):
+    def test_shards(self):
+        cache = RecordCache(0, shards=4)
+        for i in range(100):
+            cache.add_record(a_record("host{}.example.com".format(i),
+                                      "10.0.0.1"))
+        self.assertEqual(len(cache), 100)
+        self.assertTrue(all(shard.records for shard in cache.shards))
+        for i in range(100):
+            self.assertEqual(len(cache.lookup(
+                Name("host{}.example.com".format(i)), Type.A, Class.IN)), 1)
+
+    def test_bounds_divided(self):
+        cache = RecordCache(0, max_entries=8, shards=4)
+        self.assertEqual([shard.max_entries for shard in cache.shards],
+                         [2, 2, 2, 2])
+
+    def test_concurrent(self):
+        cache = RecordCache(0, max_entries=50, shards=4)
+        errors = []
+
+        def worker(n):
+            try:
+                for i in range(500):
+                    name = "host{}.example.com".format((n * 7 + i) % 80)
+                    cache.add_record(a_record(name, "10.0.0.{}".format(n)))
+                    cache.lookup(Name(name), Type.A, Class.IN)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(n,))
+                   for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertLessEqual(len(cache), 52)
+
+
+class PersistenceTestCase(DNSTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, "cache")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def journal(self):
+        with open(self.filename + ".journal") as file_:
+            return file_.readlines()
+
+    def test_journal_appends(self):
+        cache = RecordCache(0, filename=self.filename)
+        cache.add_record(a_record("a.example.com", "10.0.0.1"))
+        cache.write_cache_file()
+        cache.add_record(a_record("b.example.com", "10.0.0.2"))
+        cache.write_cache_file()
+        self.assertEqual(len(self.journal()), 2)
+        self.assertFalse(os.path.exists(self.filename))
+
+    def test_replay(self):
+        cache = RecordCache(0, max_entries=1, filename=self.filename)
+        cache.add_record(a_record("a.example.com", "10.0.0.1"))
+        cache.add_record(a_record("b.example.com", "10.0.0.2"))
+        cache.write_cache_file()
+
+        cache = RecordCache(0, filename=self.filename)
+        cache.read_cache_file()
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.lookup(Name("a.example.com"), Type.A,
+                                      Class.IN), [])
+        self.assertEqual(len(cache.lookup(Name("b.example.com"), Type.A,
+                                          Class.IN)), 1)
+
+    def test_compact(self):
+        cache = RecordCache(0, filename=self.filename)
+        cache.compact_after = 3
+        for i in range(4):
+            cache.add_record(a_record("a.example.com", "10.0.0.1", 100 + i))
+            cache.write_cache_file()
+        self.assertEqual(self.journal(), [])
+
+        cache.add_record(a_record("b.example.com", "10.0.0.2"))
+        cache.write_cache_file()
+        self.assertEqual(len(self.journal()), 1)
+
+        cache = RecordCache(0, filename=self.filename)
+        cache.read_cache_file()
+        self.assertEqual(cache.stats()["snapshot"], 1)
+        for name in ["a.example.com", "b.example.com"]:
+            self.assertEqual(len(cache.lookup(Name(name), Type.A, Class.IN)),
+                             1)
+
+    def test_partial_event(self):
+        cache = RecordCache(0, filename=self.filename)
+        cache.add_record(a_record("a.example.com", "10.0.0.1"))
+        cache.write_cache_file()
+        with open(self.filename + ".journal", "a") as file_:
+            file_.write('{"add": {"name"')
+
+        cache = RecordCache(0, filename=self.filename)
+        cache.read_cache_file()
+        self.assertEqual(len(cache), 1)
+
+    def test_snapshot_lazy(self):
+        cache = RecordCache(0, filename=self.filename)
+        cache.add_record(a_record("a.example.com", "10.0.0.1"))
+        cache.add_record(a_record("a.example.com", "10.0.0.2"))
+        cache.add_record(a_record("b.example.com", "10.0.0.3"))
+        cache.compact()
+        with open(self.filename, "rb") as file_:
+            self.assertEqual(file_.read(8), Snapshot.MAGIC)
+
+        cache = RecordCache(0, filename=self.filename)
+        cache.read_cache_file()
+        self.assertEqual(len(cache), 0)
+        records = cache.lookup(Name("A.example.com"), Type.A, Class.IN)
+        self.assertEqual([r.rdata.address for r in records],
+                         ["10.0.0.1", "10.0.0.2"])
+        self.assertEqual(len(cache), 1)
+
+    def test_snapshot_compact_copies_entries(self):
+        cache = RecordCache(0, filename=self.filename)
+        cache.add_record(a_record("a.example.com", "10.0.0.1"))
+        cache.add_record(a_record("b.example.com", "10.0.0.2"))
+        cache.compact()
+
+        cache = RecordCache(0, max_entries=1, filename=self.filename)
+        cache.read_cache_file()
+        cache.add_record(a_record("c.example.com", "10.0.0.3"))
+        cache.add_record(a_record("d.example.com", "10.0.0.4"))
+        cache.write_cache_file()
+        cache.compact()
+
+        cache = RecordCache(0, filename=self.filename)
+        cache.read_cache_file()
+        found = [name for name in "abcd" if cache.lookup(
+            Name(name + ".example.com"), Type.A, Class.IN)]
+        # c was evicted by d, a and b were never touched
+        self.assertEqual(found, ["a", "b", "d"])
+
+    def test_shared_file(self):
+        first = RecordCache(0, filename=self.filename)
+        second = RecordCache(0, filename=self.filename)
+        first.read_cache_file()
+        second.read_cache_file()
+        first.add_record(a_record("a.example.com", "10.0.0.1"))
+        first.write_cache_file()
+        second.add_record(a_record("b.example.com", "10.0.0.2"))
+        second.write_cache_file()
+        first.compact()
+        second.add_record(a_record("c.example.com", "10.0.0.3"))
+        second.write_cache_file()
+        self.assertEqual(len(self.journal()), 1)
+        self.assertEqual(sorted(os.listdir(self.directory.name)),
+                         ["cache", "cache.journal", "cache.lock"])
+
+        cache = RecordCache(0, filename=self.filename)
+        cache.read_cache_file()
+        found = [name for name in "abc" if cache.lookup(
+            Name(name + ".example.com"), Type.A, Class.IN)]
+        self.assertEqual(found, ["a", "b", "c"])
+
+    def test_interleaved_compactions(self):
+        first = RecordCache(0, filename=self.filename)
+        second = RecordCache(0, filename=self.filename)
+        first.read_cache_file()
+        second.read_cache_file()
+        first.add_record(a_record("a.example.com", "10.0.0.1"))
+        first.write_cache_file()
+        second.add_record(a_record("b.example.com", "10.0.0.2"))
+        second.compact()
+        first.add_record(a_record("c.example.com", "10.0.0.3"))
+        first.compact()
+        second.add_record(a_record("d.example.com", "10.0.0.4"))
+        second.compact()
+
+        cache = RecordCache(0, filename=self.filename)
+        cache.read_cache_file()
+        self.assertEqual(cache.stats()["snapshot"], 4)
+        found = [name for name in "abcd" if cache.lookup(
+            Name(name + ".example.com"), Type.A, Class.IN)]
+        self.assertEqual(found, ["a", "b", "c", "d"])
+
+    def test_read_json_cache(self):
+        record = a_record("a.example.com", "10.0.0.1")
+        record.ttl += time.time()
+        with open(self.filename, "w") as file_:
+            json.dump([record.to_dict()], file_)
+        cache = RecordCache(0, filename=self.filename)
+        cache.read_cache_file()
+        self.assertEqual(len(cache), 1)
+
+
+class SharedCacheTestCase(DNSTestCase):
+    def setUp(self):
+        self.cache = SharedRecordCache(0, 64)
+
+    def tearDown(self):
+        self.cache.close()
+
+    def test_lookup(self):
+        self.cache.add_record(a_record("www.example.com", "1.2.3.4"))
+        self.cache.add_record(a_record("www.example.com", "1.2.3.5"))
+        self.cache.add_record(a_record("www.example.com", "1.2.3.4"))
+        records = self.cache.lookup(Name("WWW.EXAMPLE.COM"), Type.A, Class.IN)
+        self.assertEqual(sorted(r.rdata.address for r in records),
+                         ["1.2.3.4", "1.2.3.5"])
+        self.assertEqual(self.cache.lookup(Name("www.example.com"), Type.NS,
+                                           Class.IN), [])
+        self.assertEqual(len(self.cache), 1)
+
+    def test_rrset_version(self):
+        key = cache_key("www.example.com", Type.A, Class.IN)
+        self.assertIsNone(self.cache.rrset_version(key))
+        self.cache.add_record(a_record("www.example.com", "1.2.3.4"))
+        version = self.cache.rrset_version(key)
+        self.cache.add_record(a_record("mail.example.com", "1.2.3.6"))
+        self.assertEqual(self.cache.rrset_version(key), version)
+        self.cache.add_record(a_record("www.example.com", "1.2.3.5"))
+        self.assertNotEqual(self.cache.rrset_version(key), version)
+
+    def test_lookup_expired(self):
+        self.cache.add_record(a_record("www.example.com", "1.2.3.4", ttl=-1))
+        self.assertEqual(self.cache.lookup(Name("www.example.com"), Type.A,
+                                           Class.IN), [])
+        self.assertEqual(len(self.cache), 0)
+
+    def test_shared_between_processes(self):
+        context = multiprocessing.get_context("fork")
+        child = context.Process(target=self.cache.add_record,
+                                args=(a_record("www.example.com", "1.2.3.4"),))
+        child.start()
+        child.join()
+        records = self.cache.lookup(Name("www.example.com"), Type.A, Class.IN)
+        self.assertEqual([r.rdata.address for r in records], ["1.2.3.4"])
+
+    def test_full_bucket_evicts_first_expiring(self):
+        cache = SharedRecordCache(0, SharedRecordCache.WAYS)
+        try:
+            for i in range(SharedRecordCache.WAYS + 1):
+                cache.add_record(a_record("host{}.example.com".format(i),
+                                          "10.0.0.1", ttl=3600 + i))
+            self.assertEqual(cache.lookup(Name("host0.example.com"), Type.A,
+                                          Class.IN), [])
+            self.assertEqual(len(cache), SharedRecordCache.WAYS)
+            self.assertEqual(cache.stats()["evictions"], 1)
+        finally:
+            cache.close()
+
+    def test_writer_died(self):
+        self.cache.add_record(a_record("www.example.com", "1.2.3.4"))
+        bkey = Snapshot.encode_key(cache_key("www.example.com", Type.A,
+                                             Class.IN))
+        bucket = zlib.crc32(bkey) % self.cache.buckets
+        slot = self.cache.find(bucket, zlib.crc32(bkey), bkey)[0]
+        index = bucket % len(self.cache.locks)
+
+        def die_writing():
+            self.cache.acquire(index)
+            struct.pack_into("!I", self.cache.buf,
+                             slot * SharedRecordCache.SLOT_SIZE, 1)
+            os._exit(0)
+
+        child = multiprocessing.get_context("fork").Process(
+            target=die_writing)
+        child.start()
+        child.join()
+        self.assertEqual(self.cache.lookup(Name("www.example.com"), Type.A,
+                                           Class.IN), [])
+        self.cache.LOCK_TIMEOUT = 0.1
+        self.cache.add_record(a_record("www.example.com", "1.2.3.5"))
+        records = self.cache.lookup(Name("www.example.com"), Type.A, Class.IN)
+        self.assertEqual([r.rdata.address for r in records], ["1.2.3.5"])
+        self.assertEqual(self.cache.holders[index], 0)
+
+    def test_rrset_too_large(self):
+        for i in range(64):
+            self.cache.add_record(a_record("www.example.com",
+                                           "10.0.0.{}".format(i)))
+        records = self.cache.lookup(Name("www.example.com"), Type.A, Class.IN)
+        self.assertGreater(len(records), 0)
+        self.assertLess(len(records), 64)
+
+
+class PacketCacheTestCase(DNSTestCase):
+    def setUp(self):
+        self.cache = RecordCache(0)
+        self.packets = PacketCache(2, self.cache)
+        header = Header(1, 0, 1, 0, 0, 0)
+        self.query = Message(header, [Question(Name("www.example.com"),
+                                               Type.A, Class.IN)]).to_bytes()
+        header = Header(1, 0, 1, 2, 0, 0)
+        header.qr = 1
+        self.response = Message(header, [
+            Question(Name("www.example.com"), Type.A, Class.IN)], [
+            a_record("www.example.com", "1.2.3.4", 100),
+            a_record("www.example.com", "1.2.3.5", 200)]).to_bytes()
+
+    def test_ttl_offsets(self):
+        offsets = ttl_offsets(self.response)
+        self.assertEqual([struct.unpack_from("!I", self.response, offset)[0]
+                          for offset in offsets], [100, 200])
+
+    def test_get_patches_ident(self):
+        self.packets.put(self.query, self.response, float("inf"), 1)
+        query = b"\x12\x34" + self.query[2:]
+        self.assertEqual(self.packets.get(query, 1),
+                         b"\x12\x34" + self.response[2:])
+        self.assertIsNone(self.packets.get(query, 2))
+        self.assertIsNone(self.packets.get(query, 1))
+
+    def test_decay(self):
+        now = time.time()
+        self.packets.put(self.query, self.response, now + 100, 1, (),
+                         decay=True)
+        with unittest.mock.patch("dns.cache.time.time",
+                                 return_value=now + 60.5):
+            response = Message.from_bytes(self.packets.get(self.query, 1))
+        self.assertEqual([r.ttl for r in response.answers], [40, 140])
+        with unittest.mock.patch("dns.cache.time.time",
+                                 return_value=now + 101):
+            self.assertIsNone(self.packets.get(self.query, 1))
+
+    def test_record_cache_versions(self):
+        key = cache_key("www.example.com", Type.A, Class.IN)
+        self.cache.add_record(a_record("www.example.com", "1.2.3.4"))
+        self.packets.put(self.query, self.response, float("inf"), 1,
+                         ((key, self.cache.rrset_version(key)),))
+        self.cache.add_record(a_record("other.example.com", "1.2.3.6"))
+        self.assertIsNotNone(self.packets.get(self.query, 1))
+        self.cache.add_record(a_record("www.example.com", "1.2.3.5"))
+        self.assertIsNone(self.packets.get(self.query, 1))
+
+    def test_max_entries(self):
+        for count in range(2, 5):
+            query = self.query[:4] + bytes([0, count]) + self.query[6:]
+            self.packets.put(query, self.response, float("inf"), 1)
+        self.packets.put(self.query, self.response, float("inf"), 1)
+        self.assertEqual(len(self.packets), 2)
+        self.assertIsNone(self.packets.get(self.query[:5] + b"\x02" +
+                                           self.query[6:], 1))
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import tempfile
+
+from util import DNSTestCase
+
+from dns.classes import Class
+from dns.masterfile import parse_master_file, MasterFileError
+from dns.types import Type
+
+
+ZONE = """$ORIGIN example.com.
+$TTL 1h
+@   IN  SOA ns1 hostmaster (
+            2024010101 ; serial
+            7200       ; refresh
+            1h         ; retry
+            1w         ; expire
+            300 )      ; minimum
+    IN  NS  ns1
+    NS      ns.other.net.
+ns1 600 IN A 192.0.2.1
+www IN 60 A 192.0.2.2
+        A   192.0.2.3
+mail    MX  10 ns1
+txt     TXT "hello world" "a;b" plain
+v6      AAAA 2001:db8::1
+"""
+
+
+def parse(text, origin=None):
+    return list(parse_master_file(io.StringIO(text), origin, "test"))
+
+
+class MasterFileTestCase(DNSTestCase):
+    def test_parse(self):
+        records = parse(ZONE)
+        self.assertEqual([(str(r.name), r.type_, r.ttl) for r in records], [
+            ("example.com.", Type.SOA, 3600),
+            ("example.com.", Type.NS, 3600),
+            ("example.com.", Type.NS, 3600),
+            ("ns1.example.com.", Type.A, 600),
+            ("www.example.com.", Type.A, 60),
+            ("www.example.com.", Type.A, 3600),
+            ("mail.example.com.", Type.MX, 3600),
+            ("txt.example.com.", Type.TXT, 3600),
+            ("v6.example.com.", Type.AAAA, 3600)])
+        soa = records[0].rdata
+        self.assertEqual((str(soa.mname), str(soa.rname)),
+                         ("ns1.example.com.", "hostmaster.example.com."))
+        self.assertEqual((soa.serial, soa.refresh, soa.retry, soa.expire,
+                          soa.minimum), (2024010101, 7200, 3600, 604800, 300))
+        self.assertEqual(str(records[1].rdata.nsdname), "ns1.example.com.")
+        self.assertEqual(records[5].rdata.address, "192.0.2.3")
+        self.assertEqual(records[6].rdata.data,
+                         b"\x00\x0a\x03ns1\x07example\x03com\x00")
+        self.assertEqual(records[7].rdata.data,
+                         b"\x0bhello world\x03a;b\x05plain")
+        self.assertEqual(len(records[8].rdata.data), 16)
+
+    def test_generic_rdata(self):
+        record = parse("raw 60 IN PTR \\# 2 abcd", "example.com.")[0]
+        self.assertEqual(record.rdata.data, b"\xab\xcd")
+
+    def test_class_and_ttl_inherited(self):
+        records = parse("a.example. 60 CH A 192.0.2.1\n"
+                        "b.example. A 192.0.2.2\n")
+        self.assertEqual([(r.class_, r.ttl) for r in records],
+                         [(Class.CH, 60), (Class.CH, 60)])
+
+    def test_include(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "hosts"), "w") as file_:
+                file_.write("www 60 A 192.0.2.1\n")
+            filename = os.path.join(directory, "zone")
+            with open(filename, "w") as file_:
+                file_.write("$ORIGIN example.com.\n"
+                            "$INCLUDE hosts sub.example.com.\n"
+                            "ftp 60 A 192.0.2.2\n")
+            with open(filename) as file_:
+                records = list(parse_master_file(file_, None, filename))
+        self.assertEqual([str(r.name) for r in records],
+                         ["www.sub.example.com.", "ftp.example.com."])
+
+    def test_errors(self):
+        cases = [
+            ("www 60 A 192.0.2.1", 1, "without origin"),
+            ("a.example. A 192.0.2.1", 1, "no TTL"),
+            ("a.example. 60 A 192.0.2.300", 1, "invalid address"),
+            ("a.example. 60 A", 1, "needs 1 RDATA"),
+            ("a.example. 60 FOO x", 1, "unknown type"),
+            ("\n\na.example. 60 SOA a. b. ( 1 2 3 4 5", 3, "parentheses"),
+            ("a.example. 60 A 1.2.3.4 )", 1, "parentheses"),
+            ("a.example. 60 TXT \"open", 1, "unterminated"),
+            ("$TTL 1x", 1, "invalid TTL"),
+            ("$FOO bar", 1, "invalid directive"),
+            (" 60 A 192.0.2.1", 1, "no owner"),
+        ]
+        for text, lineno, message in cases:
+            with self.assertRaises(MasterFileError) as context:
+                parse(text)
+            self.assertEqual(context.exception.lineno, lineno)
+            self.assertIn("test:{}: ".format(lineno), str(context.exception))
+            self.assertIn(message, str(context.exception))
+        self.assertTrue(issubclass(MasterFileError, ValueError))
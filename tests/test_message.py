@@ -7,7 +7,7 @@ from util import DNSTestCase
 from dns.name import Name
 from dns.types import Type
 from dns.classes import Class
-from dns.message import Message, Header, Question
+from dns.message import Message, Header, Question, opt_record
 import dns.message
 
 
@@ -68,6 +68,22 @@ class HeaderTestCase(DNSTestCase):
             h1.ar_count != h2.ar_count):
             raise self.inequalityException(h1, h2, msg)
 
+    def test_opt(self):
+        header = Header(1, 0, 0, 0, 0, 1)
+        message = Message(header, additionals=[opt_record(4096, 16, 1)])
+        message = Message.from_bytes(message.to_bytes())
+        self.assertEqual(message.opt.type_, Type.OPT)
+        self.assertEqual(message.payload_size, 4096)
+        self.assertEqual(message.edns_version, 1)
+        self.assertEqual(message.opt.ttl >> 24, 1)
+        self.assertEqual(message.opt.rdata.options, [])
+
+        message.additionals = [opt_record(100)]
+        self.assertEqual(message.payload_size, 512)
+        message.additionals = []
+        self.assertEqual(message.payload_size, 512)
+        self.assertIsNone(message.edns_version)
+
     def test_qr(self):
         header = Header(0, 0, 0, 0, 0, 0)
         header.qr = 1
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+
+import asyncio
+import socket
+import struct
+import threading
+import time
+from unittest.mock import patch
+
+from util import DNSTestCase
+
+from dns.classes import Class
+from dns.message import Message
+from dns.name import Name
+from dns.resolver import Resolver, UpstreamSockets
+from dns.resource import ResourceRecord, ARecordData, NSRecordData
+from dns.types import Type
+
+
+def a_record(name, address):
+    return ResourceRecord(Name(name), Type.A, Class.IN, 3600,
+                          ARecordData(address))
+
+
+def ns_record(name, nsdname):
+    return ResourceRecord(Name(name), Type.NS, Class.IN, 3600,
+                          NSRecordData(Name(nsdname)))
+
+
+# Upstream responses by server address, as (answers, authorities, additionals)
+RESPONSES = {
+    "198.41.0.4": ([], [ns_record("nl.", "ns1.dns.nl.")],
+                   [a_record("ns1.dns.nl.", "193.176.144.5")]),
+    "193.176.144.5": ([a_record("ru.nl.", "131.174.78.60")], [], []),
+}
+
+
+class ResolverTestCase(DNSTestCase):
+    def setUp(self):
+        self.resolver = Resolver(5, False, 0)
+        self.requests = []
+
+    def send_request(self, ip, name):
+        self.requests.append((ip, str(name)))
+        return RESPONSES[ip]
+
+    def test_gethostbyname(self):
+        with patch.object(self.resolver, "send_request", self.send_request):
+            result = self.resolver.gethostbyname("ru.nl.")
+        self.assertEqual(result, ("ru.nl.", [], ["131.174.78.60"]))
+        self.assertEqual(self.requests, [("198.41.0.4", "ru.nl."),
+                                         ("193.176.144.5", "ru.nl.")])
+
+    def test_gethostbyname_async(self):
+        async def send_request_async(ip, name):
+            return self.send_request(ip, name)
+
+        with patch.object(self.resolver, "send_request_async",
+                          send_request_async):
+            result = asyncio.run(self.resolver.gethostbyname_async("ru.nl."))
+        self.assertEqual(result, ("ru.nl.", [], ["131.174.78.60"]))
+        self.assertEqual(len(self.requests), 2)
+
+    def test_gethostbyname_failure(self):
+        with patch.object(self.resolver, "send_request",
+                          lambda ip, name: ([], [], [])):
+            result = self.resolver.gethostbyname("ru.nl.")
+        self.assertEqual(result, ("ru.nl.", [], []))
+
+    def test_single_flight(self):
+        release = threading.Event()
+
+        def send_request(ip, name):
+            release.wait(5)
+            return self.send_request(ip, name)
+
+        results = []
+
+        def client():
+            results.append(self.resolver.gethostbyname("ru.nl."))
+
+        with patch.object(self.resolver, "send_request", send_request):
+            clients = [threading.Thread(target=client) for _ in range(10)]
+            for thread in clients:
+                thread.start()
+            time.sleep(0.05)
+            release.set()
+            for thread in clients:
+                thread.join()
+
+        self.assertEqual(results, [("ru.nl.", [], ["131.174.78.60"])] * 10)
+        stats = self.resolver.stats()
+        self.assertEqual(stats, {"upstream": 2, "coalesced": 9, "saved": 18})
+        self.assertEqual(self.resolver.flights, {})
+
+    def test_single_flight_async(self):
+        async def send_request_async(ip, name):
+            await asyncio.sleep(0.01)
+            return self.send_request(ip, name)
+
+        async def clients():
+            return await asyncio.gather(*[
+                self.resolver.gethostbyname_async(hostname)
+                for hostname in ["ru.nl.", "RU.NL.", "ru.nl."]])
+
+        with patch.object(self.resolver, "send_request_async",
+                          send_request_async):
+            results = asyncio.run(clients())
+        self.assertEqual(results[1], ("RU.NL.", [], ["131.174.78.60"]))
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual(self.resolver.stats(),
+                         {"upstream": 2, "coalesced": 2, "saved": 4})
+        self.assertEqual(self.resolver.async_flights, {})
+
+    def test_single_flight_error(self):
+        def send_request(ip, name):
+            raise OSError("timeout")
+
+        with patch.object(self.resolver, "send_request", send_request):
+            self.assertRaises(OSError, self.resolver.gethostbyname, "ru.nl.")
+        self.assertEqual(self.resolver.flights, {})
+
+    def make_response(self, tc=0):
+        response = self.resolver.build_query(Name("ru.nl."))
+        response.header.qr = 1
+        response.header.tc = tc
+        if not tc:
+            response.answers = [a_record("ru.nl.", "131.174.78.60")]
+            response.header.an_count = 1
+        return response.to_bytes()
+
+    def test_truncated_retry_over_tcp(self):
+        with patch.object(self.resolver, "send_udp",
+                          return_value=self.make_response(tc=1)), \
+                patch.object(self.resolver, "send_tcp",
+                             return_value=self.make_response()) as send_tcp:
+            answers, _, _ = self.resolver.send_request("193.176.144.5",
+                                                       Name("ru.nl."))
+        self.assertEqual(send_tcp.call_args[0][0], "193.176.144.5")
+        self.assertEqual(answers[0].rdata.address, "131.174.78.60")
+
+    def test_edns(self):
+        query = Message.from_bytes(
+            self.resolver.build_query(Name("ru.nl.")).to_bytes())
+        self.assertEqual(query.payload_size, 1232)
+        self.assertIsNone(self.resolver.build_query(Name("ru.nl."),
+                                                    edns=False).opt)
+        self.assertEqual(self.resolver.receive_size, 1232)
+
+        formerr = self.resolver.build_query(Name("ru.nl."), edns=False)
+        formerr.header.qr = 1
+        formerr.header.rcode = 1
+        with patch.object(self.resolver, "send_udp", side_effect=[
+                formerr.to_bytes(), self.make_response()]) as send_udp:
+            answers, _, _ = self.resolver.send_request("193.176.144.5",
+                                                       Name("ru.nl."))
+        retry = Message.from_bytes(send_udp.call_args[0][1])
+        self.assertIsNone(retry.opt)
+        self.assertEqual(answers[0].rdata.address, "131.174.78.60")
+
+    def test_tcp_connection_reuse(self):
+        client, server = socket.socketpair()
+        response = self.make_response()
+
+        def serve():
+            for _ in range(2):
+                length = struct.unpack("!H", server.recv(2))[0]
+                query = server.recv(length)
+                server.sendall(struct.pack("!H", len(response)) +
+                               query[:2] + response[2:])
+
+        thread = threading.Thread(target=serve)
+        thread.start()
+        query = self.resolver.build_query(Name("ru.nl.")).to_bytes()
+        with patch("dns.resolver.socket.create_connection",
+                   return_value=client) as create_connection:
+            for _ in range(2):
+                data = self.resolver.send_tcp("193.176.144.5", query)
+                self.assertEqual(Message.from_bytes(data).answers[0]
+                                 .rdata.address, "131.174.78.60")
+        thread.join(5)
+        self.assertEqual(create_connection.call_count, 1)
+        client.close()
+        server.close()
+
+    def upstream(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(("127.0.0.1", 0))
+        server.settimeout(5)
+        self.addCleanup(server.close)
+        return server
+
+    @staticmethod
+    def reply(query):
+        return query[:2] + bytes([query[2] | 0x80]) + query[3:]
+
+    def test_upstream_sockets(self):
+        server = self.upstream()
+        pool = UpstreamSockets(size=2)
+        self.addCleanup(pool.close)
+        names = ["host{}.example.".format(i) for i in range(6)]
+        responses = {}
+
+        def serve():
+            requests = [server.recvfrom(512) for _ in names]
+            query, address = requests[0]
+            ident = struct.pack("!H", (struct.unpack_from("!H", query)[0] + 1)
+                                % 2 ** 16)
+            server.sendto(self.reply(ident + query[2:]), address)
+            for query, address in reversed(requests):
+                server.sendto(self.reply(query), address)
+            self.sources = {address for _, address in requests}
+
+        def client(name):
+            query = self.resolver.build_query(Name(name)).to_bytes()
+            responses[name] = pool.query(server.getsockname(), query, 5)
+
+        async def clients(names):
+            queries = [self.resolver.build_query(Name(name)).to_bytes()
+                       for name in names]
+            results = await asyncio.gather(*[
+                pool.query_async(server.getsockname(), query, 5)
+                for query in queries])
+            responses.update(zip(names, results))
+
+        threads = [threading.Thread(target=serve)]
+        threads += [threading.Thread(target=client, args=(name,))
+                    for name in names[:4]]
+        threads.append(threading.Thread(target=asyncio.run,
+                                        args=(clients(names[4:]),)))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        for name in names:
+            response = Message.from_bytes(responses[name])
+            self.assertEqual(str(response.questions[0].qname), name)
+        self.assertLessEqual(len(self.sources), 2)
+        self.assertEqual(pool.stats(), {"sockets": 2, "pending": 0,
+                                        "unmatched": 1})
+
+        query = self.resolver.build_query(Name("example.")).to_bytes()
+        self.assertRaises(socket.timeout, pool.query, server.getsockname(),
+                          query, 0.1)
+        self.assertEqual(pool.stats()["pending"], 0)
+
+    def test_upstream_sockets_replaced(self):
+        server = self.upstream()
+        pool = UpstreamSockets(size=1, max_requests=2)
+        self.addCleanup(pool.close)
+        query = self.resolver.build_query(Name("example.")).to_bytes()
+        ports = []
+
+        def serve():
+            for _ in range(3):
+                data, address = server.recvfrom(512)
+                ports.append(address[1])
+                server.sendto(self.reply(data), address)
+
+        thread = threading.Thread(target=serve)
+        thread.start()
+        pool.query(server.getsockname(), query, 5)
+        first = pool.sockets[0]
+        pool.query(server.getsockname(), query, 5)
+        deadline = time.time() + 5
+        while first.fileno() != -1 and time.time() < deadline:
+            time.sleep(0.01)
+        pool.query(server.getsockname(), query, 5)
+        thread.join(5)
+        self.assertEqual(ports[0], ports[1])
+        self.assertNotEqual(ports[1], ports[2])
+        self.assertEqual(first.fileno(), -1)
+        self.assertEqual(pool.stats()["sockets"], 1)
+
+    def test_upstream_sockets_no_question(self):
+        server = self.upstream()
+        pool = UpstreamSockets()
+        self.addCleanup(pool.close)
+        query = self.resolver.build_query(Name("example.")).to_bytes()
+
+        def serve():
+            data, address = server.recvfrom(512)
+            server.sendto(data[:2] + b"\x80\x01" + bytes(8), address)
+
+        thread = threading.Thread(target=serve)
+        thread.start()
+        response = pool.query(server.getsockname(), query, 5)
+        thread.join(5)
+        self.assertEqual(Message.from_bytes(response).header.rcode, 1)
+        self.assertEqual(pool.stats()["unmatched"], 0)
+
+    def test_upstream_sockets_closed(self):
+        server = self.upstream()
+        pool = UpstreamSockets()
+        query = self.resolver.build_query(Name("example.")).to_bytes()
+        errors = []
+
+        def client():
+            try:
+                pool.query(server.getsockname(), query, 5)
+            except ConnectionError as error:
+                errors.append(error)
+
+        thread = threading.Thread(target=client)
+        thread.start()
+        server.recvfrom(512)
+        pool.close()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(len(errors), 1)
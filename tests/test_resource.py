@@ -4,7 +4,7 @@ from unittest.mock import MagicMock, patch
 
 from util import DNSTestCase
 
-from dns.resource import ResourceRecord, ARecordData
+from dns.resource import ResourceRecord, ARecordData, SOARecordData
 from dns.name import Name
 from dns.types import Type
 from dns.classes import Class
@@ -53,3 +53,15 @@ class RecordDataTestCase(DNSTestCase):
 
 class ARecordDataTestCase(DNSTestCase):
     pass
+
+
+class SOARecordDataTestCase(DNSTestCase):
+    def test_soa_round_trip(self):
+        rdata = SOARecordData(Name("ns1.example.com."),
+                              Name("hostmaster.example.com."), 2024010101,
+                              7200, 3600, 604800, 300)
+        data = b"\x00" * 5 + rdata.to_bytes(5, {})
+        decoded = SOARecordData.from_bytes(data, 5, len(data) - 5)
+        self.assertEqual(decoded.to_dict(), rdata.to_dict())
+        self.assertEqual(SOARecordData.from_dict(rdata.to_dict()).to_dict(),
+                         rdata.to_dict())
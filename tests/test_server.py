@@ -0,0 +1,685 @@
+#!/usr/bin/env python3
+
+import asyncio
+import os
+import socket
+import struct
+import tempfile
+import time
+from queue import Queue
+from unittest.mock import MagicMock, patch
+
+from util import DNSTestCase
+
+from dns.classes import Class
+from dns.message import Message, Header, Question, opt_record
+from dns.name import Name
+from dns.rcodes import RCode
+from dns.resource import (ResourceRecord, ARecordData, NSRecordData,
+                          SOARecordData)
+from dns.server import (Server, RequestHandler, ServerProtocol, Supervisor,
+                        ZoneWatcher, TCPHandler, truncate_response)
+from dns.types import Type
+from dns.zone import Catalog, Zone, MappedZone
+
+
+def make_query(hostname, ident=1234, rd=0, qtype=Type.A, edns=0, version=0):
+    header = Header(ident, 0, 1, 0, 0, 1 if edns else 0)
+    header.rd = rd
+    question = Question(Name(hostname), qtype, Class.IN)
+    additionals = [opt_record(edns, version=version)] if edns else []
+    return Message(header, [question], additionals=additionals).to_bytes()
+
+
+class ServerTestCase(DNSTestCase):
+    def setUp(self):
+        self.zone = Zone()
+        catalog = Catalog()
+        catalog.add_zone(".", self.zone)
+        with patch("dns.server.load_catalog", return_value=catalog):
+            self.server = Server(5353, False, 0)
+        self.server.doLogging = False
+        self.zone.add_node("kaas.lol.", [
+            ResourceRecord(Name("kaas.lol."), Type.A, Class.IN, 3600,
+                           ARecordData("1.1.1.1"))])
+        self.zone.add_node("nl.", [
+            ResourceRecord(Name("nl."), Type.NS, Class.IN, 3600,
+                           NSRecordData(Name("ns1.dns.nl.")))])
+        self.zone.add_node("ns1.dns.nl.", [
+            ResourceRecord(Name("ns1.dns.nl."), Type.A, Class.IN, 3600,
+                           ARecordData("193.176.144.5"))])
+
+    def test_handle_request_zone_answer(self):
+        response = Message.from_bytes(
+            self.server.handle_request(make_query("kaas.lol"), None))
+        self.assertEqual(response.header.ident, 1234)
+        self.assertEqual(response.header.aa, 1)
+        self.assertEqual(response.answers[0].rdata.address, "1.1.1.1")
+
+    def test_handle_request_referral(self):
+        response = Message.from_bytes(
+            self.server.handle_request(make_query("ru.nl"), None))
+        self.assertEqual(response.answers, [])
+        self.assertEqual(str(response.authorities[0].rdata.nsdname),
+                         "ns1.dns.nl.")
+        self.assertEqual(response.additionals[0].rdata.address,
+                         "193.176.144.5")
+
+    def test_handle_request_malformed(self):
+        self.assertIsNone(self.server.handle_request(b"\x00\x01", None))
+
+    def test_error_response(self):
+        query = make_query("example.com", ident=42, rd=1)
+        response = Message.from_bytes(
+            self.server.error_response(query, RCode.ServFail))
+        self.assertEqual(response.header.ident, 42)
+        self.assertEqual(response.header.qr, 1)
+        self.assertEqual(response.header.rd, 1)
+        self.assertEqual(response.header.rcode, RCode.ServFail)
+        self.assertEqual(str(response.questions[0].qname), "example.com.")
+
+    def test_request_handler(self):
+        requests = Queue()
+        self.server.sock = MagicMock()
+        handler = RequestHandler(self.server, requests)
+        requests.put((make_query("kaas.lol"), ("127.0.0.1", 4000)))
+        requests.put(None)
+        handler.run()
+        data, address = self.server.sock.sendto.call_args[0]
+        self.assertEqual(address, ("127.0.0.1", 4000))
+        self.assertEqual(Message.from_bytes(data).answers[0].rdata.address,
+                         "1.1.1.1")
+
+    def test_truncate_response(self):
+        self.zone.add_node("big.lol.", [
+            ResourceRecord(Name("big.lol."), Type.A, Class.IN, 3600,
+                           ARecordData("10.0.0.{}".format(i)))
+            for i in range(40)])
+        response = self.server.handle_request(make_query("big.lol"), None)
+        self.assertGreater(len(response), 512)
+        self.assertIs(truncate_response(response, 1000), response)
+        truncated = Message.from_bytes(truncate_response(response))
+        self.assertEqual(truncated.header.tc, 1)
+        self.assertEqual(truncated.header.ident, 1234)
+        self.assertEqual(str(truncated.questions[0].qname), "big.lol.")
+        self.assertEqual(truncated.answers, [])
+
+        header = Header(7, 0, 0, 0, 0, 0)
+        header.qr = 1
+        bare = Message(header, []).to_bytes() + bytes(600)
+        truncated = Message.from_bytes(truncate_response(bare))
+        self.assertEqual((truncated.header.qd_count, truncated.questions),
+                         (0, []))
+        header = Header(8, 0, 2, 0, 0, 0)
+        header.qr = 1
+        two = Message(header, [Question(Name(name), Type.A, Class.IN)
+                               for name in ("a.lol.", "b.a.lol.")]).to_bytes()
+        truncated = Message.from_bytes(truncate_response(two + bytes(600)))
+        self.assertEqual([str(q.qname) for q in truncated.questions],
+                         ["a.lol.", "b.a.lol."])
+        self.assertEqual(truncate_response(two + bytes(600)), two[:2] +
+                         bytes([two[2] | 2]) + two[3:])
+
+        requests = Queue()
+        self.server.sock = MagicMock()
+        requests.put((make_query("big.lol"), ("127.0.0.1", 4000)))
+        requests.put(None)
+        RequestHandler(self.server, requests).run()
+        data, _ = self.server.sock.sendto.call_args[0]
+        self.assertEqual(Message.from_bytes(data).header.tc, 1)
+
+    def test_tcp_pipelining(self):
+        handle_request = self.server.handle_request
+
+        def slow_handle_request(data, address):
+            if Message.from_bytes(data).header.ident == 1:
+                time.sleep(0.2)
+            return handle_request(data, address)
+
+        self.server.requests = Queue()
+        self.server.handlers = [RequestHandler(self.server,
+                                               self.server.requests)
+                                for _ in range(2)]
+        for handler in self.server.handlers:
+            handler.start()
+        client, sock = socket.socketpair()
+        with patch.object(self.server, "handle_request", slow_handle_request):
+            TCPHandler(self.server, sock, ("127.0.0.1", 4000)).start()
+            for ident in [1, 2]:
+                query = make_query("kaas.lol", ident=ident)
+                client.sendall(struct.pack("!H", len(query)) + query)
+            client.shutdown(socket.SHUT_WR)
+            client.settimeout(5)
+            data = b""
+            while True:
+                chunk = client.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+        client.close()
+        for _ in self.server.handlers:
+            self.server.requests.put(None)
+        idents = []
+        while data:
+            length = struct.unpack("!H", data[:2])[0]
+            idents.append(Message.from_bytes(data[2:2 + length]).header.ident)
+            data = data[2 + length:]
+        self.assertEqual(idents, [2, 1])
+
+    def test_server_protocol(self):
+        transport = MagicMock()
+        protocol = ServerProtocol(self.server)
+        protocol.connection_made(transport)
+        protocol.datagram_received(make_query("kaas.lol"), ("127.0.0.1", 4000))
+        data, address = transport.sendto.call_args[0]
+        self.assertEqual(address, ("127.0.0.1", 4000))
+        self.assertEqual(Message.from_bytes(data).answers[0].rdata.address,
+                         "1.1.1.1")
+        self.assertEqual(protocol.tasks, set())
+
+    def test_malformed_upstream_response(self):
+        truncated = b"\x00\x01\x80\x00\x00\x01" + bytes(6)
+        self.server.sock = MagicMock()
+        requests = Queue()
+        requests.put((make_query("example.com", rd=1), ("127.0.0.1", 4000)))
+        requests.put((make_query("kaas.lol"), ("127.0.0.1", 4001)))
+        requests.put(None)
+        with patch.object(self.server.resolver, "send_udp",
+                          return_value=truncated):
+            RequestHandler(self.server, requests).run()
+        (failed, _), (answered, _) = [
+            call[0] for call in self.server.sock.sendto.call_args_list]
+        self.assertEqual(Message.from_bytes(failed).header.rcode,
+                         RCode.ServFail)
+        self.assertEqual(Message.from_bytes(answered).answers[0].rdata
+                         .address, "1.1.1.1")
+
+        async def resolve():
+            protocol = ServerProtocol(self.server)
+            protocol.transport = MagicMock()
+            await protocol.resolve(make_query("example.com", rd=1),
+                                   Message.from_bytes(make_query(
+                                       "example.com", rd=1)),
+                                   ("127.0.0.1", 4000))
+            return protocol.transport.sendto.call_args[0][0]
+
+        with patch.object(self.server.resolver, "send_udp_async",
+                          return_value=truncated):
+            response = asyncio.run(resolve())
+        self.assertEqual(Message.from_bytes(response).header.rcode,
+                         RCode.ServFail)
+
+    def test_run_engine(self):
+        with patch.object(self.server, "serve") as serve:
+            self.server.run("threads")
+        serve.assert_called_with()
+
+    def test_supervisor_reuse_port(self):
+        supervisor = Supervisor(self.server, 2)
+        self.assertTrue(self.server.reuse_port)
+        self.assertEqual(supervisor.workers, 2)
+
+    def test_supervisor_gives_up(self):
+        supervisor = Supervisor(self.server, 2)
+        pids = iter(range(100, 200))
+        delays = []
+        spawn = supervisor.spawn
+
+        def record_spawn(delay=0):
+            delays.append(delay)
+            spawn(delay)
+
+        with patch("dns.server.os.fork", side_effect=lambda: next(pids)), \
+                patch("dns.server.os.wait",
+                      side_effect=lambda: (min(supervisor.started), 256)), \
+                patch("dns.server.os.kill"), \
+                patch("dns.server.os.waitpid"), \
+                patch("dns.server.gc.freeze"), \
+                patch("dns.server.signal.signal"), \
+                patch.object(supervisor, "spawn", record_spawn):
+            self.assertRaises(SystemExit, supervisor.run)
+        self.assertEqual(delays, [0, 0, 1, 2, 4, 8])
+        self.assertTrue(supervisor.done)
+        self.assertEqual(supervisor.started, {})
+
+    def test_resolver_shares_cache(self):
+        self.assertFalse(self.server.resolver.caching)
+        with patch("dns.server.RecordCache.read_cache_file") as read, \
+                patch("dns.server.load_catalog", return_value=Catalog()):
+            server = Server(5353, True, 0)
+        read.assert_called_with()
+        self.assertTrue(server.resolver.caching)
+        self.assertIs(server.resolver.cache, server.cache)
+
+    def test_packet_cache_hit(self):
+        self.server.handle_request(
+            make_query("kaas.lol", ident=1, qtype=Type.NS), None)
+        with patch.object(self.server, "parse_request") as parse_request:
+            response = Message.from_bytes(self.server.handle_request(
+                make_query("kaas.lol", ident=2, qtype=Type.NS), None))
+        parse_request.assert_not_called()
+        self.assertEqual(response.header.ident, 2)
+        self.assertEqual(response.answers[0].rdata.address, "1.1.1.1")
+        self.assertEqual(self.server.packets.stats()["hits"], 1)
+
+    def test_packet_cache_zone_change(self):
+        self.server.handle_request(make_query("kaas.lol"), None)
+        self.zone.add_node("kaas.lol.", [
+            ResourceRecord(Name("kaas.lol."), Type.A, Class.IN, 3600,
+                           ARecordData("2.2.2.2"))])
+        response = Message.from_bytes(
+            self.server.handle_request(make_query("kaas.lol"), None))
+        self.assertEqual(response.answers[0].rdata.address, "2.2.2.2")
+
+    def test_packet_cache_record_cache(self):
+        self.server.cache.add_record(
+            ResourceRecord(Name("example.com."), Type.A, Class.IN, 100,
+                           ARecordData("3.3.3.3")))
+        self.server.handle_request(make_query("example.com"), None)
+        now = time.time()
+        with patch("dns.cache.time.time", return_value=now + 30):
+            response = Message.from_bytes(
+                self.server.handle_request(make_query("example.com"), None))
+        self.assertEqual(self.server.packets.stats()["hits"], 1)
+        self.assertLessEqual(response.answers[0].ttl, 70)
+
+        self.server.cache.add_record(
+            ResourceRecord(Name("example.org."), Type.A, Class.IN, 100,
+                           ARecordData("5.5.5.5")))
+        self.server.handle_request(make_query("example.com"), None)
+        self.assertEqual(self.server.packets.stats()["hits"], 2)
+
+        self.server.cache.add_record(
+            ResourceRecord(Name("example.com."), Type.A, Class.IN, 100,
+                           ARecordData("4.4.4.4")))
+        response = Message.from_bytes(
+            self.server.handle_request(make_query("example.com"), None))
+        self.assertEqual(len(response.answers), 2)
+        self.assertEqual(self.server.packets.stats()["hits"], 2)
+
+    def test_packet_cache_rd_flag(self):
+        self.server.handle_request(make_query("kaas.lol", rd=0), None)
+        response = Message.from_bytes(
+            self.server.handle_request(make_query("kaas.lol", rd=1), None))
+        self.assertEqual(response.header.rd, 1)
+        self.assertEqual(self.server.packets.stats()["hits"], 0)
+
+    def test_fast_response_matches_full_path(self):
+        for hostname in ["kaas.lol", "ru.nl", "ns1.dns.nl", "nl"]:
+            query = make_query(hostname, rd=1)
+            message = Message.from_bytes(query)
+            fast = Message.from_bytes(self.server.fast_response(query, None))
+            full = Message.from_bytes(self.server.response(
+                message, 1, 0, *self.server.zone_resolution(message.questions)))
+            self.assertEqual(fast.header.flags, full.header.flags)
+            self.assertEqual(fast.questions[0].qname, full.questions[0].qname)
+            for section in ["answers", "authorities", "additionals"]:
+                self.assertEqual(
+                    [r.to_dict() for r in getattr(fast, section)],
+                    [r.to_dict() for r in getattr(full, section)])
+
+    def test_fast_response_edns(self):
+        for hostname in ["kaas.lol", "ru.nl", "ns1.dns.nl"]:
+            query = make_query(hostname, edns=4096)
+            message = Message.from_bytes(query)
+            fast = Message.from_bytes(self.server.fast_response(query, None))
+            full = Message.from_bytes(self.server.zone_response(message))
+            self.assertEqual(fast.opt.class_, 1232)
+            for section in ["answers", "authorities", "additionals"]:
+                self.assertEqual(
+                    [r.to_dict() for r in getattr(fast, section)],
+                    [r.to_dict() for r in getattr(full, section)])
+        self.assertIsNone(self.server.fast_response(
+            make_query("kaas.lol", edns=4096, version=1), None))
+
+    def test_edns_badvers(self):
+        response = Message.from_bytes(self.server.handle_request(
+            make_query("kaas.lol", edns=4096, version=1), None))
+        self.assertEqual(response.header.rcode, RCode.BADVERS & 0xf)
+        self.assertEqual(response.opt.ttl >> 24, RCode.BADVERS >> 4)
+        self.assertEqual(response.answers, [])
+
+    def test_edns_payload_size(self):
+        self.zone.add_node("big.lol.", [
+            ResourceRecord(Name("big.lol."), Type.A, Class.IN, 3600,
+                           ARecordData("10.0.0.{}".format(i)))
+            for i in range(40)])
+        for edns, tc in [(0, 1), (4096, 0), (600, 1)]:
+            query = make_query("big.lol", edns=edns)
+            response = Message.from_bytes(self.server.udp_response(
+                query, self.server.handle_request(query, None)))
+            self.assertEqual(response.header.tc, tc)
+            self.assertEqual(response.opt is not None, bool(edns))
+        self.assertEqual(len(Message.from_bytes(self.server.handle_request(
+            make_query("big.lol", edns=4096), None)).answers), 40)
+
+    def test_fast_response_case_insensitive(self):
+        response = Message.from_bytes(
+            self.server.fast_response(make_query("KAAS.lol"), None))
+        self.assertEqual(str(response.questions[0].qname), "KAAS.lol.")
+        self.assertEqual(response.answers[0].rdata.address, "1.1.1.1")
+
+    def test_fast_response_falls_back(self):
+        query = make_query("kaas.lol")
+        two_questions = Message(Header(1, 0, 2, 0, 0, 0), [
+            Question(Name("kaas.lol"), Type.A, Class.IN),
+            Question(Name("nl"), Type.A, Class.IN)]).to_bytes()
+        for data in [b"\x00\x01", make_query("kaas.lol", qtype=Type.NS),
+                     make_query("example.com"), two_questions, query + b"\x00",
+                     query[:2] + b"\x28" + query[3:],
+                     query[:12] + b"\xc0\x0c" + query[-4:]]:
+            self.assertIsNone(self.server.fast_response(data, None))
+
+    def test_fast_response_zone_change(self):
+        self.server.fast_response(make_query("kaas.lol"), None)
+        self.zone.add_node("kaas.lol.", [
+            ResourceRecord(Name("kaas.lol."), Type.A, Class.IN, 3600,
+                           ARecordData("2.2.2.2"))])
+        response = Message.from_bytes(
+            self.server.fast_response(make_query("kaas.lol"), None))
+        self.assertEqual(response.answers[0].rdata.address, "2.2.2.2")
+
+    def test_zone_response(self):
+        message = Message.from_bytes(make_query("Kaas.lol", qtype=Type.NS))
+        response = Message.from_bytes(self.server.zone_response(message))
+        self.assertEqual(response.header.aa, 1)
+        self.assertEqual(str(response.questions[0].qname), "Kaas.lol.")
+        self.assertEqual(response.answers[0].rdata.address, "1.1.1.1")
+        message = Message.from_bytes(make_query("example.com"))
+        self.assertIsNone(self.server.zone_response(message))
+
+    def test_mapped_zone(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "zone.img")
+            MappedZone.write(filename, self.zone)
+            mapped = MappedZone.open(filename)
+            self.server.catalog.add_zone(".", mapped)
+            fast = Message.from_bytes(
+                self.server.fast_response(make_query("ru.nl"), None))
+            full = Message.from_bytes(self.server.handle_request(
+                make_query("KAAS.lol", qtype=Type.NS), None))
+            mapped.close()
+        self.assertEqual(fast.additionals[0].rdata.address, "193.176.144.5")
+        self.assertEqual(full.answers[0].rdata.address, "1.1.1.1")
+
+
+class ZoneReloadTestCase(DNSTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, "zone")
+        self.write_zone("kaas.lol. 3600 A 1.1.1.1\n")
+        self.server = Server(5353, False, 0, zone_files=[self.filename])
+        self.server.doLogging = False
+
+    def tearDown(self):
+        self.server.done = True
+        if self.server.watcher is not None:
+            self.server.watcher.stop()
+        self.directory.cleanup()
+
+    def write_zone(self, text):
+        with open(self.filename, "w") as file_:
+            file_.write(text)
+
+    def address(self):
+        response = Message.from_bytes(
+            self.server.handle_request(make_query("kaas.lol"), None))
+        return [r.rdata.address for r in response.answers]
+
+    def test_reload_zones(self):
+        self.assertEqual(self.address(), ["1.1.1.1"])
+        self.write_zone("kaas.lol. 3600 A 2.2.2.2\n")
+        self.assertTrue(self.server.reload_zones())
+        self.assertEqual(self.address(), ["2.2.2.2"])
+
+    def test_reload_zones_failure(self):
+        catalog = self.server.catalog
+        self.write_zone("kaas.lol. 3600 A 2.2.2\n")
+        self.assertFalse(self.server.reload_zones())
+        self.assertIs(self.server.catalog, catalog)
+        os.remove(self.filename)
+        self.assertFalse(self.server.reload_zones())
+        self.assertEqual(self.address(), ["1.1.1.1"])
+
+    def test_zone_watcher(self):
+        self.server.watcher = ZoneWatcher(self.server, 0.01)
+        self.server.watcher.start()
+        self.write_zone("kaas.lol. 3600 A 2.2.2.2\n"
+                        "www.kaas.lol. 3600 A 3.3.3.3\n")
+        deadline = time.monotonic() + 5
+        while self.address() != ["2.2.2.2"] and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.address(), ["2.2.2.2"])
+
+    def test_zone_watcher_reload(self):
+        self.server.watcher = ZoneWatcher(self.server, 0)
+        self.server.watcher.start()
+        with patch.object(self.server, "reload_zones") as reload_zones:
+            self.server.watcher.reload()
+            deadline = time.monotonic() + 5
+            while not reload_zones.called and time.monotonic() < deadline:
+                time.sleep(0.01)
+        reload_zones.assert_called_with()
+
+
+class CatalogServerTestCase(DNSTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        zones = {
+            "lol": "$ORIGIN lol.\n@ 3600 SOA ns hostmaster 1 2 3 4 5\n"
+                   "@ 3600 NS ns\nns 3600 A 10.0.0.1\n"
+                   "kaas 3600 NS ns.kaas\nns.kaas 3600 A 10.0.0.2\n",
+            "kaas.lol": "$ORIGIN kaas.lol.\n"
+                        "@ 3600 SOA ns hostmaster 1 2 3 4 5\n"
+                        "@ 3600 A 1.1.1.1\nwww 3600 A 2.2.2.2\n",
+        }
+        for name, text in zones.items():
+            with open(os.path.join(self.directory.name, name), "w") as file_:
+                file_.write(text)
+        self.server = Server(5353, False, 0,
+                             zone_files=[self.directory.name])
+        self.server.doLogging = False
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_catalog_zones(self):
+        self.assertEqual(sorted(self.server.catalog.zones),
+                         ["kaas.lol.", "lol."])
+
+    def test_longest_suffix_zone(self):
+        for query in [make_query("www.kaas.lol"),
+                      make_query("www.KAAS.lol", qtype=Type.NS)]:
+            response = Message.from_bytes(
+                self.server.handle_request(query, None))
+            self.assertEqual(response.header.aa, 1)
+            self.assertEqual(response.answers[0].rdata.address, "2.2.2.2")
+
+    def test_parent_zone_referral(self):
+        response = Message.from_bytes(
+            self.server.handle_request(make_query("ns.lol"), None))
+        self.assertEqual(response.answers[0].rdata.address, "10.0.0.1")
+        response = Message.from_bytes(
+            self.server.handle_request(make_query("x.frites.lol"), None))
+        self.assertEqual(str(response.authorities[0].rdata.nsdname),
+                         "ns.lol.")
+
+    def test_no_zone(self):
+        self.assertIsNone(
+            self.server.fast_response(make_query("example.com"), None))
+
+
+EXAMPLE_ZONE = """$ORIGIN example.
+$TTL 3600
+@ SOA ns hostmaster {} 7200 3600 604800 300
+@ NS ns
+ns A 192.0.2.1
+www A 192.0.2.{}
+"""
+
+
+def make_transfer_query(qtype, serial=None, ident=7):
+    authorities = []
+    if serial is not None:
+        authorities.append(ResourceRecord(
+            Name("example."), Type.SOA, Class.IN, 3600, SOARecordData(
+                Name("ns.example."), Name("hostmaster.example."), serial,
+                0, 0, 0, 0)))
+    header = Header(ident, 0, 1, 0, len(authorities), 0)
+    question = Question(Name("example."), qtype, Class.IN)
+    return Message(header, [question], authorities=authorities).to_bytes()
+
+
+class TransferTestCase(DNSTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, "example")
+        self.write_zone(1, 10)
+        self.server = Server(5353, False, 0, zone_files=[self.filename])
+        self.server.doLogging = False
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write_zone(self, serial, address):
+        with open(self.filename, "w") as file_:
+            file_.write(EXAMPLE_ZONE.format(serial, address))
+
+    def transfer(self, query):
+        messages = [Message.from_bytes(response) for response in
+                    self.server.tcp_responses(query, None)]
+        return messages, [(r.type_, r.rdata.serial if r.type_ == Type.SOA
+                           else str(r.name))
+                          for m in messages for r in m.answers]
+
+    def test_axfr(self):
+        messages, records = self.transfer(make_transfer_query(Type.AXFR))
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0].header.ident, 7)
+        self.assertEqual(messages[0].header.aa, 1)
+        self.assertEqual(records, [
+            (Type.SOA, 1), (Type.NS, "example."), (Type.A, "ns.example."),
+            (Type.A, "www.example."), (Type.SOA, 1)])
+
+    def test_axfr_stream(self):
+        message = Message.from_bytes(make_transfer_query(Type.AXFR))
+        records = [ResourceRecord(Name("host{}.example.".format(i)), Type.A,
+                                  Class.IN, 3600, ARecordData("10.0.0.1"))
+                   for i in range(100)]
+        messages = [Message.from_bytes(data) for data in
+                    self.server.transfer_messages(message, iter(records),
+                                                  size=512)]
+        self.assertGreater(len(messages), 1)
+        self.assertEqual([len(m.questions) for m in messages],
+                         [1] + [0] * (len(messages) - 1))
+        self.assertEqual([str(r.name) for m in messages for r in m.answers],
+                         [str(r.name) for r in records])
+
+    def test_ixfr(self):
+        self.write_zone(2, 20)
+        self.assertTrue(self.server.reload_zones())
+        _, records = self.transfer(make_transfer_query(Type.IXFR, 1))
+        self.assertEqual(records, [
+            (Type.SOA, 2), (Type.SOA, 1), (Type.A, "www.example."),
+            (Type.SOA, 2), (Type.A, "www.example."), (Type.SOA, 2)])
+        _, records = self.transfer(make_transfer_query(Type.IXFR, 2))
+        self.assertEqual(records, [(Type.SOA, 2)])
+        _, records = self.transfer(make_transfer_query(Type.IXFR, 5))
+        self.assertEqual(len(records), 5)
+
+    def test_transfer_errors(self):
+        query = make_transfer_query(Type.AXFR)
+        query = query[:12] + b"\x03www" + query[12:]
+        messages, _ = self.transfer(query)
+        self.assertEqual(messages[0].header.rcode, RCode.NotAuth)
+        messages, _ = self.transfer(make_transfer_query(Type.IXFR))
+        self.assertEqual(messages[0].header.rcode, RCode.FormErr)
+
+    def test_udp_transfer(self):
+        response = Message.from_bytes(self.server.handle_request(
+            make_transfer_query(Type.IXFR, 1), None))
+        self.assertEqual([r.type_ for r in response.answers], [Type.SOA])
+        response = Message.from_bytes(self.server.handle_request(
+            make_transfer_query(Type.AXFR), None))
+        self.assertEqual(response.header.rcode, RCode.Refused)
+
+    def test_tcp_handler(self):
+        client, sock = socket.socketpair()
+        handler = TCPHandler(self.server, sock, ("127.0.0.1", 4000))
+        handler.start()
+        for query in [make_transfer_query(Type.AXFR),
+                      make_query("www.example")]:
+            client.sendall(struct.pack("!H", len(query)) + query)
+        client.settimeout(5)
+        responses = []
+        data = b""
+        while len(responses) < 2:
+            data += client.recv(4096)
+            while len(data) >= 2 and \
+                    len(data) >= 2 + struct.unpack("!H", data[:2])[0]:
+                length = struct.unpack("!H", data[:2])[0]
+                responses.append(Message.from_bytes(data[2:2 + length]))
+                data = data[2 + length:]
+        client.close()
+        handler.join(5)
+        self.assertEqual(len(responses[0].answers), 5)
+        self.assertEqual(responses[1].answers[0].rdata.address, "192.0.2.10")
+
+
+def make_update(updates, zone="example."):
+    header = Header(11, 0, 1, 0, len(updates), 0)
+    header.opcode = 5
+    return Message(header, [Question(Name(zone), Type.SOA, Class.IN)], [],
+                   updates).to_bytes()
+
+
+class UpdateServerTestCase(DNSTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, "example")
+        with open(self.filename, "w") as file_:
+            file_.write(EXAMPLE_ZONE.format(1, 10))
+        self.server = Server(5353, False, 0, zone_files=[self.filename],
+                             allow_update=["127.0.0.0/8"])
+        self.server.doLogging = False
+        self.update = make_update([ResourceRecord(
+            Name("www.example."), Type.A, Class.IN, 3600,
+            ARecordData("192.0.2.11"))])
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def addresses(self, hostname):
+        response = Message.from_bytes(
+            self.server.handle_request(make_query(hostname), None))
+        return sorted(r.rdata.address for r in response.answers)
+
+    def test_update(self):
+        response = Message.from_bytes(self.server.handle_request(
+            self.update, ("127.0.0.1", 4000)))
+        self.assertEqual(response.header.opcode, 5)
+        self.assertEqual(response.header.rcode, RCode.NoError)
+        self.assertEqual(str(response.questions[0].qname), "example.")
+        self.assertEqual(self.addresses("www.example"),
+                         ["192.0.2.10", "192.0.2.11"])
+        self.assertTrue(os.path.exists(self.filename + ".journal"))
+
+    def test_update_refused(self):
+        for address in [("192.0.2.1", 4000), None]:
+            response = Message.from_bytes(
+                self.server.handle_request(self.update, address))
+            self.assertEqual(response.header.rcode, RCode.Refused)
+        response = Message.from_bytes(self.server.handle_request(
+            make_update([], "www.example."), ("127.0.0.1", 4000)))
+        self.assertEqual(response.header.rcode, RCode.NotAuth)
+        self.assertEqual(self.addresses("www.example"), ["192.0.2.10"])
+
+    def test_update_keeps_packet_cache(self):
+        self.addresses("www.example")
+        self.addresses("ns.example")
+        self.server.handle_request(self.update, ("127.0.0.1", 4000))
+        self.assertEqual(self.addresses("ns.example"), ["192.0.2.1"])
+        self.assertEqual(self.server.packets.stats()["hits"], 1)
+        self.assertEqual(self.addresses("www.example"),
+                         ["192.0.2.10", "192.0.2.11"])
+        self.assertEqual(self.server.packets.stats()["hits"], 1)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+
+from util import DNSTestCase
+
+from dns.classes import Class
+from dns.message import Message, Header, Question
+from dns.name import Name
+from dns.rcodes import RCode
+from dns.resource import (ResourceRecord, ARecordData, CNAMERecordData,
+                          NSRecordData, GenericRecordData)
+from dns.types import Type
+from dns.update import OPCODE_UPDATE, UpdateError, update_zone
+from dns.zone import load_zone
+
+
+ZONE = """$ORIGIN example.
+$TTL 3600
+@ SOA ns hostmaster 1 7200 3600 604800 300
+@ NS ns
+ns A 192.0.2.1
+www A 192.0.2.10
+"""
+
+
+def record(name, type_, rdata=None, class_=Class.IN, ttl=3600):
+    if rdata is None:
+        rdata = GenericRecordData(b"")
+    return ResourceRecord(Name(name), type_, class_, ttl, rdata)
+
+
+def make_update(prerequisites=(), updates=(), zone="example."):
+    header = Header(9, 0, 1, len(prerequisites), len(updates), 0)
+    header.opcode = OPCODE_UPDATE
+    message = Message(header, [Question(Name(zone), Type.SOA, Class.IN)],
+                      list(prerequisites), list(updates))
+    return Message.from_bytes(message.to_bytes())
+
+
+class UpdateTestCase(DNSTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, "example")
+        with open(self.filename, "w") as file_:
+            file_.write(ZONE)
+        self.zone = load_zone(self.filename)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def addresses(self, name, zone=None):
+        exact, records, _ = (zone or self.zone).find(name)
+        return sorted(r.rdata.address for r in records
+                      if exact and r.type_ == Type.A)
+
+    def serial(self, zone=None):
+        return (zone or self.zone).soa().rdata.serial
+
+    def test_add(self):
+        www = self.zone.walk("www.example.")[1]
+        ns = self.zone.walk("ns.example.")[1]
+        versions = www.version, ns.version
+        self.assertTrue(update_zone(self.zone, make_update(updates=[
+            record("www.example.", Type.A, ARecordData("192.0.2.11")),
+            record("new.example.", Type.A, ARecordData("192.0.2.12"))])))
+        self.assertEqual(self.addresses("www.example."),
+                         ["192.0.2.10", "192.0.2.11"])
+        self.assertEqual(self.addresses("new.example."), ["192.0.2.12"])
+        self.assertEqual(self.serial(), 2)
+        self.assertNotEqual(www.version, versions[0])
+        self.assertEqual(ns.version, versions[1])
+
+    def test_delete(self):
+        update_zone(self.zone, make_update(updates=[
+            record("www.example.", Type.A, class_=Class.ANY, ttl=0)]))
+        self.assertEqual(self.zone.find("www.example.")[0], False)
+        self.assertIsNone(self.zone.node(Name("www.example.").to_bytes(0)))
+        update_zone(self.zone, make_update(updates=[
+            record("ns.example.", Type.A, ARecordData("192.0.2.1"),
+                   Class.NONE, 0)]))
+        self.assertEqual(self.zone.find("ns.example.")[0], False)
+        self.assertEqual(self.serial(), 3)
+
+    def test_apex_kept(self):
+        self.assertFalse(update_zone(self.zone, make_update(updates=[
+            record("example.", Type.ANY, class_=Class.ANY, ttl=0),
+            record("example.", Type.NS, NSRecordData(Name("ns.example.")),
+                   Class.NONE, 0)])))
+        self.assertEqual(self.serial(), 1)
+        self.assertEqual(len(self.zone.find("example.")[1]), 2)
+
+    def test_cname(self):
+        update_zone(self.zone, make_update(updates=[
+            record("www.example.", Type.CNAME,
+                   CNAMERecordData(Name("ns.example."))),
+            record("alias.example.", Type.CNAME,
+                   CNAMERecordData(Name("ns.example."))),
+            record("alias.example.", Type.A, ARecordData("192.0.2.13"))]))
+        self.assertEqual(self.addresses("www.example."), ["192.0.2.10"])
+        self.assertEqual([r.type_ for r in
+                          self.zone.find("alias.example.")[1]], [Type.CNAME])
+
+    def test_prerequisites(self):
+        cases = [
+            (record("www.example.", Type.ANY, class_=Class.NONE, ttl=0),
+             RCode.YXDomain),
+            (record("foo.example.", Type.ANY, class_=Class.ANY, ttl=0),
+             RCode.NXDomain),
+            (record("www.example.", Type.A, class_=Class.NONE, ttl=0),
+             RCode.YXRRSet),
+            (record("www.example.", Type.NS, class_=Class.ANY, ttl=0),
+             RCode.NXRRSet),
+            (record("www.example.", Type.A, ARecordData("192.0.2.11"),
+                    ttl=0), RCode.NXRRSet),
+            (record("www.example.", Type.A, class_=Class.ANY),
+             RCode.FormErr),
+            (record("www.other.", Type.A, class_=Class.ANY, ttl=0),
+             RCode.NotZone)]
+        for prerequisite, rcode in cases:
+            with self.assertRaises(UpdateError) as context:
+                update_zone(self.zone, make_update(
+                    [prerequisite],
+                    [record("www.example.", Type.A, class_=Class.ANY,
+                            ttl=0)]))
+            self.assertEqual(context.exception.rcode, rcode)
+        self.assertEqual(self.addresses("www.example."), ["192.0.2.10"])
+        update_zone(self.zone, make_update(
+            [record("www.example.", Type.A, ARecordData("192.0.2.10"),
+                    ttl=0)],
+            [record("www.example.", Type.A, class_=Class.ANY, ttl=0)]))
+        self.assertEqual(self.addresses("www.example."), [])
+
+    def test_prescan(self):
+        for update, rcode in [
+                (record("www.other.", Type.A, ARecordData("192.0.2.1")),
+                 RCode.NotZone),
+                (record("www.example.", Type.A, class_=Class.ANY),
+                 RCode.FormErr),
+                (record("www.example.", Type.AXFR, class_=Class.ANY, ttl=0),
+                 RCode.FormErr)]:
+            with self.assertRaises(UpdateError) as context:
+                update_zone(self.zone, make_update(updates=[
+                    record("new.example.", Type.A, ARecordData("192.0.2.1")),
+                    update]))
+            self.assertEqual(context.exception.rcode, rcode)
+        self.assertEqual(self.zone.find("new.example.")[0], False)
+
+    def test_soa(self):
+        soa = self.zone.soa()
+        for serial, expected in [(1, 1), (5, 5), (3, 5)]:
+            rdata = soa.rdata
+            rdata = type(rdata)(rdata.mname, rdata.rname, serial,
+                                rdata.refresh, rdata.retry, rdata.expire,
+                                rdata.minimum)
+            update_zone(self.zone, make_update(updates=[
+                record("example.", Type.SOA, rdata)]))
+            self.assertEqual(self.serial(), expected)
+
+    def test_journal(self):
+        update_zone(self.zone, make_update(updates=[
+            record("www.example.", Type.A, ARecordData("192.0.2.11"))]))
+        update_zone(self.zone, make_update(updates=[
+            record("ns.example.", Type.A, class_=Class.ANY, ttl=0)]))
+        self.assertEqual(len(self.zone.history), 2)
+        zone = load_zone(self.filename)
+        self.assertEqual(self.serial(zone), 3)
+        self.assertEqual(self.addresses("www.example.", zone),
+                         ["192.0.2.10", "192.0.2.11"])
+        self.assertEqual(zone.find("ns.example.")[0], False)
+        self.assertEqual(len(zone.history.since(1)), 2)
+
+        with open(self.filename, "w") as file_:
+            file_.write(ZONE.replace(" 1 7200", " 10 7200"))
+        zone = load_zone(self.filename)
+        self.assertEqual(self.serial(zone), 10)
+        self.assertEqual(self.addresses("www.example.", zone),
+                         ["192.0.2.10"])
+
+    def test_journal_malformed(self):
+        update_zone(self.zone, make_update(updates=[
+            record("www.example.", Type.A, ARecordData("192.0.2.11"))]))
+        with open(self.filename + ".journal", "a") as file_:
+            file_.write('{"delete": [], "add": []}\n')
+        zone = load_zone(self.filename)
+        self.assertEqual(self.serial(zone), 2)
+        self.assertEqual(len(zone.history.since(1)), 1)
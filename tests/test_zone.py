@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+
+from util import DNSTestCase
+
+from dns.message import Message, Header, Question
+
+from dns.classes import Class
+from dns.name import Name
+from dns.resource import (ResourceRecord, ARecordData, NSRecordData,
+                          SOARecordData)
+from dns.types import Type
+from dns.zone import (Catalog, History, Zone, MappedZone, load_zone,
+                      load_catalog, record_changes)
+
+
+def a_record(name, address):
+    return ResourceRecord(Name(name), Type.A, Class.IN, 3600,
+                          ARecordData(address))
+
+
+def ns_record(name, nsdname):
+    return ResourceRecord(Name(name), Type.NS, Class.IN, 3600,
+                          NSRecordData(Name(nsdname)))
+
+
+def soa_record(name):
+    return ResourceRecord(Name(name), Type.SOA, Class.IN, 3600, SOARecordData(
+        Name("ns." + name), Name("hostmaster." + name), 1, 2, 3, 4, 5))
+
+
+class ZoneTestCase(DNSTestCase):
+    def setUp(self):
+        self.zone = Zone()
+        self.zone.add_node("nl.", [ns_record("nl.", "ns1.dns.nl."),
+                                   ns_record("nl.", "ns.example.com.")])
+        self.zone.add_node("ns1.dns.nl.", [a_record("ns1.dns.nl.",
+                                                    "193.176.144.5")])
+        self.zone.add_node("kaas.lol.", [a_record("kaas.lol.", "1.1.1.1")])
+
+    def test_find_exact(self):
+        exact, records, glue = self.zone.find(Name("KAAS.lol."))
+        self.assertTrue(exact)
+        self.assertEqual(records[0].rdata.address, "1.1.1.1")
+        self.assertEqual(glue, [])
+
+    def test_find_enclosing(self):
+        exact, records, glue = self.zone.find("www.ru.nl")
+        self.assertFalse(exact)
+        self.assertEqual([str(r.rdata.nsdname) for r in records],
+                         ["ns1.dns.nl.", "ns.example.com."])
+        self.assertEqual([r.rdata.address for r in glue], ["193.176.144.5"])
+
+    def test_find_empty_non_terminal(self):
+        self.assertEqual(self.zone.find("dns.nl.")[0], False)
+        self.assertEqual(self.zone.find("example.com."), (False, [], []))
+
+    def test_find_root(self):
+        self.zone.add_node(".", [ns_record(".", "a.root-servers.net.")])
+        exact, records, _ = self.zone.find("example.com.")
+        self.assertFalse(exact)
+        self.assertEqual(records[0].type_, Type.NS)
+        self.assertTrue(self.zone.find(".")[0])
+
+    def test_glue_follows_changes(self):
+        self.assertEqual(len(self.zone.find("nl.")[2]), 1)
+        version = self.zone.version
+        self.zone.add_node("ns.example.com.", [a_record("ns.example.com.",
+                                                        "10.0.0.1")])
+        self.assertNotEqual(self.zone.version, version)
+        self.assertEqual([r.rdata.address for r in self.zone.find("nl.")[2]],
+                         ["193.176.144.5", "10.0.0.1"])
+
+    def test_template(self):
+        header = Header(1, 0, 1, 0, 0, 0)
+        header.qr = 1
+        for hostname, exact in [("kaas.lol.", True), ("www.ru.nl.", False)]:
+            question = Question(Name(hostname), Type.A, Class.IN)
+            _, node = self.zone.walk(hostname)
+            counts, records = self.zone.template(node, exact)
+            response = Message.from_bytes(
+                header.to_bytes()[:6] + counts + question.to_bytes(12, {}) +
+                records)
+            self.assertEqual(
+                [r.to_dict() for r in response.resources],
+                [r.to_dict() for r in sum(
+                    self.zone.sections(*self.zone.find(hostname)), [])])
+        _, node = self.zone.walk("ns1.dns.nl.")
+        self.assertIsNone(self.zone.template(node, False))
+
+    def test_template_follows_changes(self):
+        self.zone.compile()
+        _, node = self.zone.walk("kaas.lol.")
+        before = self.zone.template(node, True)
+        self.zone.add_node("kaas.lol.", [a_record("kaas.lol.", "2.2.2.2")])
+        self.assertNotEqual(self.zone.template(node, True), before)
+
+
+class MappedZoneTestCase(DNSTestCase):
+    def setUp(self):
+        ZoneTestCase.setUp(self)
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, "zone.img")
+        MappedZone.write(self.filename, self.zone)
+        self.mapped = MappedZone.open(self.filename)
+
+    def tearDown(self):
+        self.mapped.close()
+        self.directory.cleanup()
+
+    def test_find_matches_zone(self):
+        for name in ["kaas.lol.", "KAAS.LOL.", "www.ru.nl.", "nl.",
+                     "dns.nl.", "example.com.", "."]:
+            expected = self.zone.find(name)
+            found = self.mapped.find(name)
+            self.assertEqual(found[0], expected[0])
+            for section in (1, 2):
+                self.assertEqual([r.to_dict() for r in found[section]],
+                                 [r.to_dict() for r in expected[section]])
+
+    def test_template_matches_zone(self):
+        for name in ["kaas.lol.", "ns1.dns.nl.", "nl."]:
+            node = self.mapped.node(Name(name).to_bytes(0))
+            for exact in (True, False):
+                self.assertEqual(
+                    self.mapped.template(node, exact),
+                    self.zone.template(self.zone.walk(name)[1], exact))
+
+    def test_names_sorted(self):
+        self.assertEqual(len(self.mapped), 3)
+        self.assertEqual([str(name) for name, _ in self.mapped.names()],
+                         ["kaas.lol.", "nl.", "ns1.dns.nl."])
+
+    def test_rewrite_while_mapped(self):
+        MappedZone.write(self.filename, Zone())
+        self.assertTrue(self.mapped.find("kaas.lol.")[0])
+        self.assertEqual(len(self.mapped), 3)
+        rewritten = MappedZone.open(self.filename)
+        self.assertEqual(len(rewritten), 0)
+        rewritten.close()
+        self.assertEqual(os.listdir(self.directory.name), ["zone.img"])
+
+    def test_load_zone(self):
+        self.assertIsInstance(load_zone(self.filename), MappedZone)
+        master = os.path.join(self.directory.name, "zone")
+        with open(master, "w") as file_:
+            file_.write("kaas.lol. 3600 A 1.1.1.1\n")
+        zone = load_zone(master)
+        self.assertIsInstance(zone, Zone)
+        self.assertTrue(zone.find("kaas.lol.")[0])
+        self.assertIsNone(MappedZone.open(master))
+
+
+class CatalogTestCase(DNSTestCase):
+    def setUp(self):
+        self.catalog = Catalog()
+        self.zones = {}
+        for name in [".", "nl.", "ru.nl."]:
+            zone = Zone()
+            zone.add_node(name, [soa_record(name)])
+            self.catalog.add_zone(name, zone)
+            self.zones[name] = zone
+
+    def test_find_zone(self):
+        for name, zone in [("www.RU.nl.", "ru.nl."), ("ru.nl.", "ru.nl."),
+                           ("uu.nl.", "nl."), ("example.com.", "."),
+                           (".", ".")]:
+            self.assertIs(self.catalog.find_zone(name), self.zones[zone])
+        del self.catalog.wire[b"\x00"]
+        self.assertIsNone(self.catalog.find_zone("example.com."))
+
+    def test_version_follows_zones(self):
+        version = self.catalog.version
+        self.zones["nl."].add_node("www.nl.", [a_record("www.nl.", "1.1.1.1")])
+        self.assertNotEqual(self.catalog.version, version)
+        version = self.catalog.version
+        self.catalog.add_zone("lol.", Zone())
+        self.assertNotEqual(self.catalog.version, version)
+
+    def test_origin(self):
+        self.assertEqual(str(self.zones["ru.nl."].origin()), "ru.nl.")
+        zone = Zone()
+        zone.add_node("nl.", [ns_record("nl.", "ns1.dns.nl.")])
+        zone.add_node("kaas.lol.", [a_record("kaas.lol.", "1.1.1.1")])
+        self.assertEqual(str(zone.origin()), ".")
+
+    def test_load_catalog(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for name in ["nl", "ru.nl"]:
+                with open(os.path.join(directory, name), "w") as file_:
+                    file_.write("$ORIGIN {}.\n"
+                                "@ 3600 SOA ns hostmaster 1 2 3 4 5\n"
+                                .format(name))
+            zone = Zone()
+            zone.add_node("ru.nl.", [soa_record("ru.nl.")])
+            MappedZone.write(os.path.join(directory, "ru.nl.img"), zone)
+            self.assertRaisesRegex(ValueError, "both hold zone ru.nl.",
+                                   load_catalog, [directory])
+            os.remove(os.path.join(directory, "ru.nl"))
+            catalog = load_catalog([directory])
+            self.assertEqual(sorted(catalog.zones), ["nl.", "ru.nl."])
+            self.assertIsInstance(catalog.find_zone("www.ru.nl."), MappedZone)
+            catalog.find_zone("www.ru.nl.").close()
+
+
+class HistoryTestCase(DNSTestCase):
+    def soa(self, serial):
+        record = soa_record("nl.")
+        record.rdata.serial = serial
+        return record
+
+    def test_since(self):
+        history = History()
+        for serial in range(1, 4):
+            history.add(self.soa(serial), [], self.soa(serial + 1), [])
+        self.assertEqual([change[0].rdata.serial
+                          for change in history.since(2)], [2, 3])
+        self.assertIsNone(history.since(4))
+
+    def test_limits(self):
+        history = History(max_changes=2, max_records=3)
+        for serial in range(1, 4):
+            history.add(self.soa(serial), [], self.soa(serial + 1), [])
+        self.assertEqual(len(history), 2)
+        self.assertIsNone(history.since(1))
+        records = [a_record("www.nl.", "10.0.0.1")] * 2
+        history.add(self.soa(4), records, self.soa(5), records)
+        self.assertEqual(len(history), 0)
+
+    def test_record_changes(self):
+        old = Zone()
+        old.add_node("nl.", [soa_record("nl."), ns_record("nl.", "ns.nl.")])
+        old.add_node("www.nl.", [a_record("www.nl.", "10.0.0.1")])
+        new = Zone()
+        new.add_node("nl.", [soa_record("nl."), ns_record("nl.", "ns.nl.")])
+        new.add_node("www.nl.", [a_record("www.nl.", "10.0.0.2")])
+        deleted, added = record_changes(old, new)
+        self.assertEqual([r.rdata.address for r in deleted], ["10.0.0.1"])
+        self.assertEqual([r.rdata.address for r in added], ["10.0.0.2"])